@@ -0,0 +1,297 @@
+"""
+バックエンドのベンチマーク（合成カタログで段階ごとの所要時間とピークメモリを測る）
+
+reciept.json / reciept-cost.json と同じ形式の合成カタログを N（レシピ数）・M（日数）・
+カテゴリ/ジャンル構成のグリッドで作り、次の段階を別々に計測する:
+    load_json_sources / build_price_table / preprocess / build_similarity / recipe_details /
+    QUBO の項ごと（H1〜H7）/ solve / decode / JSON シリアライズ
+
+使い方:
+    python benchmark.py                                  # 既定（quick）グリッド、local ソルバー
+    python benchmark.py --grid full --solver stub        # N 250〜10000 × M 5〜30 × 3構成
+    python benchmark.py --output bench.json --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json   # 基準より遅い・重い段階があれば終了コード 1
+
+QUBO の係数行列は (N×M)^2 の密行列なので、--max-qubo-gb を超えるケースは前処理だけ測り、
+QUBO 以降は skipped として記録する。
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+import main
+
+
+# カテゴリ（0:主菜 1:副菜 2:主食 3:汁物 4:デザート）の出現比とジャンル数
+MIXES = {
+    "school": {"category_weights": [102, 55, 85, 42, 11], "genres": 5},  # reciept.json と同じ比率
+    "balanced": {"category_weights": [1, 1, 1, 1, 1], "genres": 12},
+    "skewed": {"category_weights": [10, 60, 10, 15, 5], "genres": 2},
+}
+
+GRIDS = {
+    "quick": {"N": [250, 1000], "M": [5, 10], "mix": ["school"]},
+    "full": {"N": [250, 1000, 2500, 5000, 10000], "M": [5, 10, 20, 30], "mix": ["school", "balanced", "skewed"]},
+}
+
+NUT_KEYS = ["エネルギー", "たんぱく質", "脂質", "ナトリウム"]
+# カテゴリごとの栄養（NUT_KEYS の順）の平均
+CATEGORY_NUTRITION = {
+    0: (220.0, 14.0, 9.0, 400.0),
+    1: (60.0, 2.0, 2.0, 250.0),
+    2: (280.0, 6.0, 4.0, 200.0),
+    3: (50.0, 3.0, 2.0, 600.0),
+    4: (100.0, 2.0, 3.0, 40.0),
+}
+
+
+def generate_catalog(N: int, mix: str, seed: int = 0) -> tuple[list[dict], list[dict]]:
+    """合成カタログ（recipes_raw, cost_raw）を作る。同じ引数なら同じ内容"""
+    rng = np.random.default_rng(seed)
+    spec = MIXES[mix]
+    weights = np.asarray(spec["category_weights"], dtype=float)
+    n_foods = max(200, N // 5)
+
+    cats = rng.choice(len(weights), size=N, p=weights / weights.sum())
+    genres = rng.integers(spec["genres"], size=N)
+
+    recipes = []
+    for i in range(N):
+        c = int(cats[i])
+        means = CATEGORY_NUTRITION[c]
+        noise = rng.gamma(4.0, 0.25, size=len(means))
+        n_ing = int(rng.integers(5, 16))
+        foods = rng.choice(n_foods, size=n_ing, replace=False) + 1
+        months = [1] * 12
+        if rng.random() < 0.2:
+            start = int(rng.integers(12))
+            months = [1 if (m - start) % 12 < 6 else 0 for m in range(12)]
+        recipes.append({
+            "id": i + 1,
+            "title": f"recipe_{i + 1}",
+            "category": c,
+            "genre": int(genres[i]),
+            "active": 1,
+            "is_month": months,
+            "nutritions": {key: round(float(m * f), 1) for key, m, f in zip(NUT_KEYS, means, noise)},
+            "ingredients": [
+                {"id": int(fid), "name": f"food_{int(fid)}", "amount": round(float(rng.uniform(5.0, 120.0)), 1)}
+                for fid in foods
+            ],
+        })
+
+    # 1割の食材は単価なし（median で補完される）
+    priced = rng.random(n_foods) < 0.9
+    costs = [
+        {"food_id": fid + 1, "cost": round(float(rng.lognormal(0.0, 0.6)), 2)}
+        for fid in range(n_foods) if priced[fid]
+    ]
+    return recipes, costs
+
+
+def make_stub_solver(catalog):
+    """各日・各必須カテゴリで一次係数が最小のレシピを1品ずつ選ぶだけのソルバー（パイプライン計測用）"""
+    def solve_qubo_stub(Q, p, const, **_):
+        sol = np.zeros(p.shape, dtype=np.int8)
+        for c in main.REQ_CATS:
+            idxs = np.flatnonzero(catalog.cats == c)
+            sol[idxs[np.argmin(p[idxs], axis=0)], np.arange(p.shape[1])] = 1
+        x = sol.reshape(-1).astype(float)
+        energy = float(x @ Q.reshape(x.size, x.size) @ x + p.reshape(-1) @ x + const)
+        return sol, energy
+    return solve_qubo_stub
+
+
+def run_case(N: int, M: int, mix: str, *, solver: str, solver_options: dict, seed: int,
+             workdir: str, max_qubo_bytes: int, measure_memory: bool) -> dict:
+    recipes, costs = generate_catalog(N, mix, seed)
+    recipe_path = os.path.join(workdir, f"reciept_{N}_{mix}.json")
+    cost_path = os.path.join(workdir, f"reciept-cost_{N}_{mix}.json")
+    with open(recipe_path, "w", encoding="utf-8") as f:
+        json.dump(recipes, f, ensure_ascii=False)
+    with open(cost_path, "w", encoding="utf-8") as f:
+        json.dump(costs, f, ensure_ascii=False)
+    main.RECIPE_JSON_PATH, main.COST_JSON_PATH = recipe_path, cost_path
+    del recipes, costs
+
+    case = {
+        "key": f"N={N},M={M},mix={mix},solver={solver}",
+        "N": N, "M": M, "mix": mix, "solver": solver,
+        "stages": {}, "qubo_terms": {}, "skipped": None,
+    }
+    stages = case["stages"]
+    if measure_memory:
+        tracemalloc.start()
+
+    t0 = time.perf_counter()
+    recipes_raw, cost_raw = main.load_json_sources()
+    stages["load_json_sources"] = round(time.perf_counter() - t0, 4)
+
+    catalog = main.RecipeCatalog(recipes_raw, cost_raw, version="bench", timings=stages)
+    case["variables"] = catalog.N * M
+
+    TARGET = {"エネルギー": 650.0, "たんぱく質": 20.0, "脂質": 18.0, "ナトリウム": 1000.0, "cost": 300.0 * M}
+    W = {"H1": 80.0, "H2": 0.03, "H3": 0.006, "H4": 20.0, "H5": 0.2, "H7": 0.2}
+
+    if main.qubo_bytes(catalog.N, M, solver) > max_qubo_bytes:
+        case["skipped"] = f"QUBO needs ~{main.qubo_bytes(catalog.N, M, solver) / 2**30:.1f} GiB"
+    else:
+        t0 = time.perf_counter()
+        Q, p, const = main.build_qubo_coefficients(
+            catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost,
+            catalog.top_neighbors, catalog.top_sim, main.build_day_adjacency(M),
+            M=M, NUT_KEYS=catalog.NUT_KEYS, TARGET=TARGET, W=W, timings=case["qubo_terms"],
+        )
+        stages["qubo"] = round(time.perf_counter() - t0, 4)
+
+        solve_fn = make_stub_solver(catalog) if solver == "stub" else main.SOLVER_BACKENDS[solver]
+        t0 = time.perf_counter()
+        sol, energy = solve_fn(Q, p, const, **solver_options)
+        stages["solve"] = round(time.perf_counter() - t0, 4)
+        case["energy"] = energy
+        del Q
+
+        t0 = time.perf_counter()
+        plan, checks = main.decode_plan(catalog, sol)
+        stages["decode"] = round(time.perf_counter() - t0, 4)
+
+        t0 = time.perf_counter()
+        payload = json.dumps({"meta": {"M": M, "N_candidates": catalog.N}, "plan": plan, "checks": checks},
+                             ensure_ascii=False)
+        stages["json_serialize"] = round(time.perf_counter() - t0, 4)
+        case["json_bytes"] = len(payload.encode("utf-8"))
+
+    if measure_memory:
+        case["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    case["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return case
+
+
+def flatten_timings(case: dict) -> dict:
+    flat = dict(case["stages"])
+    flat.update({f"qubo.{k}": v for k, v in case["qubo_terms"].items()})
+    return flat
+
+
+def compare_with_baseline(results: dict, baseline: dict, *, time_tolerance: float, min_seconds: float,
+                          memory_tolerance: float) -> list[str]:
+    """基準より遅い段階・ピークメモリが増えたケースを列挙する"""
+    base_cases = {case["key"]: case for case in baseline.get("cases", [])}
+    regressions = []
+    for case in results["cases"]:
+        base = base_cases.get(case["key"])
+        if base is None:
+            continue
+        current, before = flatten_timings(case), flatten_timings(base)
+        for stage, seconds in current.items():
+            old = before.get(stage)
+            if old is None:
+                continue
+            if seconds > old * (1.0 + time_tolerance) and seconds - old > min_seconds:
+                regressions.append(f"{case['key']} {stage}: {old:.4f}s -> {seconds:.4f}s")
+        old_mem, new_mem = base.get("peak_memory_bytes"), case.get("peak_memory_bytes")
+        if old_mem and new_mem and new_mem > old_mem * (1.0 + memory_tolerance):
+            regressions.append(f"{case['key']} peak_memory: {old_mem / 2**20:.1f} MiB -> {new_mem / 2**20:.1f} MiB")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="合成カタログでバックエンドの段階ごとの所要時間を測る")
+    parser.add_argument("--grid", choices=sorted(GRIDS), default="quick")
+    parser.add_argument("--N", type=int, nargs="*", help="グリッドの N を上書き")
+    parser.add_argument("--M", type=int, nargs="*", help="グリッドの M を上書き")
+    parser.add_argument("--mix", nargs="*", choices=sorted(MIXES), help="グリッドの構成を上書き")
+    parser.add_argument("--solver", choices=["local", "stub"], default="local")
+    parser.add_argument("--sweeps", type=int, default=5, help="local ソルバーの sweeps")
+    parser.add_argument("--time-limit-ms", type=int, default=10000, help="local ソルバーの time_limit_ms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-qubo-gb", type=float, default=2.0, help="これを超える QUBO は作らずに skipped にする")
+    parser.add_argument("--no-memory", action="store_true", help="tracemalloc によるピークメモリ計測をしない（計測の負荷を除く）")
+    parser.add_argument("--output", default="benchmark_results.json", help="結果の JSON")
+    parser.add_argument("--baseline", help="比較する基準の JSON（遅くなった段階があれば終了コード 1）")
+    parser.add_argument("--save-baseline", help="今回の結果を基準として保存するパス")
+    parser.add_argument("--time-tolerance", type=float, default=0.5, help="基準から何割まで遅くてよいか")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="これ未満の差は無視する（秒）")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="ピークメモリの増加を何割まで許すか")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    grid = dict(GRIDS[args.grid])
+    for key in ("N", "M", "mix"):
+        if getattr(args, key):
+            grid[key] = getattr(args, key)
+
+    solver_options = {"sweeps": args.sweeps, "time_limit_ms": args.time_limit_ms, "seed": args.seed}
+    results = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "grid": grid,
+        "solver": args.solver,
+        "solver_options": solver_options if args.solver == "local" else {},
+        "cases": [],
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for mix in grid["mix"]:
+            for N in grid["N"]:
+                for M in grid["M"]:
+                    case = run_case(
+                        N, M, mix,
+                        solver=args.solver,
+                        solver_options=results["solver_options"],
+                        seed=args.seed,
+                        workdir=workdir,
+                        max_qubo_bytes=int(args.max_qubo_gb * 2**30),
+                        measure_memory=not args.no_memory,
+                    )
+                    results["cases"].append(case)
+                    total = sum(case["stages"].values())
+                    peak = case.get("peak_memory_bytes")
+                    peak_text = f"{peak / 2**20:.1f} MiB" if peak else "-"
+                    print(f"[INFO] {case['key']}: total={total:.3f}s peak={peak_text}"
+                          + (f" skipped ({case['skipped']})" if case["skipped"] else ""))
+                    print(f"       {json.dumps(flatten_timings(case), ensure_ascii=False)}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] Results written to {args.output}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"[INFO] Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(
+            results, baseline,
+            time_tolerance=args.time_tolerance,
+            min_seconds=args.min_seconds,
+            memory_tolerance=args.memory_tolerance,
+        )
+        if regressions:
+            print(f"[ERROR] {len(regressions)} regression(s) against {args.baseline}:")
+            for line in regressions:
+                print(f"[ERROR]   {line}")
+            sys.exit(1)
+        print(f"[INFO] No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    run()
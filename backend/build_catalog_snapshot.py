@@ -0,0 +1,114 @@
+"""
+レシピカタログのスナップショットを作るビルドツール
+
+reciept.json / reciept-cost.json を前処理したカタログ（cats, genres, nut, recipe_cost, 疎行列 X、
+上位近傍、価格表）を .npy に、レシピ名・食材名を文字列表にして書き出す。
+サーバーは起動時に JSON のハッシュと manifest.json の source_sha256 を照合し、一致すれば
+JSON のパース・前処理・類似度計算をせずに mmap で読む（複数プロセスでページを共有する）。
+JSON が正で、一致しなければ従来どおり JSON から作る。
+
+使い方:
+    python build_catalog_snapshot.py                    # catalog_snapshot/ に書き出す
+    python build_catalog_snapshot.py --output /tmp/snap
+    python build_catalog_snapshot.py --check            # 既存のスナップショットを検証（不一致なら終了コード 1）
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from main import (
+    CATALOG_SNAPSHOT_PATH,
+    COST_JSON_PATH,
+    RECIPE_JSON_PATH,
+    TOPK_SIM,
+    RecipeCatalog,
+    catalog_source_digest,
+    load_catalog_snapshot,
+    read_snapshot_manifest,
+    verify_catalog_snapshot,
+    write_catalog_snapshot,
+)
+
+
+def build_from_json():
+    recipes_bytes = Path(RECIPE_JSON_PATH).read_bytes()
+    cost_bytes = Path(COST_JSON_PATH).read_bytes()
+    digest = catalog_source_digest(recipes_bytes, cost_bytes)
+    catalog = RecipeCatalog(
+        json.loads(recipes_bytes.decode("utf-8")),
+        json.loads(cost_bytes.decode("utf-8")),
+        topk_sim=TOPK_SIM,
+        version=digest[:16],
+    )
+    return catalog, digest
+
+
+def compare_catalogs(expected: RecipeCatalog, actual: RecipeCatalog) -> list[str]:
+    """JSON から作ったカタログとスナップショットの配列・レシピ詳細を比べる。Returns: 一致しなかった項目"""
+    diffs = []
+    for name in ("cats", "genres", "nut", "recipe_cost", "is_month", "food_ids", "top_neighbors", "top_sim"):
+        if not np.array_equal(np.asarray(getattr(expected, name)), np.asarray(getattr(actual, name))):
+            diffs.append(name)
+    if (expected.X != actual.X).nnz:
+        diffs.append("X")
+    if list(expected.df["recipe_id"]) != list(actual.df["recipe_id"]):
+        diffs.append("recipe_id")
+    if list(expected.df["title"]) != [actual.df["title"][i] for i in range(actual.N)]:
+        diffs.append("title")
+    for i in range(expected.N):
+        a, b = expected.recipe_details[i], actual.recipe_details[i]
+        if a["ingredients"] != b["ingredients"] or a["recipe_cost"] != b["recipe_cost"]:
+            diffs.append(f"recipe_details[{i}]")
+            break
+    return diffs
+
+
+def check_snapshot(path) -> int:
+    manifest = read_snapshot_manifest(path)
+    if manifest is None:
+        print(f"[ERROR] {path}/manifest.json not found")
+        return 1
+    bad = verify_catalog_snapshot(path, manifest)
+    if bad:
+        print(f"[ERROR] checksum mismatch: {bad}")
+        return 1
+
+    catalog, digest = build_from_json()
+    snapshot = load_catalog_snapshot(path, digest)
+    if snapshot is None:
+        print(f"[ERROR] snapshot (version={manifest.get('version')}) does not match the JSON sources (version={catalog.version})")
+        return 1
+    diffs = compare_catalogs(catalog, snapshot)
+    if diffs:
+        print(f"[ERROR] snapshot differs from the JSON build: {diffs}")
+        return 1
+    print(f"[INFO] snapshot OK (version={manifest['version']}, N={manifest['N']})")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="レシピカタログのスナップショットを作る")
+    parser.add_argument("--output", default=CATALOG_SNAPSHOT_PATH or "catalog_snapshot", help="書き出すディレクトリ")
+    parser.add_argument("--check", action="store_true", help="書き出さずに既存のスナップショットを検証する")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(check_snapshot(args.output))
+
+    catalog, digest = build_from_json()
+    manifest = write_catalog_snapshot(catalog, args.output, digest)
+    size = sum(f.stat().st_size for f in Path(args.output).iterdir())
+    print(f"[INFO] Wrote catalog snapshot to {args.output} (version={manifest['version']}, N={manifest['N']}, {size / 1024:.1f} KiB)")
+
+    diffs = compare_catalogs(catalog, load_catalog_snapshot(args.output, digest))
+    if diffs:
+        print(f"[ERROR] snapshot differs from the JSON build: {diffs}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+保存済み献立（school_menus.menu_data）を compact 形式に変換する移行ツール
+
+従来は最適化結果をそのまま保存していたため、各レシピの栄養・食材リスト・単価と meta が
+行ごとに重複して入っている。これを recipe_id・日別集計・カタログのバージョンと使った食材の単価だけの形にする。
+/get_menu は読み出し時にカタログから詳細を復元するので、変換前後どちらの行も読める。
+
+使い方:
+    python compact_menu_data.py                    # 100件ずつ全件変換
+    python compact_menu_data.py --batch-size 500 --limit 2000
+    python compact_menu_data.py --dry-run          # 変換せずにサイズだけ集計
+
+現在のカタログに無いレシピを含む行は、詳細を復元できなくなるので変換しない（--force で変換）。
+変換後は VACUUM (ANALYZE) school_menus; で GIN インデックスの領域を回収する。
+"""
+
+import argparse
+import json
+
+from main import (
+    MENU_DATA_FORMAT,
+    compact_menu_data,
+    db_connection,
+    get_catalog,
+)
+
+
+def compact_saved_menus(batch_size: int = 100, limit: int = None, dry_run: bool = False, force: bool = False) -> dict:
+    """
+    従来形式の行を school_menu_id 順に batch_size 件ずつ変換する（1バッチ = 1トランザクション）
+
+    Returns:
+        集計（変換件数・スキップ件数・変換前後の JSON サイズ）
+    """
+    catalog = get_catalog()
+    stats = {"scanned": 0, "compacted": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    last_id = 0
+
+    while limit is None or stats["scanned"] < limit:
+        size = batch_size if limit is None else min(batch_size, limit - stats["scanned"])
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT school_menu_id, menu_data
+                FROM school_menus
+                WHERE school_menu_id > %s AND (menu_data ->> 'format') IS DISTINCT FROM %s
+                ORDER BY school_menu_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (last_id, MENU_DATA_FORMAT, size))
+            rows = cur.fetchall()
+            if not rows:
+                cur.close()
+                break
+
+            for menu_id, menu_data in rows:
+                # JSON文字列をパース（pg8000の場合は既にdictになっている可能性あり）
+                if isinstance(menu_data, str):
+                    menu_data = json.loads(menu_data)
+                stats["scanned"] += 1
+
+                compact = compact_menu_data(menu_data)
+                missing = [
+                    rid for day in compact["plan"]["days"] for rid in day["recipe_ids"]
+                    if rid not in catalog.recipe_index
+                ]
+                if missing and not force:
+                    print(f"[WARN] school_menu_id={menu_id}: recipes not in catalog {missing[:5]}, skipped")
+                    stats["skipped"] += 1
+                    continue
+
+                before = json.dumps(menu_data, ensure_ascii=False)
+                after = json.dumps(compact, ensure_ascii=False)
+                stats["bytes_before"] += len(before.encode("utf-8"))
+                stats["bytes_after"] += len(after.encode("utf-8"))
+                stats["compacted"] += 1
+
+                if not dry_run:
+                    cur.execute("""
+                        UPDATE school_menus
+                        SET menu_data = %s::jsonb, updated_at = CURRENT_TIMESTAMP
+                        WHERE school_menu_id = %s
+                    """, (after, menu_id))
+
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+            cur.close()
+
+        last_id = rows[-1][0]
+        print(f"[INFO] up to school_menu_id={last_id}: {stats}")
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="school_menus.menu_data を compact 形式に変換する")
+    parser.add_argument("--batch-size", type=int, default=100, help="1トランザクションで変換する件数")
+    parser.add_argument("--limit", type=int, default=None, help="処理する最大件数")
+    parser.add_argument("--dry-run", action="store_true", help="変換せずにサイズだけ集計する")
+    parser.add_argument("--force", action="store_true", help="カタログに無いレシピを含む行も変換する")
+    args = parser.parse_args()
+
+    stats = compact_saved_menus(
+        batch_size=max(1, args.batch_size),
+        limit=args.limit,
+        dry_run=args.dry_run,
+        force=args.force,
+    )
+    print(f"[INFO] Done: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+gunicorn の設定（本番用: gunicorn -c gunicorn.conf.py wsgi:app）
+
+prefork（GUNICORN_WORKERS 個のプロセス）× 各プロセス GUNICORN_THREADS 本のスレッドで同時にリクエストを処理する。
+Cloud Run の --concurrency は workers × threads 以下にする。
+
+非同期ジョブ（/jobs）・結果キャッシュ・メトリクスはプロセスごとに持つので、既定はワーカー1つで
+スレッドを増やして並行処理する。ワーカーを増やすと /jobs の状態確認が別のワーカーに届いて 404 になる。
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("GUNICORN_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+worker_class = "gthread"
+
+# wsgi.py をマスターで読み込んでから fork する（カタログ・import 済みモジュールを共有）
+preload_app = True
+
+# 最適化は数分かかることがあるので、Cloud Run のリクエストタイムアウトに合わせる
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} forked (threads={threads})")
+
+
+def when_ready(server):
+    if workers > 1:
+        server.log.warning(
+            f"GUNICORN_WORKERS={workers}: /jobs, the result cache and /metrics are per worker process"
+        )
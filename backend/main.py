@@ -24,26 +24,45 @@
 
 import os
 import json
+import atexit
+import copy
+import time
+import uuid
+import hashlib
+import re
+import threading
+import queue
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 import numpy as np
+from scipy import sparse
 from flask import Flask, request, jsonify, make_response
 app = Flask(__name__)
-from amplify import VariableGenerator, sum, solve, AmplifyAEClient
+from amplify import VariableGenerator, sum, solve, AmplifyAEClient, ConstraintList, one_hot, less_equal
 
 # PostgreSQL接続用
 import psycopg2
 from psycopg2.extras import Json
 
-# Cloud SQL Proxy 用（オプション）
-try:
-    from google.cloud.sql.connector import Connector
-    CLOUD_SQL_AVAILABLE = True
-except ImportError:
-    CLOUD_SQL_AVAILABLE = False
-    Connector = None
+# Cloud SQL Proxy 用（オプション）。import が重く、Connector はスレッドを持つので、
+# 起動時ではなく初めて Cloud SQL に接続するとき（fork 後の各ワーカー）に読み込む
+_cloud_sql_available = None
+
+
+def cloud_sql_available() -> bool:
+    """google.cloud.sql.connector が使えるか（初回だけ import を試す）"""
+    global _cloud_sql_available
+    if _cloud_sql_available is None:
+        try:
+            import google.cloud.sql.connector  # noqa: F401
+            _cloud_sql_available = True
+        except ImportError:
+            _cloud_sql_available = False
+    return _cloud_sql_available
 
 
 # ============
@@ -54,20 +73,37 @@ except ImportError:
 RECIPE_JSON_PATH = "reciept.json"
 COST_JSON_PATH   = "reciept-cost.json"
 
+# build_catalog_snapshot.py で作るバイナリのスナップショット（JSON と一致する場合だけ使う。"" で使わない）
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot")
+
 
 # ============
 # データベース接続関数
 # ============
+_connector_lock = threading.Lock()
+_connector = None
+
+
+def get_cloud_sql_connector():
+    """プロセスで1つの Cloud SQL Connector を返す（初回に生成、終了時に close_db_pool で閉じる）"""
+    global _connector
+    with _connector_lock:
+        if _connector is None:
+            from google.cloud.sql.connector import Connector
+            _connector = Connector()
+        return _connector
+
+
 def get_db_connection():
-    """PostgreSQLデータベースへの接続を取得"""
+    """PostgreSQLデータベースへの新しい接続を作る（通常は db_connection() でプールから借りる）"""
 
     # Cloud SQL接続名が設定されている場合は Cloud SQL Proxy を使用
     cloud_sql_connection_name = os.getenv("CLOUD_SQL_CONNECTION_NAME")
 
-    if cloud_sql_connection_name and CLOUD_SQL_AVAILABLE:
+    if cloud_sql_connection_name and cloud_sql_available():
         # Cloud SQL Proxy 経由で接続（VPC Connector 不要）
         print(f"[INFO] Connecting to Cloud SQL via Proxy: {cloud_sql_connection_name}")
-        connector = Connector()
+        connector = get_cloud_sql_connector()
 
         conn = connector.connect(
             cloud_sql_connection_name,
@@ -90,67 +126,335 @@ def get_db_connection():
         return conn
 
 
-def save_menu_to_db(school_id, target_year_month, target_week, menu_data, total_cost, total_nutrition_avg):
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_IDLE_SECONDS = int(os.getenv("DB_POOL_MAX_IDLE_SECONDS", "300"))
+DB_POOL_MAX_LIFETIME_SECONDS = int(os.getenv("DB_POOL_MAX_LIFETIME_SECONDS", "1800"))
+DB_POOL_CHECKOUT_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT_SECONDS", "10"))
+
+
+class ConnectionPool:
     """
-    献立データをschool_menusテーブルに保存
+    DB接続のプール
+
+    貸し出し時に SELECT 1 で死活確認し、アイドル時間や生存時間が上限を超えた接続は作り直す。
+    接続は pg8000 / psycopg2 のどちらでもよい（cursor / commit / rollback / close のみ使う）。
+    """
+
+    def __init__(self, factory, *, min_size: int, max_size: int, max_idle_seconds: float,
+                 max_lifetime_seconds: float, checkout_timeout_seconds: float):
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.max_idle_seconds = max_idle_seconds
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+
+        self._cond = threading.Condition()
+        self._idle = []       # [(conn, created_at, last_used)]
+        self._created_at = {}  # id(conn) -> created_at（貸し出し中も含む）
+        self._opening = 0      # 生成中の接続数
+        self._closed = False
+        self._counters = {
+            "created": 0,
+            "closed": 0,
+            "recycled": 0,
+            "health_check_failures": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+        }
+
+    def _register(self, conn):
+        self._created_at[id(conn)] = time.monotonic()
+        self._counters["created"] += 1
+
+    def _close(self, conn):
+        self._created_at.pop(id(conn), None)
+        self._counters["closed"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def fill(self):
+        """min_size まで接続を作っておく（起動直後の初回リクエストで接続を待たないため）"""
+        while True:
+            with self._cond:
+                if len(self._created_at) + self._opening >= self.min_size:
+                    return
+                self._opening += 1
+            try:
+                conn = self.factory()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+            with self._cond:
+                self._register(conn)
+                self._idle.append((conn, self._created_at[id(conn)], time.monotonic()))
+                self._cond.notify()
+
+    def acquire(self):
+        """接続を借りる。接続の生成や死活確認はロックの外で行う"""
+        deadline = time.monotonic() + self.checkout_timeout_seconds
+        while True:
+            conn = None
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("connection pool is closed")
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                elif len(self._created_at) + self._opening < self.max_size:
+                    self._opening += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise TimeoutError("Timed out waiting for a database connection.")
+                    self._counters["waits"] += 1
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    conn = self.factory()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                with self._cond:
+                    self._register(conn)
+                    self._counters["checkouts"] += 1
+                return conn
+
+            now = time.monotonic()
+            if now - last_used > self.max_idle_seconds or now - created_at > self.max_lifetime_seconds:
+                with self._cond:
+                    self._counters["recycled"] += 1
+                    self._close(conn)
+                continue
+            if not self._is_alive(conn):
+                with self._cond:
+                    self._counters["health_check_failures"] += 1
+                    self._close(conn)
+                continue
+            with self._cond:
+                self._counters["checkouts"] += 1
+            return conn
+
+    def release(self, conn, *, discard: bool = False):
+        with self._cond:
+            if not discard:
+                try:
+                    conn.rollback()  # 途中のトランザクションを残さない
+                except Exception:
+                    discard = True
+            if discard or self._closed:
+                self._close(conn)
+            else:
+                self._idle.append((conn, self._created_at.get(id(conn), time.monotonic()), time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._close(conn)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            size = len(self._created_at)
+            return {
+                "size": size,
+                "idle": len(self._idle),
+                "in_use": size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                **self._counters,
+            }
+
+
+_db_pool_lock = threading.Lock()
+_db_pool = None
+
+
+def get_db_pool() -> ConnectionPool:
+    """プロセスで共有する接続プール（初回に min_size 本の接続を作る）"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            pool = ConnectionPool(
+                get_db_connection,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                max_idle_seconds=DB_POOL_MAX_IDLE_SECONDS,
+                max_lifetime_seconds=DB_POOL_MAX_LIFETIME_SECONDS,
+                checkout_timeout_seconds=DB_POOL_CHECKOUT_TIMEOUT_SECONDS,
+            )
+            pool.fill()
+            _db_pool = pool
+        return _db_pool
+
+
+def db_connection():
+    """
+    プールから接続を借りるコンテキストマネージャ
+
+    with db_connection() as conn: ... の中で commit する。例外時は rollback してから返却する。
+    """
+    return get_db_pool().connection()
+
+
+@atexit.register
+def close_db_pool():
+    """プールの接続と共有 Connector を閉じる"""
+    global _db_pool, _connector
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
+    with _connector_lock:
+        if _connector is not None:
+            _connector.close()
+            _connector = None
+
+
+def save_menus_to_db(records, *, replace: bool = False) -> list[int]:
+    """
+    複数の献立を1トランザクションでschool_menusテーブルに保存（月の各週をまとめて保存する用）
 
     Args:
-        school_id: 小学校ID
-        target_year_month: 対象年月（VARCHAR(7)、YYYY-MM形式、例: "2026-03"）
-        target_week: 対象週（1〜5、NULLも可）
-        menu_data: 献立データ（JSONB）
-        total_cost: 合計コスト（円）
-        total_nutrition_avg: 平均栄養価（JSONB）
+        records: (school_id, target_year_month, target_week, menu_data, total_cost, total_nutrition_avg) のリスト
+        replace: True なら同じ school_id・target_year_month・target_week の既存献立を
+                 論理削除（deleted_at を設定）してから挿入する
 
     Returns:
-        menu_id: 保存された献立ID
+        menu_ids: 保存された献立ID（records と同じ順）
     """
-    conn = None
-    try:
-        conn = get_db_connection()
+    records = list(records)
+    if not records:
+        return []
+
+    with db_connection() as conn:
         cur = conn.cursor()
 
-        # JSONデータを文字列に変換（ダブルクォートで正しくシリアライズ）
-        import json
-        menu_data_json = json.dumps(menu_data, ensure_ascii=False)
-        total_nutrition_avg_json = json.dumps(total_nutrition_avg, ensure_ascii=False)
+        if replace:
+            # 同じ週の献立を重複させない（挿入と同じトランザクションで入れ替える）
+            for school_id, target_year_month, target_week in dict.fromkeys((r[0], r[1], r[2]) for r in records):
+                cur.execute("""
+                    UPDATE school_menus
+                    SET deleted_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                    WHERE school_id = %s AND target_year_month = %s
+                      AND target_week IS NOT DISTINCT FROM %s AND deleted_at IS NULL
+                """, (school_id, target_year_month, target_week))
+
+        # 複数行 INSERT（JSONデータはダブルクォートで正しくシリアライズ）
+        # 行番号（ord）の順に挿入して採番をそろえ、RETURNING の行はキーで records に対応づける
+        # （RETURNING の並びは保証されないので、行の位置には頼らない）
+        values_sql = ", ".join(["(%s::int, %s::int, %s::varchar, %s::smallint, %s::jsonb, %s::int, %s::jsonb)"] * len(records))
+        args = []
+        for n, (school_id, target_year_month, target_week, menu_data, total_cost, total_nutrition_avg) in enumerate(records):
+            args.extend([
+                n,
+                school_id,
+                target_year_month,
+                target_week,
+                json.dumps(menu_data, ensure_ascii=False),
+                total_cost,
+                json.dumps(total_nutrition_avg, ensure_ascii=False),
+            ])
 
-        # school_menusテーブルに挿入
-        cur.execute("""
+        cur.execute(f"""
             INSERT INTO school_menus
                 (school_id, target_year_month, target_week, menu_data, total_cost, total_nutrition_avg, created_at)
-            VALUES
-                (%s, %s, %s, %s::jsonb, %s, %s::jsonb, CURRENT_TIMESTAMP)
-            RETURNING school_menu_id
-        """, (
-            school_id,
-            target_year_month,
-            target_week,
-            menu_data_json,
-            total_cost,
-            total_nutrition_avg_json
-        ))
-
-        result = cur.fetchone()
-        if result is None:
+            SELECT v.school_id, v.target_year_month, v.target_week, v.menu_data, v.total_cost, v.total_nutrition_avg,
+                   CURRENT_TIMESTAMP
+            FROM (VALUES {values_sql})
+                AS v(ord, school_id, target_year_month, target_week, menu_data, total_cost, total_nutrition_avg)
+            ORDER BY v.ord
+            RETURNING school_menu_id, school_id, target_year_month, target_week
+        """, tuple(args))
+
+        rows = cur.fetchall()
+        if len(rows) != len(records):
             raise Exception("Failed to insert menu data")
 
-        menu_id = result[0]
         conn.commit()
         cur.close()
 
-        return menu_id
+    return menu_ids_by_record(records, rows)
+
+
+def menu_ids_by_record(records, rows) -> list[int]:
+    """
+    INSERT ... RETURNING school_menu_id, school_id, target_year_month, target_week の行を records の順の id にする
+
+    同じキー（学校・年月・週）の行が複数あるときは、ord の順に採番されているので id の小さい順に割り当てる。
+    """
+    def _key(school_id, target_year_month, target_week):
+        return (int(school_id), str(target_year_month), None if target_week is None else int(target_week))
+
+    ids = defaultdict(list)
+    for menu_id, school_id, target_year_month, target_week in rows:
+        ids[_key(school_id, target_year_month, target_week)].append(int(menu_id))
+    for key_ids in ids.values():
+        key_ids.sort(reverse=True)
+    try:
+        return [ids[_key(*r[:3])].pop() for r in records]
+    except IndexError:
+        raise Exception("Inserted menu rows do not match the records")
 
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        raise e
-    finally:
-        if conn:
-            conn.close()
 
- 
- 
+def save_menu_to_db(school_id, target_year_month, target_week, menu_data, total_cost, total_nutrition_avg,
+                    *, replace: bool = False):
+    """
+    献立データをschool_menusテーブルに保存
+
+    Args:
+        school_id: 小学校ID
+        target_year_month: 対象年月（VARCHAR(7)、YYYY-MM形式、例: "2026-03"）
+        target_week: 対象週（1〜5、NULLも可）
+        menu_data: 献立データ（JSONB）
+        total_cost: 合計コスト（円）
+        total_nutrition_avg: 平均栄養価（JSONB）
+        replace: True なら同じ週の既存献立を置き換える
+
+    Returns:
+        menu_id: 保存された献立ID
+    """
+    return save_menus_to_db(
+        [(school_id, target_year_month, target_week, menu_data, total_cost, total_nutrition_avg)],
+        replace=replace,
+    )[0]
 
 
 # ============
@@ -192,6 +496,41 @@ def build_price_table(cost_raw: list[dict]) -> tuple[dict[int, float], float]:
     return price_per_g, median_price
 
 
+def recipe_row(r: dict, NUT_KEYS: list, price_per_g: dict, median_price: float):
+    """
+    レシピ1件を配列の1行にする（preprocess とカタログの差分更新で共用）
+
+    Returns:
+        (category, genre, 栄養ベクトル, 原価, [(food_id, amount_g), ...])
+    """
+    nutr = r.get("nutritions", {}) or {}
+    nut_row = np.array([float(nutr.get(key, 0.0) or 0.0) for key in NUT_KEYS])
+
+    csum = 0.0
+    foods = []
+    for ing in r.get("ingredients", []):
+        fid = ing.get("id")
+        amt = ing.get("amount")
+        if fid is None or amt is None:
+            continue
+        fid = int(fid)
+        amt = float(amt)  # g
+        price = float(price_per_g.get(fid, median_price))
+        csum += amt * price
+        foods.append((fid, amt))
+
+    return int(r.get("category", -1)), int(r.get("genre", -1)), nut_row, csum, foods
+
+
+def recipe_months(r: dict) -> np.ndarray:
+    """提供可能月（is_month：1〜12月の 0/1。無ければ通年）"""
+    months = np.ones(12, dtype=bool)
+    is_month = r.get("is_month")
+    if isinstance(is_month, list) and is_month:
+        months[:min(12, len(is_month))] = [bool(v) for v in is_month[:12]]
+    return months
+
+
 def preprocess(recipes_raw, price_per_g, median_price):
     # active==1を優先
     recipes = [r for r in recipes_raw if int(r.get("active", 1)) == 1]
@@ -217,7 +556,8 @@ def preprocess(recipes_raw, price_per_g, median_price):
     genres = np.zeros(N, dtype=int)
     nut = np.zeros((N, len(NUT_KEYS)), dtype=float)
     recipe_cost = np.zeros(N, dtype=float)
-    X = np.zeros((N, K), dtype=float)  # 食材amountベクトル
+    # 食材amountベクトル（1レシピの食材は数品なので CSR で持つ）
+    X_rows, X_cols, X_vals = [], [], []
 
     # フロント表示用に recipe_id を拾えるなら拾う（なければ idx を使う）
     recipe_ids = []
@@ -225,29 +565,16 @@ def preprocess(recipes_raw, price_per_g, median_price):
     for i, r in enumerate(recipes):
         recipe_ids.append(r.get("id", i))
         titles.append(r.get("title", f"recipe_{i}"))
-        cats[i] = int(r.get("category", -1))
-        genres[i] = int(r.get("genre", -1))
-
-        nutr = r.get("nutritions", {}) or {}
-        for k_idx, key in enumerate(NUT_KEYS):
-            nut[i, k_idx] = float(nutr.get(key, 0.0) or 0.0)
-
-        csum = 0.0
-        for ing in r.get("ingredients", []):
-            fid = ing.get("id")
-            amt = ing.get("amount")
-            if fid is None or amt is None:
-                continue
-            fid = int(fid)
-            amt = float(amt)  # g
-            price = float(price_per_g.get(fid, median_price))
-            csum += amt * price
-
+        cats[i], genres[i], nut[i], recipe_cost[i], foods = recipe_row(r, NUT_KEYS, price_per_g, median_price)
+        for fid, amt in foods:
             j = fid_to_idx.get(fid)
             if j is not None:
-                X[i, j] += amt
+                X_rows.append(i)
+                X_cols.append(j)
+                X_vals.append(amt)
 
-        recipe_cost[i] = csum
+    # 同じ食材が複数行ある場合は CSR 変換時に合算される
+    X = sparse.csr_matrix((X_vals, (X_rows, X_cols)), shape=(N, K), dtype=float)
 
     # df（表示しやすい中間表）
     df = {
@@ -267,349 +594,5152 @@ def preprocess(recipes_raw, price_per_g, median_price):
     return recipes, df, cats, genres, nut, recipe_cost, X, NUT_KEYS
 
 
-def build_similarity(X: np.ndarray, genres: np.ndarray, M: int, topk: int):
+# 類似度をブロック計算するときの1ブロックあたりの要素数（行数 × N）の目安
+SIM_BLOCK_ELEMS = 4_000_000
+
+
+def build_similarity(X: sparse.csr_matrix, topk: int):
+    """
+    食材ベクトルのコサイン類似度で各レシピの上位 topk 近傍を求める
+
+    N×N の類似度行列は保持せず、行ブロックごとに計算して argpartition で上位だけ残す。
+
+    Returns:
+        (top_neighbors, top_sim): 近傍index（N×k）と、その類似度 sim[i, ip]（N×k, float32）
+    """
+    N = X.shape[0]
+    k = min(topk, N - 1)
+
     # cosine similarity
-    X_norm = np.linalg.norm(X, axis=1, keepdims=True) + 1e-9
-    Xn = X / X_norm
-    sim = (Xn @ Xn.T).astype(np.float32)
-    np.fill_diagonal(sim, 0.0)
+    Xn = sparse.csr_matrix(sparse.diags(1.0 / row_norms(X)) @ X)
+    XnT = Xn.T.tocsc()
+
+    top_neighbors = np.zeros((N, k), dtype=np.int64)
+    top_sim = np.zeros((N, k), dtype=np.float32)
+    if k <= 0:
+        return top_neighbors, top_sim
+
+    block = max(1, SIM_BLOCK_ELEMS // N)
+    for start in range(0, N, block):
+        stop = min(start + block, N)
+        rows = np.arange(start, stop)
+        S = (Xn[start:stop] @ XnT).toarray().astype(np.float32)
+        S[rows - start, rows] = -np.inf  # 自分自身は除外
+        top_neighbors[start:stop], top_sim[start:stop] = top_k_rows(S, k)
+
+    return top_neighbors, top_sim
+
+
+def row_norms(X: sparse.csr_matrix) -> np.ndarray:
+    """コサイン類似度用の行ノルム（0 除算よけに 1e-9 を足す）"""
+    return np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel()) + 1e-9
+
+
+def top_k_rows(S: np.ndarray, k: int):
+    """類似度ブロック S（自分自身は -inf にしておく）の各行から上位 k 件を類似度の降順で取る"""
+    part = np.argpartition(-S, k - 1, axis=1)[:, :k]
+    part_sim = np.take_along_axis(S, part, axis=1)
+    order = np.argsort(-part_sim, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_sim, order, axis=1)
 
-    # g: 同ジャンル
-    g = (genres[:, None] == genres[None, :]).astype(np.int8)
-    np.fill_diagonal(g, 0)
 
+def build_day_adjacency(M: int) -> np.ndarray:
     # d: 隣接日
     d = np.zeros((M, M), dtype=np.int8)
     for r in range(M):
         for rp in range(M):
             if abs(r - rp) == 1:
                 d[r, rp] = 1
+    return d
 
-    # top neighbors
-    N = X.shape[0]
-    top_neighbors = []
-    for i in range(N):
-        idxs = np.argsort(-sim[i])
-        nbrs = [int(j) for j in idxs[: topk + 1] if j != i][:topk]
-        top_neighbors.append(nbrs)
 
-    return sim, g, d, top_neighbors
+# ============
+# 前処理済みカタログ（プロセス内キャッシュ）
+# ============
+TOPK_SIM = 12
 
 
-def solve_menu(
-    recipes_raw,
-    cost_raw,
-    *,
-    M: int,
-    topk_sim: int,
-    amplify_token: str,
-    TARGET: dict,
-    W: dict,
-    H5_MODE: str = "practical",
-):
-    price_per_g, median_price = build_price_table(cost_raw)
-    recipes, df, cats, genres, nut, recipe_cost, X, NUT_KEYS = preprocess(recipes_raw, price_per_g, median_price)
+class LazyRecipeDetails:
+    """
+    レシピ詳細を参照されたものだけ作る列（学校ごとの単価で作り直したカタログ用）
 
-    # カテゴリindex集合
-    cat_to_idxs = {c: np.where(cats == c)[0].tolist() for c in sorted(set(cats))}
-    for c in REQ_CATS + OPT_CATS:
-        if len(cat_to_idxs.get(c, [])) == 0:
-            raise ValueError(f"category {c} has no recipes. CATEGORY_NAME/REQ_CATS/OPT_CATS mapping mismatch.")
+    献立の展開で使うのは選ばれた数十件だけなので、全件を作り直さない。
+    index n は base の base_idx[n] 番目のレシピ（subset しても元カタログの index を返す）。
+    """
 
-    sim, g, d, top_neighbors = build_similarity(X, genres, M, topk_sim)
-    N = len(recipes)
+    def __init__(self, base: "RecipeCatalog", base_idx=None, cache: dict = None):
+        self.base = base
+        self.base_idx = np.arange(base.N) if base_idx is None else np.asarray(base_idx)
+        self._cache = {} if cache is None else cache
 
-    # 変数
-    gen = VariableGenerator()
-    x = gen.array("Binary", (N, M))
+    def __len__(self):
+        return len(self.base_idx)
 
-    H = 0
+    def __getitem__(self, n):
+        i = int(self.base_idx[n])
+        detail = self._cache.get(i)
+        if detail is None:
+            detail = self._cache[i] = recipe_detail(self.base, i)
+        return detail
 
-    # H1：主食・主菜は=1 / 他は<=1
-    H1 = 0
-    for r in range(M):
-        for c in REQ_CATS:
-            idxs = cat_to_idxs[c]
-            Sx = sum([x[i, r] for i in idxs])
-            H1 += (Sx - 1) ** 2
-        for c in OPT_CATS:
-            idxs = cat_to_idxs[c]
-            Sx = sum([x[i, r] for i in idxs])
-            H1 += Sx * (Sx - 1)  # <=1
-    H += float(W["H1"]) * H1
+    def take(self, idx) -> "LazyRecipeDetails":
+        return LazyRecipeDetails(self.base, self.base_idx[np.asarray(idx)], self._cache)
 
-    # H2：栄養（各日）
-    H2 = 0
-    for r in range(M):
-        for k_idx, key in enumerate(NUT_KEYS):
-            coef = nut[:, k_idx]
-            Sx = sum([float(coef[i]) * x[i, r] for i in range(N)])
-            H2 += (Sx - float(TARGET[key])) ** 2
-    H += float(W["H2"]) * H2
 
-    # H3：M日合計コスト
-    total_cost_expr = sum([float(recipe_cost[i]) * x[i, r] for r in range(M) for i in range(N)])
-    H3 = (total_cost_expr - float(TARGET["cost"])) ** 2
-    H += float(W["H3"]) * H3
+class RecipeCatalog:
+    """
+    前処理済みのレシピカタログ
 
-    # H4：同一レシピ重複抑制（期間）
-    H4 = 0
-    for i in range(N):
-        Sx = sum([x[i, r] for r in range(M)])
-        H4 += Sx * (Sx - 1)
-    H += float(W["H4"]) * H4
+    価格表・レシピ配列（cats, genres, nut, recipe_cost, X）・
+    上位近傍リストとその類似度をまとめて保持する。リクエスト間で共有するので読み取り専用として扱う。
+    """
 
-    # H5：同日ジャンル制御（practical推奨：同ジャンルを罰→多様化）
-    H5 = 0
-    if H5_MODE == "paper":
-        pairs = [(i, j) for i in range(N) for j in range(i + 1, N) if genres[i] != genres[j]]
-    elif H5_MODE == "practical":
-        pairs = [(i, j) for i in range(N) for j in range(i + 1, N) if genres[i] == genres[j]]
-    else:
-        raise ValueError("H5_MODE must be 'paper' or 'practical'.")
+    def __init__(self, recipes_raw, cost_raw, *, topk_sim: int = TOPK_SIM, version: str = "", timings: dict = None):
+        """timings を渡すと各段階（build_price_table / preprocess / build_similarity / recipe_details）の秒数を書き込む"""
+        self.version = version
+        self.topk_sim = topk_sim
+        self.built_at = datetime.now()
+        if timings is None:
+            timings = {}
 
-    for r in range(M):
-        for (i, j) in pairs:
-            H5 += x[i, r] * x[j, r]
-    H += float(W["H5"]) * H5
+        t0 = time.perf_counter()
+        self.price_per_g, self.median_price = build_price_table(cost_raw)
+        timings["build_price_table"] = round(time.perf_counter() - t0, 4)
 
-    # H7：隣接日多様性（g + sim）
-    H7 = 0
-    for r in range(M):
-        for rp in range(M):
-            if d[r, rp] != 1:
-                continue
-            for i in range(N):
-                for ip in top_neighbors[i]:
-                    coef = float(g[i, ip]) + float(sim[i, ip])
-                    if coef != 0.0:
-                        H7 += coef * x[i, r] * x[ip, rp]
-    H += float(W["H7"]) * H7
+        t0 = time.perf_counter()
+        (
+            self.recipes, self.df, self.cats, self.genres,
+            self.nut, self.recipe_cost, self.X, self.NUT_KEYS,
+        ) = preprocess(recipes_raw, self.price_per_g, self.median_price)
+        self.N = len(self.recipes)
+        # X の列に対応する食材ID（preprocess の食材語彙と同じ並び）
+        self.food_ids = np.array(sorted({
+            int(ing["id"]) for r in self.recipes for ing in r.get("ingredients", []) if ing.get("id") is not None
+        }), dtype=np.int64)
+        timings["preprocess"] = round(time.perf_counter() - t0, 4)
+        # recipe_id → index（保存済み献立の復元用）
+        self.recipe_index = {rid: i for i, rid in enumerate(self.df["recipe_id"])}
 
-    # solve
-    client = AmplifyAEClient()
-    client.token = amplify_token
-    # client.parameters.timeout = 10000
-    result = solve(H, client)
-    best = result.best
-    vals = best.values
+        # カテゴリindex集合
+        cat_to_idxs = {c: np.where(self.cats == c)[0].tolist() for c in sorted(set(self.cats))}
+        for c in REQ_CATS + OPT_CATS:
+            if len(cat_to_idxs.get(c, [])) == 0:
+                raise ValueError(f"category {c} has no recipes. CATEGORY_NAME/REQ_CATS/OPT_CATS mapping mismatch.")
 
-    # decode
-    idx_to_recipe = {i: recipes[i] for i in range(N)}
+        t0 = time.perf_counter()
+        self.top_neighbors, self.top_sim = build_similarity(self.X, topk_sim)
+        timings["build_similarity"] = round(time.perf_counter() - t0, 4)
 
-    def get_recipe_detail(i: int):
-        r = idx_to_recipe[i]
-        # フロントに返す詳細（必要なものだけ）
-        return {
-            "idx": int(i),
-            "id": r.get("id", i),
-            "title": r.get("title", f"recipe_{i}"),
-            "category": int(r.get("category", -1)),
-            "category_name": CATEGORY_NAME.get(int(r.get("category", -1)), str(r.get("category", -1))),
-            "genre": int(r.get("genre", -1)),
-            "nutritions": r.get("nutritions", {}) or {},
-            "ingredients": [
-                {
-                    "food_id": int(ing.get("id")) if ing.get("id") is not None else None,
-                    "amount_g": float(ing.get("amount")) if ing.get("amount") is not None else None,
-                    "name": (ing.get("food") or {}).get("name") if isinstance(ing.get("food"), dict) else ing.get("name"),
-                    "unit_cost": float(price_per_g.get(int(ing.get("id")), median_price)) if ing.get("id") is not None else None,
-                    "cost": (
-                        float(ing.get("amount")) * float(price_per_g.get(int(ing.get("id")), median_price))
-                        if (ing.get("id") is not None and ing.get("amount") is not None)
-                        else None
-                    ),
-                }
-                for ing in (r.get("ingredients", []) or [])
-            ],
-            "recipe_cost": float(recipe_cost[i]),
-        }
+        # 献立の展開用：チェック対象カテゴリの one-hot（C×N）と、レシピごとのフロント向け詳細。
+        # 詳細は価格表込みでカタログごとに1回だけ作り、レスポンス間で共有する（書き換えないこと）
+        self.check_cats = REQ_CATS + OPT_CATS
+        self.cat_onehot = (self.cats[None, :] == np.array(self.check_cats)[:, None]).astype(float)
+        t0 = time.perf_counter()
+        self.recipe_details = [recipe_detail(self, i) for i in range(self.N)]
+        timings["recipe_details"] = round(time.perf_counter() - t0, 4)
 
-    days = []
-    daily_totals = []
+        # 提供可能月（is_month：1〜12月の 0/1。無ければ通年）
+        self.is_month = np.array([recipe_months(r) for r in self.recipes], dtype=bool).reshape(self.N, 12)
 
-    # カテゴリ別カウント（チェック用）
-    checks = {"per_day_category_counts": []}
+        # subset で作った候補の絞り込みなら、元カタログでの index
+        self.parent_idx = np.arange(self.N)
+        self.source = "json"
 
-    for r in range(M):
-        chosen = [i for i in range(N) if vals[x[i, r]] == 1]
-        details = [get_recipe_detail(i) for i in chosen]
+    def subset(self, idx) -> "RecipeCatalog":
+        """
+        idx のレシピだけを候補にしたカタログを返す（前処理はやり直さず配列を切り出す）
 
-        # 日別集計（選ばれた分だけ合計）
-        tot = {"cost": 0.0}
-        for key in NUT_KEYS:
-            tot[key] = 0.0
+        上位近傍は候補内の index に付け替え、候補から外れた近傍は -1（類似度 0）にする。
+        recipe_details は元カタログのもの（"idx" は元カタログの index）を共有する。
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        sub = copy.copy(self)
+        sub.N = len(idx)
+        sub.parent_idx = self.parent_idx[idx]
+        if isinstance(self.recipes, SnapshotRecipes):
+            sub.recipes = self.recipes.take(idx)
+        else:
+            sub.recipes = [self.recipes[i] for i in idx]
+        sub.df = {k: (v[idx] if isinstance(v, np.ndarray) else [v[i] for i in idx]) for k, v in self.df.items()}
+        sub.cats = self.cats[idx]
+        sub.genres = self.genres[idx]
+        sub.nut = self.nut[idx]
+        sub.recipe_cost = self.recipe_cost[idx]
+        sub.X = self.X[idx]
+        sub.is_month = self.is_month[idx]
+        sub.cat_onehot = self.cat_onehot[:, idx]
+        if isinstance(self.recipe_details, LazyRecipeDetails):
+            sub.recipe_details = self.recipe_details.take(idx)
+        else:
+            sub.recipe_details = [self.recipe_details[i] for i in idx]
+        sub.recipe_index = {rid: n for n, rid in enumerate(sub.df["recipe_id"])}
 
-        for drec in details:
-            tot["cost"] += float(drec["recipe_cost"])
-            nutr = drec.get("nutritions", {}) or {}
-            for key in NUT_KEYS:
-                tot[key] += float(nutr.get(key, 0.0) or 0.0)
+        remap = np.full(self.N, -1, dtype=np.int64)
+        remap[idx] = np.arange(len(idx))
+        neighbors = self.top_neighbors[idx]
+        sub.top_neighbors = np.where(neighbors >= 0, remap[np.maximum(neighbors, 0)], -1)
+        sub.top_sim = np.where(sub.top_neighbors >= 0, self.top_sim[idx], 0.0).astype(np.float32)
+        return sub
 
-        # チェック：カテゴリごとに何個選ばれてるか
-        cnt = {}
-        for c in (REQ_CATS + OPT_CATS):
-            cnt[CATEGORY_NAME.get(c, str(c))] = sum(1 for drec in details if drec["category"] == c)
+    def price_vector(self, price_per_g: dict, median_price: float) -> np.ndarray:
+        """X の列（食材）ごとのグラム単価。価格表に無い食材は median_price"""
+        return np.array([price_per_g.get(int(fid), median_price) for fid in self.food_ids], dtype=float)
 
-        checks["per_day_category_counts"].append({"day": r + 1, "counts": cnt})
+    def with_prices(self, price_per_g: dict, median_price: float, *, recipe_cost: np.ndarray = None,
+                    version: str = None) -> "RecipeCatalog":
+        """
+        価格表だけを差し替えたカタログを返す（学校ごとの単価用）
 
-        days.append({"day": r + 1, "recipes": details})
-        daily_totals.append({"day": r + 1, "totals": tot})
+        X・類似度・上位近傍・栄養は共有し、recipe_cost（= X · 単価）だけを作り直す。
+        レシピ詳細は参照されたときに新しい単価で作る（LazyRecipeDetails）。
+        recipe_cost を渡せばそれを使う（複数校分をまとめて計算した場合）。
+        """
+        if recipe_cost is None:
+            recipe_cost = self.X @ self.price_vector(price_per_g, median_price)
+        sub = copy.copy(self)
+        sub.price_per_g = price_per_g
+        sub.median_price = median_price
+        sub.recipe_cost = np.asarray(recipe_cost, dtype=float)
+        sub.df = dict(self.df, cost=sub.recipe_cost)
+        sub.recipe_details = LazyRecipeDetails(sub)
+        sub._base_version = self.base_version
+        if version is not None:
+            sub.version = version
+        return sub
 
-    total_cost_value = sum(x["totals"]["cost"] for x in daily_totals)
+    @property
+    def base_version(self) -> str:
+        """単価を差し替える前のカタログのバージョン（with_prices で作ったカタログでも元のもの）"""
+        return self.__dict__.get("_base_version", self.version)
 
-    response = {
-        "meta": {
-            "M": M,
-            "N_candidates": N,
-            "target": TARGET,
-            "weights": W,
-            "h5_mode": H5_MODE,
-            "topk_sim": topk_sim,
-        },
-        "plan": {
-            "days": days,
-            "daily_totals": daily_totals,
-            "total_cost": float(total_cost_value),
-        },
-        "checks": checks,
-    }
+    def info(self) -> dict:
+        return {
+            "version": self.version,
+            "N_candidates": self.N,
+            "topk_sim": self.topk_sim,
+            "built_at": self.built_at.isoformat(),
+            "source": self.source,
+        }
 
-    return response
+    @classmethod
+    def from_snapshot(cls, path, manifest: dict) -> "RecipeCatalog":
+        """
+        スナップショットの配列を mmap して組み立てる（前処理・類似度計算はしない）
 
-# ---- CORS設定 ----
-CORS_ORIGIN = "*"  # 特定ドメインに絞るなら "https://example.com"
+        配列は読み取り専用で、同じファイルを開いたプロセス間でページを共有する。
+        レシピの dict と詳細は参照されたものだけ作る（SnapshotRecipes / LazyRecipeDetails）。
+        """
+        path = Path(path)
 
-def _add_cors_headers(resp):
-    resp.headers["Access-Control-Allow-Origin"] = CORS_ORIGIN
-    resp.headers["Vary"] = "Origin"  # 将来 origin を絞る可能性があるなら有益
-    resp.headers["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    resp.headers["Access-Control-Max-Age"] = "3600"
-    return resp
+        def _load(name):
+            return np.load(path / f"{name}.npy", mmap_mode="r")
 
-@app.route("/optimize", methods=["POST", "OPTIONS"])
-def optimize_kondate():
-    # --- Preflight ---
-    if request.method == "OPTIONS":
-        resp = make_response("", 204)
-        return _add_cors_headers(resp)
-    # --- request body例 ---
-    # {
-    #   "M": 5,
-    #   "cost": 1500.0,
-    #   "school_id": "school_001",
-    #   "target_year_month": "2026-03-01",
-    #   "save_to_db": true
-    # }
-    body = request.get_json(silent=True) or {}
+        self = cls.__new__(cls)
+        self.version = manifest["version"]
+        self.topk_sim = int(manifest["topk_sim"])
+        self.built_at = datetime.fromisoformat(manifest["built_at"])
+        self.NUT_KEYS = list(manifest["nut_keys"])
+        self.source = "snapshot"
 
-    M = int(body.get("M", 5))
-    topk_sim = 12
-    h5_mode = "practical"
+        self.price_per_g = dict(zip(_load("price_food_ids").tolist(), _load("price_values").tolist()))
+        self.median_price = float(manifest["median_price"])
 
-    TARGET = {
-        "エネルギー": 650.0,
-        "たんぱく質": 20.0,
+        strings = StringTable(_load("strings"), _load("string_offsets"))
+        self.cats = _load("cats")
+        self.genres = _load("genres")
+        self.nut = _load("nut")
+        self.recipe_cost = _load("recipe_cost")
+        self.is_month = _load("is_month")
+        self.food_ids = _load("food_ids")
+        self.N = len(self.cats)
+        self.X = sparse.csr_matrix(
+            (_load("X_data"), _load("X_indices"), _load("X_indptr")),
+            shape=(self.N, len(self.food_ids)), copy=False,
+        )
+        self.top_neighbors = _load("top_neighbors")
+        self.top_sim = _load("top_sim")
+
+        if manifest["recipe_id_type"] == "int":
+            recipe_ids = _load("recipe_ids").tolist()
+        else:
+            recipe_ids = [strings[k] for k in _load("recipe_ids").tolist()]
+        self.recipes = SnapshotRecipes(self, strings, {
+            name: _load(name) for name in ("title_ref", "ing_ptr", "ing_food_id", "ing_amount", "ing_name_ref")
+        }, recipe_ids)
+        titles = strings.column(_load("title_ref"))
+        self.df = {
+            "idx": np.arange(self.N),
+            "recipe_id": recipe_ids,
+            "title": titles,
+            "category": self.cats,
+            "category_name": [CATEGORY_NAME.get(int(c), str(c)) for c in self.cats],
+            "genre": self.genres,
+            "cost": self.recipe_cost,
+            **{key: self.nut[:, k] for k, key in enumerate(self.NUT_KEYS)},
+        }
+        self.recipe_index = {rid: i for i, rid in enumerate(recipe_ids)}
+
+        self.check_cats = REQ_CATS + OPT_CATS
+        self.cat_onehot = (self.cats[None, :] == np.array(self.check_cats)[:, None]).astype(float)
+        self.recipe_details = LazyRecipeDetails(self)
+        self.parent_idx = np.arange(self.N)
+        return self
+
+
+# ============
+# カタログの差分更新（レシピの追加・変更・無効化と食材単価の変更）
+# ============
+CATALOG_INCREMENTAL_MAX_RECIPES = int(os.getenv("CATALOG_INCREMENTAL_MAX_RECIPES", "100"))
+
+
+def recipe_key(r: dict, NUT_KEYS: list) -> tuple:
+    """カタログに効く項目（表示名・カテゴリ・ジャンル・栄養・提供可能月・食材）を比較用に正規化したもの"""
+    nutr = r.get("nutritions", {}) or {}
+    return (
+        r.get("title"),
+        int(r.get("category", -1)),
+        int(r.get("genre", -1)),
+        tuple(float(nutr.get(key, 0.0) or 0.0) for key in NUT_KEYS),
+        tuple(bool(v) for v in recipe_months(r)),
+        tuple(
+            (
+                None if ing.get("id") is None else int(ing["id"]),
+                None if ing.get("amount") is None else float(ing["amount"]),
+                ing.get("name"),
+            )
+            for ing in r.get("ingredients", []) or []
+        ),
+    )
+
+
+def catalog_recipe_key(catalog: "RecipeCatalog", i: int) -> tuple:
+    """カタログのレシピ i の recipe_key（スナップショットのレシピ dict には is_month が無いので配列から作る）"""
+    r = dict(catalog.recipes[i], is_month=[int(v) for v in catalog.is_month[i]])
+    return recipe_key(r, catalog.NUT_KEYS)
+
+
+class CatalogEditor:
+    """
+    カタログを差分で更新する（レシピの upsert・無効化と食材単価の変更）
+
+    1件の変更で preprocess と build_similarity（N×N）をやり直さず、
+    X の該当行・そのレシピの類似度の行と列・それを近傍に持つレシピの近傍リスト・
+    変わった食材を使うレシピの recipe_cost だけを更新する。
+    食材を使うレシピは X を列方向に持ち替えた転置索引（food_id → レシピ）で引く。
+    元のカタログは共有中なので書き換えず、配列をコピーして更新し、commit() で新しいカタログを返す。
+    """
+
+    def __init__(self, catalog: "RecipeCatalog"):
+        if not np.array_equal(catalog.parent_idx, np.arange(len(catalog.parent_idx))):
+            raise ValueError("subset した候補のカタログは更新できない")
+        self.base = catalog
+        self.NUT_KEYS = catalog.NUT_KEYS
+        self.topk_sim = catalog.topk_sim
+        self.price_per_g = dict(catalog.price_per_g)
+        self.median_price = catalog.median_price
+
+        N = catalog.N
+        self.recipes = [catalog.recipes[i] for i in range(N)]
+        self.recipe_ids = list(catalog.df["recipe_id"])
+        self.titles = [catalog.df["title"][i] for i in range(N)]
+        self.cats = np.array(catalog.cats, dtype=int)
+        self.genres = np.array(catalog.genres, dtype=int)
+        self.nut = np.array(catalog.nut, dtype=float)
+        self.recipe_cost = np.array(catalog.recipe_cost, dtype=float)
+        self.is_month = np.array(catalog.is_month, dtype=bool)
+        self.food_ids = np.array(catalog.food_ids, dtype=np.int64)
+        self.X = sparse.csr_matrix(catalog.X, dtype=float, copy=True)
+        self.norms = row_norms(self.X)
+        self.top_neighbors = np.array(catalog.top_neighbors, dtype=np.int64)
+        self.top_sim = np.array(catalog.top_sim, dtype=np.float32)
+
+        self.index = {rid: i for i, rid in enumerate(self.recipe_ids)}
+        self.dirty = set()          # 詳細を作り直す recipe_id
+        self.rebuild_similarity = False
+        self._food_index = None
+
+    @property
+    def N(self) -> int:
+        return len(self.recipe_ids)
+
+    # ---- 転置索引 ----
+    def recipes_using(self, food_ids) -> np.ndarray:
+        """食材（food_id）を使うレシピの index"""
+        return self._recipes_using_columns(np.nonzero(np.isin(self.food_ids, list(food_ids)))[0])
+
+    def _recipes_using_columns(self, cols) -> np.ndarray:
+        if self._food_index is None:
+            self._food_index = self.X.tocsc()
+        idx = self._food_index
+        if len(cols) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate([idx.indices[idx.indptr[j]:idx.indptr[j + 1]] for j in cols]))
+
+    # ---- X の行 ----
+    def _food_columns(self, food_ids) -> np.ndarray:
+        """food_id の列 index。語彙に無い食材は並び順（昇順）を保って列を差し込む"""
+        food_ids = np.asarray(food_ids, dtype=np.int64)
+        new = np.setdiff1d(food_ids, self.food_ids)
+        if len(new):
+            merged = np.union1d(self.food_ids, new)
+            remap = np.searchsorted(merged, self.food_ids)
+            self.X = sparse.csr_matrix(
+                (self.X.data, remap[self.X.indices], self.X.indptr), shape=(self.N, len(merged))
+            )
+            self.food_ids = merged
+            self._food_index = None
+        return np.searchsorted(self.food_ids, food_ids)
+
+    def _row_vector(self, r: dict, foods: list):
+        ing_ids = [int(ing["id"]) for ing in r.get("ingredients", []) or [] if ing.get("id") is not None]
+        self._food_columns(ing_ids)
+        if not foods:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=float)
+        cols = self._food_columns([fid for fid, _ in foods])
+        # 同じ食材が複数行ある場合は合算する（preprocess の CSR 変換と同じ）
+        cols, inv = np.unique(cols, return_inverse=True)
+        vals = np.bincount(inv, weights=[amt for _, amt in foods])
+        return cols.astype(np.int32), vals
+
+    def _splice_row(self, i: int, cols, vals, *, insert: bool = False, delete: bool = False):
+        """X の行 i を差し替える（insert なら i に行を足し、delete なら行 i を消す）。O(nnz) の配列連結だけで済ませる"""
+        X = self.X
+        start = X.indptr[i] if i < X.shape[0] else X.indptr[-1]
+        end = start if insert else X.indptr[i + 1]
+        cols = np.zeros(0, dtype=np.int32) if delete else cols
+        vals = np.zeros(0, dtype=float) if delete else vals
+        data = np.concatenate([X.data[:start], vals, X.data[end:]])
+        indices = np.concatenate([X.indices[:start], cols, X.indices[end:]]).astype(np.int32)
+        counts = np.diff(X.indptr)
+        if insert:
+            counts = np.insert(counts, i, len(vals))
+        elif delete:
+            counts = np.delete(counts, i)
+        else:
+            counts[i] = len(vals)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        self.X = sparse.csr_matrix((data, indices, indptr), shape=(len(counts), X.shape[1]))
+        self._food_index = None
+
+    # ---- 類似度 ----
+    def _k(self) -> int:
+        return min(self.topk_sim, self.N - 1)
+
+    def _similarities(self, i: int) -> np.ndarray:
+        """レシピ i と全レシピのコサイン類似度（疎行列 × 疎ベクトル1回）。自分自身は -inf"""
+        s = (self.X @ self.X[i].T).toarray().ravel() / (self.norms * self.norms[i])
+        s = s.astype(np.float32)
+        s[i] = -np.inf
+        return s
+
+    def _recompute_rows(self, rows):
+        """近傍リストを作り直す（参照していたレシピが落ちた・類似度が下がった行だけ）"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0 or self.rebuild_similarity:
+            return
+        k = self.top_neighbors.shape[1]
+        block = max(1, SIM_BLOCK_ELEMS // self.N)
+        XT = self.X.T.tocsc()
+        for start in range(0, len(rows), block):
+            part = rows[start:start + block]
+            S = (self.X[part] @ XT).toarray() / (self.norms[part][:, None] * self.norms[None, :])
+            S = S.astype(np.float32)
+            S[np.arange(len(part)), part] = -np.inf
+            self.top_neighbors[part], self.top_sim[part] = top_k_rows(S, k)
+
+    def _resort_rows(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        order = np.argsort(-self.top_sim[rows], axis=1, kind="stable")
+        self.top_neighbors[rows] = np.take_along_axis(self.top_neighbors[rows], order, axis=1)
+        self.top_sim[rows] = np.take_along_axis(self.top_sim[rows], order, axis=1)
+
+    def _update_similarity(self, i: int):
+        """レシピ i の行（自分の近傍）と列（他のレシピの近傍リストでの i）を更新する"""
+        if self.rebuild_similarity:
+            return
+        if self.top_neighbors.shape[1] != self._k():
+            # レシピ数が topk_sim 前後のときは近傍数が変わるので全体を作り直す
+            self.rebuild_similarity = True
+            return
+        k = self.top_neighbors.shape[1]
+        if k <= 0:
+            return
+        s = self._similarities(i)
+        nb, sim = self.top_neighbors, self.top_sim
+        own_nb, own_sim = top_k_rows(s[None, :], k)
+        nb[i], sim[i] = own_nb[0], own_sim[0]
+
+        # i を近傍に持つ行：類似度が上がった（同じ）なら値を差し替えるだけ、
+        # 下がったら上位 k から落ちて k+1 番目が入るかもしれないので作り直す
+        has_i = nb == i
+        has_i[i] = False
+        ref_rows = np.nonzero(has_i.any(axis=1))[0]
+        ref_cols = has_i[ref_rows].argmax(axis=1)
+        keep = s[ref_rows] >= sim[ref_rows, ref_cols]
+        sim[ref_rows[keep], ref_cols[keep]] = s[ref_rows[keep]]
+
+        # i を近傍に持たない行：k 番目より似ていれば末尾と入れ替える
+        others = ~has_i.any(axis=1)
+        others[i] = False
+        ins = np.nonzero(others & (s > sim[:, -1]))[0]
+        nb[ins, -1] = i
+        sim[ins, -1] = s[ins]
+
+        self._resort_rows(np.concatenate([ref_rows[keep], ins]))
+        self._recompute_rows(ref_rows[~keep])
+
+    # ---- 操作 ----
+    def upsert_recipe(self, r: dict) -> str:
+        """
+        レシピを追加・変更する（active が 1 でなければ無効化）
+
+        Returns: "added" / "updated" / "unchanged" / "deactivated"
+        """
+        rid = r.get("id")
+        if rid is None:
+            raise ValueError("recipe id is required")
+        if int(r.get("active", 1)) != 1:
+            return "deactivated" if self.deactivate_recipe(rid) else "unchanged"
+
+        i = self.index.get(rid)
+        if i is not None and recipe_key(r, self.NUT_KEYS) == recipe_key(self._recipe_with_months(i), self.NUT_KEYS):
+            return "unchanged"
+
+        cat, genre, nut_row, cost, foods = recipe_row(r, self.NUT_KEYS, self.price_per_g, self.median_price)
+        cols, vals = self._row_vector(r, foods)
+        months = recipe_months(r)
+        title = r.get("title", f"recipe_{self.N if i is None else i}")
+
+        if i is None:
+            status = "added"
+            i = self.N
+            self.recipes.append(r)
+            self.recipe_ids.append(rid)
+            self.titles.append(title)
+            self.index[rid] = i
+            self.cats = np.append(self.cats, cat)
+            self.genres = np.append(self.genres, genre)
+            self.nut = np.vstack([self.nut, nut_row])
+            self.recipe_cost = np.append(self.recipe_cost, cost)
+            self.is_month = np.vstack([self.is_month, months])
+            self._splice_row(i, cols, vals, insert=True)
+            self.norms = np.append(self.norms, 0.0)
+            self.top_neighbors = np.vstack([self.top_neighbors, np.full((1, self.top_neighbors.shape[1]), -1)])
+            self.top_sim = np.vstack([self.top_sim, np.zeros((1, self.top_sim.shape[1]), dtype=np.float32)])
+            x_changed = True
+        else:
+            status = "updated"
+            old = self.X[i]
+            x_changed = not (np.array_equal(old.indices, cols) and np.array_equal(old.data, vals))
+            self.recipes[i] = r
+            self.titles[i] = title
+            self.cats[i], self.genres[i], self.nut[i], self.recipe_cost[i] = cat, genre, nut_row, cost
+            self.is_month[i] = months
+            if x_changed:
+                self._splice_row(i, cols, vals)
+
+        self.dirty.add(rid)
+        if x_changed:
+            self.norms[i] = np.sqrt(np.sum(vals ** 2)) + 1e-9
+            self._update_similarity(i)
+        return status
+
+    def deactivate_recipe(self, recipe_id) -> bool:
+        """レシピを候補から外す。Returns: 外したか（カタログに無ければ False）"""
+        i = self.index.get(recipe_id)
+        if i is None:
+            return False
+
+        ref_rows = np.nonzero((self.top_neighbors == i).any(axis=1))[0]
+        ref_rows = ref_rows - (ref_rows > i)  # 行 i を消した後の index
+        keep = np.arange(self.N) != i
+        del self.recipes[i], self.recipe_ids[i], self.titles[i]
+        self.cats, self.genres = self.cats[keep], self.genres[keep]
+        self.nut, self.recipe_cost, self.is_month = self.nut[keep], self.recipe_cost[keep], self.is_month[keep]
+        self.norms = self.norms[keep]
+        self._splice_row(i, None, None, delete=True)
+        self.top_neighbors = self.top_neighbors[keep]
+        self.top_sim = self.top_sim[keep]
+        self.top_neighbors[self.top_neighbors > i] -= 1
+        self.index = {rid: n for n, rid in enumerate(self.recipe_ids)}
+        self.dirty.discard(recipe_id)
+
+        if self.top_neighbors.shape[1] != self._k():
+            self.rebuild_similarity = True
+        else:
+            self._recompute_rows(ref_rows)
+        return True
+
+    def update_food_prices(self, prices: dict):
+        """
+        食材のグラム単価を変える（None なら価格表から外して median_price 扱いにする）
+
+        中央値が変われば価格表に無い食材の単価も変わる。単価が変わった食材を使うレシピだけ recipe_cost を計算し直す。
+        """
+        table = dict(self.price_per_g)
+        for fid, price in prices.items():
+            if price is None:
+                table.pop(int(fid), None)
+            else:
+                table[int(fid)] = float(price)
+        if not table:
+            raise ValueError("price_per_g is empty (cost JSON invalid).")
+        median_price = float(np.median(list(table.values())))
+
+        old = np.array([self.price_per_g.get(int(f), self.median_price) for f in self.food_ids], dtype=float)
+        new = np.array([table.get(int(f), median_price) for f in self.food_ids], dtype=float)
+        self.price_per_g, self.median_price = table, median_price
+
+        rows = self._recipes_using_columns(np.nonzero(old != new)[0])
+        if len(rows):
+            self.recipe_cost[rows] = self.X[rows] @ new
+            self.dirty.update(self.recipe_ids[n] for n in rows)
+        return rows
+
+    def reorder(self, recipe_ids: list):
+        """レシピの並びを recipe_ids の順にする（JSON から作り直した場合と同じ index にそろえる）"""
+        if recipe_ids == self.recipe_ids:
+            return
+        if len(recipe_ids) != self.N or set(recipe_ids) != set(self.index):
+            raise ValueError("reorder needs every recipe id exactly once")
+        perm = np.array([self.index[rid] for rid in recipe_ids], dtype=np.int64)
+        inv = np.empty(self.N, dtype=np.int64)
+        inv[perm] = np.arange(self.N)
+        self.recipes = [self.recipes[n] for n in perm]
+        self.recipe_ids = list(recipe_ids)
+        self.titles = [self.titles[n] for n in perm]
+        self.cats, self.genres, self.nut = self.cats[perm], self.genres[perm], self.nut[perm]
+        self.recipe_cost, self.is_month, self.norms = self.recipe_cost[perm], self.is_month[perm], self.norms[perm]
+        self.X = self.X[perm]
+        self._food_index = None
+        neighbors = self.top_neighbors[perm]
+        self.top_neighbors = np.where(neighbors >= 0, inv[np.maximum(neighbors, 0)], -1)
+        self.top_sim = self.top_sim[perm]
+        self.index = {rid: n for n, rid in enumerate(self.recipe_ids)}
+
+    def _recipe_with_months(self, i: int) -> dict:
+        return dict(self.recipes[i], is_month=[int(v) for v in self.is_month[i]])
+
+    def commit(self, version: str = None) -> "RecipeCatalog":
+        """更新後のカタログを返す（元のカタログはそのまま）"""
+        N = self.N
+        for c in REQ_CATS + OPT_CATS:
+            if not np.any(self.cats == c):
+                raise ValueError(f"category {c} has no recipes. CATEGORY_NAME/REQ_CATS/OPT_CATS mapping mismatch.")
+
+        # どのレシピにも使われなくなった食材は語彙から外す（JSON から作り直した場合と同じ列にそろえる）
+        vocab = np.array(sorted({
+            int(ing["id"]) for r in self.recipes for ing in r.get("ingredients", []) or [] if ing.get("id") is not None
+        }), dtype=np.int64)
+        if not np.array_equal(vocab, self.food_ids):
+            keep = np.isin(self.food_ids, vocab)
+            remap = np.cumsum(keep) - 1
+            X = self.X.tocoo()
+            self.X = sparse.csr_matrix((X.data, (X.row, remap[X.col])), shape=(N, len(vocab)))
+            self.food_ids = vocab
+
+        if self.rebuild_similarity:
+            self.top_neighbors, self.top_sim = build_similarity(self.X, self.topk_sim)
+
+        base = self.base
+        cat = copy.copy(base)
+        cat.version = base.version if version is None else version
+        cat.built_at = datetime.now()
+        cat.source = "incremental"
+        cat.price_per_g, cat.median_price = self.price_per_g, self.median_price
+        cat.recipes = self.recipes
+        cat.N = N
+        cat.cats, cat.genres, cat.nut = self.cats, self.genres, self.nut
+        cat.recipe_cost, cat.is_month = self.recipe_cost, self.is_month
+        cat.X, cat.food_ids = self.X, self.food_ids
+        cat.top_neighbors, cat.top_sim = self.top_neighbors, self.top_sim
+        cat.df = {
+            "idx": np.arange(N),
+            "recipe_id": self.recipe_ids,
+            "title": self.titles,
+            "category": cat.cats,
+            "category_name": [CATEGORY_NAME.get(int(c), str(c)) for c in cat.cats],
+            "genre": cat.genres,
+            "cost": cat.recipe_cost,
+            **{key: cat.nut[:, k] for k, key in enumerate(self.NUT_KEYS)},
+        }
+        cat.recipe_index = dict(self.index)
+        cat.cat_onehot = (cat.cats[None, :] == np.array(cat.check_cats)[:, None]).astype(float)
+        cat.parent_idx = np.arange(N)
+
+        if isinstance(base.recipe_details, list):
+            # 未変更のレシピは作り置きの詳細を使う（index がずれたものは "idx" だけ差し替える）
+            details = []
+            for i, rid in enumerate(self.recipe_ids):
+                j = base.recipe_index.get(rid)
+                if j is None or rid in self.dirty:
+                    details.append(recipe_detail(cat, i))
+                elif j != i:
+                    details.append(dict(base.recipe_details[j], idx=i))
+                else:
+                    details.append(base.recipe_details[j])
+            cat.recipe_details = details
+        else:
+            cat.recipe_details = LazyRecipeDetails(cat)
+        return cat
+
+
+def diff_catalog_sources(catalog: "RecipeCatalog", recipes_raw: list, cost_raw: list):
+    """
+    カタログと新しい JSON の差分（追加・変更したレシピ、外れたレシピ、単価が変わった食材、並び）
+
+    recipe_id が無い・重複しているなど id で突き合わせられないときは None（作り直す）
+    """
+    if not np.array_equal(catalog.parent_idx, np.arange(catalog.N)):
+        return None
+    active = [r for r in recipes_raw if int(r.get("active", 1)) == 1]
+    order = [r.get("id") for r in active]
+    if not active or any(rid is None for rid in order) or len(set(order)) != len(order):
+        return None
+
+    upserts = []
+    for r in active:
+        i = catalog.recipe_index.get(r["id"])
+        if i is None:
+            upserts.append(r)
+        elif r is catalog.recipes[i] or (isinstance(catalog.recipes, list) and r == catalog.recipes[i]):
+            continue  # JSON から作ったカタログなら元の dict と比べれば済む
+        elif recipe_key(r, catalog.NUT_KEYS) != catalog_recipe_key(catalog, i):
+            upserts.append(r)
+    active_ids = set(order)
+    deactivate = [rid for rid in catalog.df["recipe_id"] if rid not in active_ids]
+
+    price_per_g, _ = build_price_table(cost_raw)
+    prices = {fid: p for fid, p in price_per_g.items() if catalog.price_per_g.get(fid) != p}
+    prices.update({fid: None for fid in catalog.price_per_g if fid not in price_per_g})
+    return {"upserts": upserts, "deactivate": deactivate, "prices": prices, "order": order}
+
+
+def apply_catalog_diff(catalog: "RecipeCatalog", diff: dict, *, version: str = None) -> "RecipeCatalog":
+    """diff_catalog_sources の差分をカタログに当てた新しいカタログを返す"""
+    editor = CatalogEditor(catalog)
+    if diff["prices"]:
+        # 先に単価を変えておけば、upsert するレシピの原価も新しい単価で計算される
+        editor.update_food_prices(diff["prices"])
+    for rid in diff["deactivate"]:
+        editor.deactivate_recipe(rid)
+    for r in diff["upserts"]:
+        editor.upsert_recipe(r)
+    editor.reorder(diff["order"])
+    return editor.commit(version)
+
+
+# ============
+# カタログのスナップショット（.npy を mmap して起動時の JSON パース・前処理を省く）
+# ============
+CATALOG_SNAPSHOT_FORMAT_VERSION = 1
+
+
+class StringTable:
+    """UTF-8 を連結したバイト列とオフセットの文字列表（k 番目 = strings[offsets[k]:offsets[k+1]]）"""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        if k < 0:
+            return None
+        return bytes(self.data[self.offsets[k]:self.offsets[k + 1]]).decode("utf-8")
+
+    def column(self, refs: np.ndarray) -> "StringColumn":
+        return StringColumn(self, refs)
+
+    @staticmethod
+    def build(values) -> tuple[np.ndarray, np.ndarray, dict]:
+        """重複を除いた文字列表を作る。Returns: (data, offsets, {文字列: k})"""
+        index = {}
+        chunks = []
+        for v in values:
+            if v is not None and v not in index:
+                index[v] = len(chunks)
+                chunks.append(v.encode("utf-8"))
+        offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(c) for c in chunks])
+        data = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+        return data, offsets, index
+
+
+class StringColumn:
+    """参照番号の列を文字列の列として見せる（df["title"] 用。subset では普通の list になる）"""
+
+    def __init__(self, table: StringTable, refs: np.ndarray):
+        self.table = table
+        self.refs = refs
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __getitem__(self, i):
+        return self.table[int(self.refs[i])]
+
+
+class SnapshotRecipes:
+    """
+    スナップショットから recipe_detail が読む項目だけのレシピ dict を作る列（参照されたときに作る）
+
+    栄養は nut 配列の値（float）になる。
+    """
+
+    def __init__(self, catalog: "RecipeCatalog", strings: StringTable, arrays: dict, recipe_ids: list, idx=None):
+        self.catalog = catalog
+        self.strings = strings
+        self.arrays = arrays
+        self.recipe_ids = recipe_ids
+        self.idx = np.arange(len(recipe_ids)) if idx is None else np.asarray(idx)
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, n):
+        i = int(self.idx[n])
+        a, cat = self.arrays, self.catalog
+        start, end = int(a["ing_ptr"][i]), int(a["ing_ptr"][i + 1])
+        ingredients = []
+        for k in range(start, end):
+            fid, amount = int(a["ing_food_id"][k]), float(a["ing_amount"][k])
+            ingredients.append({
+                "id": None if fid < 0 else fid,
+                "name": self.strings[int(a["ing_name_ref"][k])],
+                "amount": None if np.isnan(amount) else amount,
+            })
+        return {
+            "id": self.recipe_ids[i],
+            "title": self.strings[int(a["title_ref"][i])],
+            "category": int(cat.cats[i]),
+            "genre": int(cat.genres[i]),
+            "nutritions": {key: float(cat.nut[i, k]) for k, key in enumerate(cat.NUT_KEYS)},
+            "ingredients": ingredients,
+        }
+
+    def take(self, idx) -> "SnapshotRecipes":
+        return SnapshotRecipes(self.catalog, self.strings, self.arrays, self.recipe_ids, self.idx[np.asarray(idx)])
+
+
+def catalog_source_digest(recipes_bytes: bytes, cost_bytes: bytes) -> str:
+    """ソースJSONの SHA-256（先頭16文字がカタログのバージョン）"""
+    h = hashlib.sha256()
+    h.update(recipes_bytes)
+    h.update(b"\0")
+    h.update(cost_bytes)
+    return h.hexdigest()
+
+
+def write_catalog_snapshot(catalog: RecipeCatalog, path, source_digest: str) -> dict:
+    """
+    JSON から作ったカタログを path にスナップショットとして書き出す
+
+    一時ディレクトリに書いてから入れ替えるので、読み込み中のプロセスが壊れたファイルを見ることはない。
+    Returns: manifest
+    """
+    path = Path(path)
+    recipes = catalog.recipes
+    N = catalog.N
+
+    strings_src = [r.get("title", f"recipe_{i}") for i, r in enumerate(recipes)]
+    strings_src += [ing.get("name") for r in recipes for ing in r.get("ingredients", []) or []]
+    recipe_id_type = "int" if all(isinstance(rid, int) for rid in catalog.df["recipe_id"]) else "str"
+    if recipe_id_type == "str":
+        strings_src += [str(rid) for rid in catalog.df["recipe_id"]]
+    data, offsets, ref = StringTable.build(strings_src)
+
+    ing_ptr = np.zeros(N + 1, dtype=np.int64)
+    ing_food_id, ing_amount, ing_name_ref = [], [], []
+    for i, r in enumerate(recipes):
+        for ing in r.get("ingredients", []) or []:
+            ing_food_id.append(-1 if ing.get("id") is None else int(ing["id"]))
+            ing_amount.append(np.nan if ing.get("amount") is None else float(ing["amount"]))
+            ing_name_ref.append(ref.get(ing.get("name"), -1))
+        ing_ptr[i + 1] = len(ing_food_id)
+
+    X = catalog.X.tocsr()
+    arrays = {
+        "cats": np.asarray(catalog.cats, dtype=np.int64),
+        "genres": np.asarray(catalog.genres, dtype=np.int64),
+        "nut": np.asarray(catalog.nut, dtype=float),
+        "recipe_cost": np.asarray(catalog.recipe_cost, dtype=float),
+        "is_month": np.asarray(catalog.is_month, dtype=bool),
+        "food_ids": np.asarray(catalog.food_ids, dtype=np.int64),
+        "X_data": X.data.astype(float),
+        "X_indices": X.indices.astype(np.int32),
+        "X_indptr": X.indptr.astype(np.int32),
+        "top_neighbors": np.asarray(catalog.top_neighbors),
+        "top_sim": np.asarray(catalog.top_sim),
+        "price_food_ids": np.array(list(catalog.price_per_g.keys()), dtype=np.int64),
+        "price_values": np.array(list(catalog.price_per_g.values()), dtype=float),
+        "strings": data,
+        "string_offsets": offsets,
+        "title_ref": np.array([ref[t] for t in strings_src[:N]], dtype=np.int32),
+        "ing_ptr": ing_ptr,
+        "ing_food_id": np.array(ing_food_id, dtype=np.int64),
+        "ing_amount": np.array(ing_amount, dtype=float),
+        "ing_name_ref": np.array(ing_name_ref, dtype=np.int32),
+        "recipe_ids": (
+            np.array(catalog.df["recipe_id"], dtype=np.int64) if recipe_id_type == "int"
+            else np.array([ref[str(rid)] for rid in catalog.df["recipe_id"]], dtype=np.int32)
+        ),
+    }
+
+    manifest = {
+        "format_version": CATALOG_SNAPSHOT_FORMAT_VERSION,
+        "version": catalog.version,
+        "source_sha256": source_digest,
+        "built_at": catalog.built_at.isoformat(),
+        "topk_sim": catalog.topk_sim,
+        "nut_keys": catalog.NUT_KEYS,
+        "median_price": catalog.median_price,
+        "recipe_id_type": recipe_id_type,
+        "N": N,
+        "arrays": {},
+    }
+
+    tmp = path.with_name(f".{path.name}.tmp-{os.getpid()}")
+    tmp.mkdir(parents=True, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(tmp / f"{name}.npy", np.ascontiguousarray(arr), allow_pickle=False)
+        manifest["arrays"][name] = {
+            "dtype": str(arr.dtype),
+            "shape": list(arr.shape),
+            "sha256": hashlib.sha256((tmp / f"{name}.npy").read_bytes()).hexdigest(),
+        }
+    (tmp / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    old = path.with_name(f".{path.name}.old-{os.getpid()}")
+    if path.exists():
+        path.rename(old)
+    tmp.rename(path)
+    if old.exists():
+        for f in old.iterdir():
+            f.unlink()
+        old.rmdir()
+    return manifest
+
+
+def read_snapshot_manifest(path):
+    manifest_path = Path(path) / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    return json.loads(manifest_path.read_text(encoding="utf-8"))
+
+
+def verify_catalog_snapshot(path, manifest: dict) -> list[str]:
+    """配列ファイルの SHA-256 を manifest と照合する。Returns: 一致しなかった配列名"""
+    bad = []
+    for name, info in manifest["arrays"].items():
+        f = Path(path) / f"{name}.npy"
+        if not f.exists() or hashlib.sha256(f.read_bytes()).hexdigest() != info["sha256"]:
+            bad.append(name)
+    return bad
+
+
+def load_catalog_snapshot(path, source_digest: str):
+    """
+    ソースJSONと一致するスナップショットがあれば mmap して返す（無い・古い・形式違いなら None）
+    """
+    if not path:
+        return None
+    try:
+        manifest = read_snapshot_manifest(path)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Catalog snapshot manifest unreadable: {str(e)}")
+        return None
+    if manifest is None:
+        return None
+    if manifest.get("format_version") != CATALOG_SNAPSHOT_FORMAT_VERSION:
+        print(f"[WARN] Catalog snapshot format {manifest.get('format_version')} is not supported, building from JSON")
+        return None
+    if manifest.get("source_sha256") != source_digest:
+        print(f"[WARN] Catalog snapshot (version={manifest.get('version')}) does not match the JSON sources, building from JSON")
+        return None
+    if int(manifest.get("topk_sim", -1)) != TOPK_SIM:
+        print(f"[WARN] Catalog snapshot topk_sim={manifest.get('topk_sim')} != {TOPK_SIM}, building from JSON")
+        return None
+    try:
+        return RecipeCatalog.from_snapshot(path, manifest)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[WARN] Catalog snapshot load failed, building from JSON: {str(e)}")
+        return None
+
+
+_catalog_lock = threading.Lock()
+_catalog = None
+_catalog_stamp = None
+
+
+def _catalog_source_stamp():
+    """ソースファイルの (path, mtime, size)。変化がなければハッシュ計算も省略する"""
+    stamp = []
+    for path in (RECIPE_JSON_PATH, COST_JSON_PATH):
+        st = os.stat(path)
+        stamp.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
+
+
+def get_catalog(force_reload: bool = False, timings: dict = None) -> RecipeCatalog:
+    """
+    プロセス内で共有するカタログを返す
+
+    ソースファイルの mtime/サイズが変わった場合は内容のハッシュを比較し、
+    内容が変わっていれば再構築する。force_reload=True なら無条件に再構築する。
+    JSON と一致するスナップショット（CATALOG_SNAPSHOT_PATH）があれば、JSON のパース・前処理をせずに mmap で読む。
+    変わったレシピが CATALOG_INCREMENTAL_MAX_RECIPES 件以下なら、今のカタログに差分だけ当てる（CatalogEditor）。
+    timings を渡すと、この呼び出しで再構築した場合だけ load / preprocess / similarity の秒数を書き込む。
+    """
+    global _catalog, _catalog_stamp
+
+    with _catalog_lock:
+        stamp = _catalog_source_stamp()
+        if _catalog is not None and not force_reload and stamp == _catalog_stamp:
+            return _catalog
+
+        t0 = time.perf_counter()
+        recipes_bytes = Path(RECIPE_JSON_PATH).read_bytes()
+        cost_bytes = Path(COST_JSON_PATH).read_bytes()
+        digest = catalog_source_digest(recipes_bytes, cost_bytes)
+        version = digest[:16]
+
+        if _catalog is not None and not force_reload and version == _catalog.version:
+            # touch されただけ（内容は同じ）
+            _catalog_stamp = stamp
+            return _catalog
+
+        snapshot = load_catalog_snapshot(CATALOG_SNAPSHOT_PATH, digest)
+        if snapshot is not None:
+            print(f"[INFO] Loaded recipe catalog snapshot (version={version}) from {CATALOG_SNAPSHOT_PATH}")
+            _catalog = snapshot
+            _catalog_stamp = stamp
+            if timings is not None:
+                timings["load"] = round(time.perf_counter() - t0, 4)
+            return _catalog
+
+        recipes_raw = json.loads(recipes_bytes.decode("utf-8"))
+        cost_raw = json.loads(cost_bytes.decode("utf-8"))
+        load_time = time.perf_counter() - t0
+
+        if _catalog is not None and not force_reload:
+            # 数件の編集・単価変更なら、変わった行と近傍だけを更新する（N×N の類似度を作り直さない）
+            t1 = time.perf_counter()
+            diff = diff_catalog_sources(_catalog, recipes_raw, cost_raw)
+            if diff is not None and len(diff["upserts"]) + len(diff["deactivate"]) <= CATALOG_INCREMENTAL_MAX_RECIPES:
+                _catalog = apply_catalog_diff(_catalog, diff, version=version)
+                _catalog_stamp = stamp
+                print(
+                    f"[INFO] Updated recipe catalog (version={version}): {len(diff['upserts'])} upserted, "
+                    f"{len(diff['deactivate'])} deactivated, {len(diff['prices'])} prices"
+                )
+                if timings is not None:
+                    timings["load"] = round(load_time, 4)
+                    timings["preprocess"] = round(time.perf_counter() - t1, 4)
+                return _catalog
+
+        print(f"[INFO] Building recipe catalog (version={version})")
+        build_timings = {}
+        _catalog = RecipeCatalog(recipes_raw, cost_raw, topk_sim=TOPK_SIM, version=version, timings=build_timings)
+        _catalog_stamp = stamp
+        if timings is not None:
+            timings["load"] = round(load_time, 4)
+            timings["preprocess"] = round(
+                build_timings["build_price_table"] + build_timings["preprocess"] + build_timings["recipe_details"], 4
+            )
+            timings["similarity"] = build_timings["build_similarity"]
+        return _catalog
+
+
+# ============
+# 学校ごとの単価（food_costs）
+# ============
+# food_costs を (school_id, food_id) の単価表にした移行（docs/migrations/001_food_costs_school_food_key.sql）
+FOOD_COSTS_MIGRATION = "001_food_costs_school_food_key"
+_food_costs_migrated = False
+_food_costs_migration_warned = False
+
+
+def food_costs_migrated(cur) -> bool:
+    """
+    food_costs の移行が済んでいるか（schema_migrations に FOOD_COSTS_MIGRATION の記録がある）
+
+    移行前の food_costs は food_id が自動採番の行 id で、レシピの食材 id ではないので読まない。
+    一度済んでいれば以降は問い合わせない（済んでいなければ呼ばれるたびに確認し直す）。
+    """
+    global _food_costs_migrated, _food_costs_migration_warned
+    if _food_costs_migrated:
+        return True
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (FOOD_COSTS_MIGRATION,))
+        _food_costs_migrated = cur.fetchone() is not None
+    if not _food_costs_migrated and not _food_costs_migration_warned:
+        _food_costs_migration_warned = True
+        print(f"[WARN] food_costs migration {FOOD_COSTS_MIGRATION} is not applied; using shared prices for all schools")
+    return _food_costs_migrated
+
+
+def load_school_prices(school_ids) -> dict[int, dict[int, float]]:
+    """
+    food_costs から学校ごとのグラム単価を読む
+
+    Returns:
+        {school_id: {food_id: price_per_gram}}（行が無い学校・移行前は含まれない）
+    """
+    school_ids = sorted({int(sid) for sid in school_ids})
+    prices = {}
+    if not school_ids:
+        return prices
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if not food_costs_migrated(cur):
+            cur.close()
+            return prices
+        cur.execute("""
+            SELECT school_id, food_id, price_per_gram
+            FROM food_costs
+            WHERE school_id = ANY(%s) AND deleted_at IS NULL
+        """, (school_ids,))
+        for school_id, food_id, price in cur.fetchall():
+            prices.setdefault(int(school_id), {})[int(food_id)] = float(price)
+        cur.close()
+    return prices
+
+
+def load_school_price_watermarks(school_ids) -> dict[int, tuple]:
+    """
+    food_costs の学校ごとのウォーターマーク（最終更新時刻と行数）
+
+    単価の追加・更新・論理削除は updated_at / created_at / deleted_at、物理削除は行数の変化で分かる。
+    Returns:
+        {school_id: (最終更新時刻, 行数)}（行が無い学校・移行前は含まれない）
+    """
+    school_ids = sorted({int(sid) for sid in school_ids})
+    marks = {}
+    if not school_ids:
+        return marks
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if not food_costs_migrated(cur):
+            cur.close()
+            return marks
+        cur.execute("""
+            SELECT school_id, MAX(GREATEST(created_at, updated_at, deleted_at)), COUNT(*)
+            FROM food_costs
+            WHERE school_id = ANY(%s)
+            GROUP BY school_id
+        """, (school_ids,))
+        for school_id, updated_at, count in cur.fetchall():
+            marks[int(school_id)] = (updated_at.isoformat() if updated_at is not None else None, int(count))
+        cur.close()
+    return marks
+
+
+def price_coverage(catalog: RecipeCatalog, school_rows: dict = None) -> dict:
+    """
+    カタログの食材語彙のうち、学校の単価・共通の価格表・中央値（median_price）のどれで値付けしたかの件数
+
+    中央値で代用した食材と、それを使うレシピ（原価が推定になる）の数も返す。
+    """
+    food_ids = np.asarray(catalog.food_ids)
+    in_school = np.isin(food_ids, list(school_rows or {}))
+    in_common = np.isin(food_ids, list(catalog.price_per_g)) & ~in_school
+    fallback = ~(in_school | in_common)
+    recipes = catalog.X[:, np.nonzero(fallback)[0]].getnnz(axis=1) > 0
+    return {
+        "foods": len(food_ids),
+        "school": int(in_school.sum()),
+        "common": int(in_common.sum()),
+        "median_fallback": int(fallback.sum()),
+        "median_fallback_food_ids": food_ids[fallback].tolist(),
+        "recipes_with_fallback": int(recipes.sum()),
+        "median_price": catalog.median_price,
+    }
+
+
+def school_catalogs(catalog: RecipeCatalog, school_prices: dict) -> dict:
+    """
+    学校ごとの単価を反映したカタログを作る（前処理・類似度は catalog のものを共有）
+
+    単価は共通の価格表（reciept-cost.json）に学校の行を上書きしたもの。全校分の recipe_cost を
+    疎行列の積 X · P（P は 食材×学校 の単価行列）1回で求める。学校の行が無ければ catalog をそのまま使う。
+
+    Returns:
+        {school_id: RecipeCatalog}
+    """
+    catalogs = {}
+    overrides = {sid: prices for sid, prices in school_prices.items() if prices}
+    for sid in school_prices:
+        if sid not in overrides:
+            catalogs[sid] = catalog
+    if not overrides:
+        return catalogs
+
+    ids = list(overrides)
+    tables = [{**catalog.price_per_g, **overrides[sid]} for sid in ids]
+    P = np.column_stack([catalog.price_vector(table, catalog.median_price) for table in tables])
+    costs = np.asarray(catalog.X @ P)
+    for n, sid in enumerate(ids):
+        digest = hashlib.sha256(P[:, n].tobytes()).hexdigest()[:8]
+        catalogs[sid] = catalog.with_prices(
+            tables[n], catalog.median_price, recipe_cost=costs[:, n], version=f"{catalog.version}-{digest}",
+        )
+    return catalogs
+
+
+SCHOOL_PRICES_CHECK_SECONDS = float(os.getenv("SCHOOL_PRICES_CHECK_SECONDS", "30"))
+
+
+class SchoolPriceCache:
+    """
+    学校ごとの単価（food_costs）のプロセス内キャッシュ
+
+    学校の行（{food_id: 単価}）と、それをカタログの食材語彙にそろえて recipe_cost を計算し直したカタログを持つ。
+    food_costs の変更は学校ごとのウォーターマーク（最終更新時刻と行数）で検知し、確認は学校ごとに
+    SCHOOL_PRICES_CHECK_SECONDS に1回だけ行う（リクエストごとには food_costs を読まない）。
+    変わった学校だけ行を読み直し、recipe_cost は変わった学校分をまとめて疎行列の積1回で求める。
+    カタログが差し替わった（version が変わった）場合も、行は読み直さず積だけやり直す。
+    """
+
+    def __init__(self, check_seconds: float):
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._rows = {}        # school_id → {food_id: 単価}
+        self._marks = {}       # school_id → ウォーターマーク
+        self._checked_at = {}  # school_id → 最後に確認した時刻（monotonic）
+        self._catalogs = {}    # (catalog.version, school_id) → (RecipeCatalog, coverage)
+        self.checks = 0
+        self.reloads = 0
+        self.failures = 0
+
+    def _refresh(self, school_ids: list):
+        """
+        期限が来た学校のウォーターマークを確認し、変わった学校の行を読み直す
+
+        DB を読む間はロックを持たない（期限の来た学校をロック内で控え、読み終えてからロック内で差し替える）。
+        読めなかったときも確認した時刻を残し、次の確認は check_seconds 後にする（失敗のたびに DB へ問い合わせない）。
+        まだ行を持っていない学校は、その間は RuntimeError にする（呼び出し側で共通の単価に戻す）。
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [sid for sid in school_ids if now - self._checked_at.get(sid, float("-inf")) >= self.check_seconds]
+            known = {sid: self._marks[sid] for sid in due if sid in self._rows}
+            waiting = [sid for sid in school_ids if sid not in due and sid not in self._rows]
+        if waiting:
+            raise RuntimeError(
+                f"food_costs for schools {waiting} could not be read; retrying after {self.check_seconds}s"
+            )
+        if not due:
+            return
+        try:
+            marks = load_school_price_watermarks(due)
+            changed = [sid for sid in due if sid not in known or marks.get(sid) != known[sid]]
+            rows = load_school_prices(changed) if changed else {}
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+                for sid in due:
+                    self._checked_at[sid] = now
+            if len(known) < len(due):
+                raise
+            # 読めなかったときは前回の単価で続ける（check_seconds 後に確認し直す）
+            print(f"[WARN] food_costs check failed, using cached prices: {str(e)}")
+            return
+
+        with self._lock:
+            self.checks += 1
+            if changed:
+                self.reloads += 1
+            for sid in changed:
+                # 読んでいる間に別のリクエストが先に差し替えていたら、そちらを残す
+                if (sid in self._rows) != (sid in known) or self._marks.get(sid) != known.get(sid):
+                    continue
+                self._rows[sid] = rows.get(sid, {})
+                self._marks[sid] = marks.get(sid)
+                for key in [key for key in self._catalogs if key[1] == sid]:
+                    del self._catalogs[key]
+            for sid in due:
+                self._checked_at[sid] = now
+
+    def lookup(self, catalog: RecipeCatalog, school_ids) -> dict:
+        """
+        学校ごとの単価を反映したカタログと price_coverage（必要なら単価を読み直す）
+
+        Returns:
+            {school_id: (RecipeCatalog, coverage)}
+        """
+        school_ids = sorted({int(sid) for sid in school_ids})
+        self._refresh(school_ids)
+        with self._lock:
+            if any(key[0] != catalog.version for key in self._catalogs):
+                self._catalogs = {key: v for key, v in self._catalogs.items() if key[0] == catalog.version}
+            entries = {sid: self._catalogs.get((catalog.version, sid)) for sid in school_ids}
+            rows = {sid: self._rows[sid] for sid, entry in entries.items() if entry is None}
+
+        if rows:
+            # 積の計算もロックの外で行う（行の dict は差し替えるだけで書き換えないので共有してよい）
+            built = school_catalogs(catalog, rows)
+            built = {sid: (built[sid], price_coverage(catalog, school_rows)) for sid, school_rows in rows.items()}
+            with self._lock:
+                for sid, school_rows in rows.items():
+                    entry = built[sid]
+                    if self._rows.get(sid) is school_rows:
+                        entry = self._catalogs.setdefault((catalog.version, sid), entry)
+                    entries[sid] = entry
+        return entries
+
+    def catalogs(self, catalog: RecipeCatalog, school_ids) -> dict:
+        """
+        学校ごとの単価を反映したカタログ（school_catalogs と同じ。行が無い学校は catalog そのもの）
+
+        Returns:
+            {school_id: RecipeCatalog}
+        """
+        return {sid: entry[0] for sid, entry in self.lookup(catalog, school_ids).items()}
+
+    def invalidate(self):
+        """次の参照で全校の単価を読み直させる（/catalog/reload 用）"""
+        with self._lock:
+            self._rows.clear()
+            self._marks.clear()
+            self._checked_at.clear()
+            self._catalogs.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "schools": len(self._rows),
+                "catalogs": len(self._catalogs),
+                "checks": self.checks,
+                "reloads": self.reloads,
+                "failures": self.failures,
+                "check_seconds": self.check_seconds,
+            }
+
+
+school_price_cache = SchoolPriceCache(SCHOOL_PRICES_CHECK_SECONDS)
+
+
+def school_catalog(catalog: RecipeCatalog, params: dict) -> RecipeCatalog:
+    """
+    params の学校（school_id）の単価を反映したカタログ（use_school_prices が false なら catalog そのもの）
+
+    単価の読み込みに失敗したときは共通の単価で続ける（meta.catalog_version で区別できる）。
+    """
+    if not params.get("use_school_prices"):
+        return catalog
+    school_id = params["school_id"]
+    try:
+        return school_price_cache.catalogs(catalog, [school_id])[school_id]
+    except Exception as e:
+        print(f"[WARN] school prices unavailable for school {school_id}, using shared prices: {str(e)}")
+        return catalog
+
+
+def build_qubo_poly(
+    cats, genres, nut, recipe_cost, top_neighbors, top_sim, d,
+    *,
+    M: int,
+    NUT_KEYS: list[str],
+    TARGET: dict,
+    W: dict,
+    H5_MODE: str = "practical",
+):
+    """
+    H1〜H7 を Poly として1項ずつ組み立てる（参照実装）
+
+    build_qubo_coefficients と同じモデルになることの確認用（test_qubo.py で項ごとに比べる）。
+    N×M が大きいと非常に遅いので本番経路では使わない。
+
+    Returns:
+        (x, H): 変数配列（N×M）と目的関数 Poly
+    """
+    N = len(cats)
+    cat_to_idxs = {c: np.where(cats == c)[0].tolist() for c in sorted(set(cats))}
+
+    # 変数
+    gen = VariableGenerator()
+    x = gen.array("Binary", (N, M))
+
+    H = 0
+
+    # H1：主食・主菜は=1 / 他は<=1
+    H1 = 0
+    for r in range(M):
+        for c in REQ_CATS:
+            idxs = cat_to_idxs[c]
+            Sx = sum([x[i, r] for i in idxs])
+            H1 += (Sx - 1) ** 2
+        for c in OPT_CATS:
+            idxs = cat_to_idxs[c]
+            Sx = sum([x[i, r] for i in idxs])
+            H1 += Sx * (Sx - 1)  # <=1
+    H += float(W["H1"]) * H1
+
+    # H2：栄養（各日）
+    H2 = 0
+    for r in range(M):
+        for k_idx, key in enumerate(NUT_KEYS):
+            coef = nut[:, k_idx]
+            Sx = sum([float(coef[i]) * x[i, r] for i in range(N)])
+            H2 += (Sx - float(TARGET[key])) ** 2
+    H += float(W["H2"]) * H2
+
+    # H3：M日合計コスト
+    total_cost_expr = sum([float(recipe_cost[i]) * x[i, r] for r in range(M) for i in range(N)])
+    H3 = (total_cost_expr - float(TARGET["cost"])) ** 2
+    H += float(W["H3"]) * H3
+
+    # H4：同一レシピ重複抑制（期間）
+    H4 = 0
+    for i in range(N):
+        Sx = sum([x[i, r] for r in range(M)])
+        H4 += Sx * (Sx - 1)
+    H += float(W["H4"]) * H4
+
+    # H5：同日ジャンル制御（practical推奨：同ジャンルを罰→多様化）
+    H5 = 0
+    if H5_MODE == "paper":
+        pairs = [(i, j) for i in range(N) for j in range(i + 1, N) if genres[i] != genres[j]]
+    elif H5_MODE == "practical":
+        pairs = [(i, j) for i in range(N) for j in range(i + 1, N) if genres[i] == genres[j]]
+    else:
+        raise ValueError("H5_MODE must be 'paper' or 'practical'.")
+
+    for r in range(M):
+        for (i, j) in pairs:
+            H5 += x[i, r] * x[j, r]
+    H += float(W["H5"]) * H5
+
+    # H7：隣接日多様性（g + sim）
+    H7 = 0
+    for r in range(M):
+        for rp in range(M):
+            if d[r, rp] != 1:
+                continue
+            for i in range(N):
+                for j, ip in enumerate(top_neighbors[i]):
+                    if ip < 0:
+                        continue
+                    coef = float(genres[i] == genres[ip]) + float(top_sim[i, j])
+                    if coef != 0.0:
+                        H7 += coef * x[i, r] * x[ip, rp]
+    H += float(W["H7"]) * H7
+
+    return x, H
+
+
+def build_neighbor_coupling(genres: np.ndarray, top_neighbors: np.ndarray, top_sim: np.ndarray) -> sparse.csr_matrix:
+    """
+    H7 の係数 C[i, ip] = g[i, ip] + sim[i, ip]（ip は i の上位近傍のみ）を N×N の CSR で返す
+
+    top_neighbors の -1 は空き（候補から外れた近傍）として無視する。
+    """
+    N, k = top_neighbors.shape
+    rows = np.repeat(np.arange(N), k)
+    cols = top_neighbors.ravel()
+    sims = top_sim.ravel().astype(float)
+    keep = cols >= 0
+    rows, cols, sims = rows[keep], cols[keep], sims[keep]
+    vals = (genres[rows] == genres[cols]).astype(float) + sims
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(N, N))
+
+
+class QuboTerms:
+    """
+    H1〜H7 を重みを掛けない形で1回だけ組み立て、combine(W) で重み付きの QUBO 係数にする
+
+    同日ブロック（H1, H2, H5）は N×N / N の係数を項ごとに、H3 はコストのベクトル、H7 は近傍の結合 C を持つ。
+    重みだけを変えて何通りも解く（スイープ）ときは、項の組み立てを1回で済ませて combine だけを繰り返す。
+    timings を渡すと項ごとの所要時間（秒）を加算する。
+    """
+
+    def __init__(
+        self,
+        cats, genres, nut, recipe_cost, top_neighbors, top_sim, d,
+        *,
+        M: int,
+        NUT_KEYS: list[str],
+        TARGET: dict,
+        H5_MODE: str = "practical",
+        timings: dict = None,
+    ):
+        lap = _lap_timer(timings)
+        N = len(cats)
+        self.N, self.M, self.d = N, M, d
+
+        if H5_MODE == "paper":
+            same_pair = genres[:, None] != genres[None, :]
+        elif H5_MODE == "practical":
+            same_pair = genres[:, None] == genres[None, :]
+        else:
+            raise ValueError("H5_MODE must be 'paper' or 'practical'.")
+
+        # --- 同日ブロック：全日で共通の (N×N, N, 1日あたりの定数) ---
+        # H1：(S-1)^2 = S^2 - 2S + 1 / S(S-1) = S^2 - S
+        B1 = np.zeros((N, N), dtype=float)
+        b1 = np.zeros(N, dtype=float)
+        for c in REQ_CATS + OPT_CATS:
+            mask = (cats == c).astype(float)
+            B1 += np.outer(mask, mask)
+            b1 -= (2.0 if c in REQ_CATS else 1.0) * mask
+        lap("H1")
+
+        # H2：(a·x - t)^2 = x^T (a a^T) x - 2t a·x + t^2
+        B2 = np.zeros((N, N), dtype=float)
+        b2 = np.zeros(N, dtype=float)
+        c2 = 0.0
+        for k_idx, key in enumerate(NUT_KEYS):
+            a = nut[:, k_idx].astype(float)
+            t = float(TARGET[key])
+            B2 += np.outer(a, a)
+            b2 -= 2.0 * t * a
+            c2 += t * t
+        lap("H2")
+
+        # H5：同日のペア（i < j）
+        B5 = np.triu(same_pair, k=1).astype(float)
+        lap("H5")
+
+        self.same_day = {
+            "H1": (B1, b1, float(len(REQ_CATS))),
+            "H2": (B2, b2, c2),
+            "H5": (B5, None, 0.0),
+        }
+
+        # --- 日をまたぐ項（H3, H4, H7） ---
+        # H3：M日合計コスト（全変数が密に結合する）
+        self.cost_flat = np.repeat(recipe_cost.astype(float), M)
+        self.t_cost = float(TARGET["cost"])
+
+        # H7：隣接日多様性（上位 topk 近傍のみ、g + sim）
+        self.C = build_neighbor_coupling(genres, top_neighbors, top_sim).toarray()
+        lap("H7")
+
+    def combine(self, W: dict, timings: dict = None):
+        """
+        重み W で足し合わせた QUBO 係数を作る（build_qubo_coefficients と同じ結果）
+
+        Returns:
+            (Q, p, const): 二次係数（N×M×N×M）、一次係数（N×M）、定数項
+        """
+        lap = _lap_timer(timings)
+        N, M = self.N, self.M
+
+        B = np.zeros((N, N), dtype=float)
+        b = np.zeros(N, dtype=float)
+        const = 0.0
+        for name, (B_k, b_k, c_k) in self.same_day.items():
+            w = float(W[name])
+            B += w * B_k
+            if b_k is not None:
+                b += w * b_k
+            const += w * c_k * M
+
+        w3 = float(W["H3"])
+        Q = w3 * np.outer(self.cost_flat, self.cost_flat)
+        p = b[:, None] - w3 * 2.0 * self.t_cost * self.cost_flat.reshape(N, M)
+        const += w3 * self.t_cost * self.t_cost
+        lap("H3")
+
+        Q4 = Q.reshape(N, M, N, M)
+        for r in range(M):
+            Q4[:, r, :, r] += B
+        lap("same_day")
+
+        # H4：S(S-1) = Σ_{r≠r'} x[i,r] x[i,r']
+        idx = np.arange(N)
+        Q4[idx, :, idx, :] += float(W["H4"]) * (1.0 - np.eye(M))
+        lap("H4")
+
+        w7C = float(W["H7"]) * self.C
+        for r, rp in zip(*np.nonzero(self.d == 1)):
+            Q4[:, r, :, rp] += w7C
+        lap("H7")
+
+        return Q4, p, const
+
+
+def _lap_timer(timings: dict = None):
+    """呼ぶたびに前回からの経過秒数を timings[name] に加算する関数を返す（timings が None なら何もしない）"""
+    t0 = time.perf_counter()
+
+    def lap(name):
+        nonlocal t0
+        t1 = time.perf_counter()
+        if timings is not None:
+            timings[name] = round(timings.get(name, 0.0) + (t1 - t0), 4)
+        t0 = t1
+
+    return lap
+
+
+def build_qubo_coefficients(
+    cats, genres, nut, recipe_cost, top_neighbors, top_sim, d,
+    *,
+    M: int,
+    NUT_KEYS: list[str],
+    TARGET: dict,
+    W: dict,
+    H5_MODE: str = "practical",
+    timings: dict = None,
+):
+    """
+    H1〜H7 の係数を NumPy で行列として組み立てる
+
+    変数 x[i, r]（レシピ i を r 日目に採用）の係数を (N, M, N, M) の二次係数 Q、
+    (N, M) の一次係数 p、定数 c にまとめる。build_qubo_poly と同じ多項式になる。
+    timings を渡すと項ごとの所要時間（秒）を書き込む（same_day は同日ブロックを各日に足す分）。
+
+    Returns:
+        (Q, p, const): 二次係数（N×M×N×M）、一次係数（N×M）、定数項
+    """
+    terms = QuboTerms(
+        cats, genres, nut, recipe_cost, top_neighbors, top_sim, d,
+        M=M, NUT_KEYS=NUT_KEYS, TARGET=TARGET, H5_MODE=H5_MODE, timings=timings,
+    )
+    return terms.combine(W, timings=timings)
+
+
+def qubo_stats(Q: np.ndarray, p: np.ndarray) -> dict:
+    """QUBO の規模（変数の数と、0 でない二次・一次係数の数）"""
+    return {
+        "variables": int(p.size),
+        "quadratic_terms": int(np.count_nonzero(Q)),
+        "linear_terms": int(np.count_nonzero(p)),
+    }
+
+
+# ============
+# カテゴリ枠の制約（H1 をペナルティでなくソルバーの制約で扱う）
+# ============
+# "penalty": H1 を二乗ペナルティとして QUBO に入れる（従来） / "one_hot": 日 × カテゴリの枠を one-hot 制約で渡す
+CONSTRAINT_FORMULATIONS = ("penalty", "one_hot")
+# one_hot で Amplify に渡す制約の既定の重み（solver_options.constraint_weight で変更）
+AMPLIFY_CONSTRAINT_WEIGHT = 80.0
+
+
+def one_hot_groups(cats: np.ndarray, M: int) -> list[tuple[bool, np.ndarray]]:
+    """
+    日 × カテゴリの枠ごとに、枠に入る変数の番号（p を平らにした並び i*M + r）を返す
+
+    主食・主菜（REQ_CATS）は「ちょうど1品」、他（OPT_CATS）は「1品以下」（「選ばない」を含めた one-hot）。
+
+    Returns:
+        [(必須の枠か, 変数番号の配列)]
+    """
+    groups = []
+    for c in REQ_CATS + OPT_CATS:
+        idxs = np.flatnonzero(cats == c)
+        if len(idxs) == 0:
+            continue
+        for r in range(M):
+            groups.append((c in REQ_CATS, idxs * M + r))
+    return groups
+
+
+def restrict_groups(groups: list, fixed: np.ndarray) -> list:
+    """
+    fix_qubo_variables の前に、固定する変数に合わせて枠を自由変数の番号に付け替える
+
+    1 に固定した変数を含む枠は満たされているので外し、その枠の他の変数を 0 に固定する（fixed を書き換える）。
+    """
+    fx = fixed.reshape(-1)
+    kept = []
+    for required, idxs in groups:
+        if (fx[idxs] == 1).any():
+            fx[idxs[fx[idxs] < 0]] = 0
+        else:
+            kept.append((required, idxs))
+    free = fx < 0
+    pos = np.cumsum(free) - 1
+    return [(required, pos[idxs[free[idxs]]]) for required, idxs in kept if free[idxs].any()]
+
+
+def h1_quadratic_terms(cats: np.ndarray, M: int) -> int:
+    """H1 のペナルティが書き込む二次係数の数（カテゴリごとのレシピ数の二乗 × 日数）"""
+    return int(sum(int(np.count_nonzero(cats == c)) ** 2 for c in REQ_CATS + OPT_CATS) * M)
+
+
+def model_weights(W: dict, constraints: str) -> dict:
+    """QUBO に入れる重み。one_hot なら H1 は制約で扱うので 0 にする"""
+    return dict(W, H1=0.0) if constraints == "one_hot" else W
+
+
+def constraint_stats(cats: np.ndarray, M: int, constraints: str, groups: list = None) -> dict:
+    """meta.qubo に足す、制約の形式と H1 の規模（ペナルティ形式と比べる用）"""
+    return {
+        "constraints": constraints,
+        "constraint_groups": len(groups or []),
+        "h1_quadratic_terms": 0 if constraints == "one_hot" else h1_quadratic_terms(cats, M),
+    }
+
+
+def qubo_to_matrix(Q: np.ndarray, p: np.ndarray, const: float):
+    """係数配列を Amplify の Matrix に一括で渡す。Returns: (x, H)"""
+    gen = VariableGenerator()
+    H = gen.matrix("Binary", p.shape)
+    H.quadratic = Q
+    H.linear = p
+    H.constant = const
+    return H.variable_array, H
+
+
+# ============
+# ソルバー（リクエストの "solver" で選択）
+# ============
+def solve_qubo_amplify(Q: np.ndarray, p: np.ndarray, const: float, *, timeout_ms: int = None,
+                       solutions: list = None, groups: list = None, constraint_weight: float = None, **_):
+    """
+    Amplify AE（クラウド）で解く。Returns: (解 0/1 配列（p と同形）, エネルギー)
+
+    solutions にリストを渡すと、Amplify が返した解をすべて (解, エネルギー) でエネルギー順に追加する。
+    groups（one_hot_groups の枠）を渡すと、必須の枠は one_hot、任意の枠は less_equal(…, 1) の制約にする。
+    制約の重みは constraint_weight（既定は H1 の既定値 80）。
+    """
+    amplify_token = os.getenv("AMPLIFY_TOKEN")
+    if not amplify_token:
+        raise ValueError("AMPLIFY_TOKEN is not set in environment variables.")
+
+    x, H = qubo_to_matrix(Q, p, const)
+    model = H
+    if groups:
+        xf = x.flatten()
+        constraints = ConstraintList()
+        for required, idxs in groups:
+            S = sum(xf[int(k)] for k in idxs)
+            constraints += one_hot(S) if required else less_equal(S, 1)
+        constraints *= float(constraint_weight if constraint_weight is not None else AMPLIFY_CONSTRAINT_WEIGHT)
+        model = H + constraints
+
+    client = AmplifyAEClient()
+    client.token = amplify_token
+    if timeout_ms is not None:
+        client.parameters.timeout = int(timeout_ms)
+    # 制約を満たす解が無くても最良の解を返す（違反は checks.feasibility に出る）
+    result = solve(model, client, filter_solution=False)
+    best = result.best
+    sol = np.rint(x.evaluate(best.values)).astype(np.int8)
+    if solutions is not None:
+        found = [(np.rint(x.evaluate(s.values)).astype(np.int8), float(s.objective)) for s in result.solutions]
+        solutions.extend(sorted(found, key=lambda item: item[1]))
+    return sol, float(best.objective)
+
+
+def solve_qubo_local(
+    Q: np.ndarray,
+    p: np.ndarray,
+    const: float,
+    *,
+    sweeps: int = 20,
+    time_limit_ms: int = 5000,
+    seed: int = 0,
+    pool_size: int = 8,
+    solutions: list = None,
+    groups: list = None,
+    **_,
+):
+    """
+    NumPy のタブーサーチで解く（オフライン・トークン不要）
+
+    毎反復で全変数の反転時のエネルギー変化をベクトル演算で求め、タブーでない中で
+    最良の1変数を反転する。局所場 f = Q_sym x は反転した変数の行だけで更新する。
+    反復回数の上限は sweeps × 変数数、time_limit_ms で打ち切る。
+    seed が同じなら同じ解を返す。
+    solutions にリストを渡すと、探索中に通った局所最適解のうちエネルギーの低い異なる解を
+    pool_size 個まで (解, エネルギー) でエネルギー順に追加する（最良解を含む）。
+    groups（one_hot_groups の枠）を渡すと、枠を満たす解だけを動く探索にする（_solve_qubo_local_one_hot）。
+
+    Returns:
+        (解 0/1 配列（p と同形）, エネルギー)
+    """
+    if groups is not None:
+        return _solve_qubo_local_one_hot(
+            Q, p, const, groups, sweeps=sweeps, time_limit_ms=time_limit_ms, seed=seed,
+            pool_size=pool_size, solutions=solutions,
+        )
+
+    shape = p.shape
+    n = int(np.prod(shape))
+    Qs, lin = _symmetrize_qubo(Q, p)
+
+    rng = np.random.default_rng(seed)
+    x = np.zeros(n, dtype=float)
+    f = np.zeros(n, dtype=float)
+    energy = float(const)
+    best_x = x.copy()
+    best_energy = energy
+
+    tabu_until = np.zeros(n, dtype=np.int64)
+    tenure = max(1, min(20, n // 10))
+    max_iters = max(1, int(sweeps) * n)
+    deadline = time.perf_counter() + float(time_limit_ms) / 1000.0
+    stall = 0
+    pool = SolutionPool(pool_size) if solutions is not None else None
+
+    for it in range(max_iters):
+        if it % 256 == 0 and time.perf_counter() > deadline:
+            break
+
+        delta = (1.0 - 2.0 * x) * (lin + 2.0 * f)
+        # どの1変数を反転してもエネルギーが下がらない = 局所最適解
+        if pool is not None and delta.min() >= -1e-12:
+            pool.keep(x, energy)
+        # タブー中でも最良解を更新する手はアスピレーションで許可
+        blocked = (tabu_until > it) & (energy + delta >= best_energy - 1e-12)
+        delta_masked = np.where(blocked, np.inf, delta)
+        v = int(np.argmin(delta_masked))
+        if not np.isfinite(delta_masked[v]):
+            v = int(rng.integers(n))
+
+        step = 1.0 - 2.0 * x[v]
+        x[v] += step
+        f += step * Qs[v]
+        energy += float(delta[v])
+        tabu_until[v] = it + tenure + int(rng.integers(tenure + 1))
+
+        if energy < best_energy - 1e-12:
+            best_energy = energy
+            best_x[:] = x
+            stall = 0
+        else:
+            stall += 1
+
+        # 改善が止まったら最良解からランダムに数変数を崩して再開
+        if stall > 2 * n:
+            x[:] = best_x
+            kick = rng.choice(n, size=max(1, n // 50), replace=False)
+            x[kick] = 1.0 - x[kick]
+            f = Qs @ x
+            energy = float(x @ f + lin @ x + const)
+            tabu_until[:] = 0
+            stall = 0
+
+    if pool is not None:
+        pool.keep(best_x, best_energy)
+        solutions.extend(pool.items(shape))
+    return best_x.reshape(shape).astype(np.int8), float(best_energy)
+
+
+def _solve_qubo_local_one_hot(
+    Q: np.ndarray,
+    p: np.ndarray,
+    const: float,
+    groups: list,
+    *,
+    sweeps: int = 20,
+    time_limit_ms: int = 5000,
+    seed: int = 0,
+    pool_size: int = 8,
+    solutions: list = None,
+):
+    """
+    枠（日 × カテゴリ）の one-hot を崩さずに動くタブーサーチ
+
+    変数は各枠でちょうど1つ（任意の枠は「選ばない」も可）が 1 で、1手は1つの枠の中身を入れ替える。
+    枠の入れ替え i → j のエネルギー変化は h[j] - h[i] - 2 Qs[i, j]（h = lin + 2 Qs x）で、
+    全枠の全候補をまとめてベクトル演算で求める。どの枠にも入らない変数は 0 のまま。
+
+    Returns:
+        (解 0/1 配列（p と同形）, エネルギー)
+    """
+    shape = p.shape
+    n = int(np.prod(shape))
+    Qs, lin = _symmetrize_qubo(Q, p)
+    rng = np.random.default_rng(seed)
+
+    G = len(groups)
+    required = np.array([req for req, _ in groups], dtype=bool)
+    members = np.concatenate([idxs for _, idxs in groups]) if G else np.zeros(0, dtype=np.int64)
+    gid = np.repeat(np.arange(G), [len(idxs) for _, idxs in groups])
+    optional = np.flatnonzero(~required)
+
+    x = np.zeros(n, dtype=float)
+    f = np.zeros(n, dtype=float)
+    cur = np.full(G, -1, dtype=np.int64)
+
+    def _assign(g, j):
+        nonlocal f
+        i = cur[g]
+        if i >= 0:
+            x[i] = 0.0
+            f -= Qs[i]
+        if j >= 0:
+            x[j] = 1.0
+            f += Qs[j]
+        cur[g] = j
+
+    # 初期解：必須の枠を順に、その時点で最もエネルギーが下がるレシピで埋める
+    for g in np.flatnonzero(required):
+        idxs = groups[g][1]
+        _assign(g, int(idxs[np.argmin(lin[idxs] + 2.0 * f[idxs])]))
+    energy = float(x @ (Qs @ x) + lin @ x + const)
+
+    best_x = x.copy()
+    best_energy = energy
+    pool = SolutionPool(pool_size) if solutions is not None else None
+
+    tabu_until = np.zeros(n, dtype=np.int64)       # 枠から外した変数は tenure の間戻さない
+    none_tabu_until = np.zeros(G, dtype=np.int64)  # 「選ばない」から埋めた枠は tenure の間空けない
+    tenure = max(1, min(20, len(members) // 10))
+    max_iters = max(1, int(sweeps) * n)
+    deadline = time.perf_counter() + float(time_limit_ms) / 1000.0
+    stall = 0
+
+    for it in range(max_iters):
+        if it % 256 == 0 and time.perf_counter() > deadline:
+            break
+
+        h = lin + 2.0 * f
+        cur_m = cur[gid]
+        has = cur_m >= 0
+        safe = np.where(has, cur_m, 0)
+        delta = h[members] - np.where(has, h[safe] + 2.0 * Qs[safe, members], 0.0)
+        delta[members == cur_m] = np.inf
+        # 任意の枠を空ける手
+        filled = optional[cur[optional] >= 0]
+        delta_none = -h[cur[filled]]
+
+        if pool is not None and min(delta.min(initial=np.inf), delta_none.min(initial=np.inf)) >= -1e-12:
+            pool.keep(x, energy)
+
+        # タブー中でも最良解を更新する手はアスピレーションで許可
+        aspire = energy + delta < best_energy - 1e-12
+        delta_masked = np.where((tabu_until[members] > it) & ~aspire, np.inf, delta)
+        aspire_none = energy + delta_none < best_energy - 1e-12
+        none_masked = np.where((none_tabu_until[filled] > it) & ~aspire_none, np.inf, delta_none)
+
+        k = int(np.argmin(delta_masked)) if len(members) else -1
+        k_none = int(np.argmin(none_masked)) if len(filled) else -1
+        move_delta = delta_masked[k] if k >= 0 else np.inf
+        if k_none >= 0 and none_masked[k_none] < move_delta:
+            g, j, move_delta = int(filled[k_none]), -1, float(delta_none[k_none])
+        elif np.isfinite(move_delta):
+            g, j, move_delta = int(gid[k]), int(members[k]), float(delta[k])
+        else:
+            break
+
+        i = int(cur[g])
+        _assign(g, j)
+        energy += move_delta
+        step = tenure + int(rng.integers(tenure + 1))
+        if i >= 0:
+            tabu_until[i] = it + step
+        else:
+            none_tabu_until[g] = it + step
+
+        if energy < best_energy - 1e-12:
+            best_energy = energy
+            best_x[:] = x
+            stall = 0
+        else:
+            stall += 1
+
+        # 改善が止まったら最良解から数枠をランダムに入れ替えて再開
+        if stall > 2 * len(members):
+            x[:] = best_x
+            cur[:] = -1
+            on = np.flatnonzero(x[members] > 0.5)
+            cur[gid[on]] = members[on]
+            for g in rng.choice(G, size=max(1, G // 10), replace=False):
+                idxs = groups[g][1]
+                choices = idxs if required[g] else np.append(idxs, -1)
+                j = int(rng.choice(choices))
+                if cur[g] >= 0:
+                    x[cur[g]] = 0.0
+                cur[g] = j
+                if j >= 0:
+                    x[j] = 1.0
+            f = Qs @ x
+            energy = float(x @ f + lin @ x + const)
+            tabu_until[:] = 0
+            none_tabu_until[:] = 0
+            stall = 0
+
+    if pool is not None:
+        pool.keep(best_x, best_energy)
+        solutions.extend(pool.items(shape))
+    return best_x.reshape(shape).astype(np.int8), float(best_energy)
+
+
+def _symmetrize_qubo(Q: np.ndarray, p: np.ndarray):
+    """x^T Q x + p·x を x^T Qs x + lin·x（Qs は対角0の対称行列）に直す。Returns: (Qs, lin)"""
+    n = p.size
+    Q2 = Q.reshape(n, n)
+    Qs = Q2 + Q2.T
+    Qs *= 0.5
+    lin = p.reshape(n) + np.diagonal(Q2)
+    np.fill_diagonal(Qs, 0.0)
+    return Qs, lin
+
+
+class SolutionPool:
+    """エネルギーの低い異なる解を size 個まで持つ（解は 0/1 のバイト列で区別する）"""
+
+    def __init__(self, size: int):
+        self.size = max(1, int(size))
+        self._entries = {}
+
+    def keep(self, x: np.ndarray, energy: float):
+        key = x.astype(np.int8).tobytes()
+        if key in self._entries:
+            return
+        self._entries[key] = float(energy)
+        if len(self._entries) > self.size:
+            del self._entries[max(self._entries, key=self._entries.get)]
+
+    def items(self, shape) -> list[tuple[np.ndarray, float]]:
+        """(解, エネルギー) をエネルギー順に返す"""
+        return [
+            (np.frombuffer(key, dtype=np.int8).reshape(shape).copy(), e)
+            for key, e in sorted(self._entries.items(), key=lambda item: item[1])
+        ]
+
+
+SOLVER_BACKENDS = {
+    "amplify": solve_qubo_amplify,
+    "local": solve_qubo_local,
+}
+
+
+def recipe_detail(catalog: RecipeCatalog, i: int) -> dict:
+    """レシピ i のフロントに返す詳細（必要なものだけ）。通常は catalog.recipe_details の作り置きを使う"""
+    r = catalog.recipes[i]
+    price_per_g, median_price = catalog.price_per_g, catalog.median_price
+    return {
+        "idx": int(i),
+        "id": r.get("id", i),
+        "title": r.get("title", f"recipe_{i}"),
+        "category": int(r.get("category", -1)),
+        "category_name": CATEGORY_NAME.get(int(r.get("category", -1)), str(r.get("category", -1))),
+        "genre": int(r.get("genre", -1)),
+        "nutritions": r.get("nutritions", {}) or {},
+        "ingredients": [
+            {
+                "food_id": int(ing.get("id")) if ing.get("id") is not None else None,
+                "amount_g": float(ing.get("amount")) if ing.get("amount") is not None else None,
+                "name": (ing.get("food") or {}).get("name") if isinstance(ing.get("food"), dict) else ing.get("name"),
+                "unit_cost": float(price_per_g.get(int(ing.get("id")), median_price)) if ing.get("id") is not None else None,
+                "cost": (
+                    float(ing.get("amount")) * float(price_per_g.get(int(ing.get("id")), median_price))
+                    if (ing.get("id") is not None and ing.get("amount") is not None)
+                    else None
+                ),
+            }
+            for ing in (r.get("ingredients", []) or [])
+        ],
+        "recipe_cost": float(catalog.recipe_cost[i]),
+    }
+
+
+def category_counts(details: list[dict]) -> dict:
+    """チェック：カテゴリごとに何個選ばれてるか"""
+    cnt = {}
+    for c in (REQ_CATS + OPT_CATS):
+        cnt[CATEGORY_NAME.get(c, str(c))] = sum(1 for drec in details if drec.get("category") == c)
+    return cnt
+
+
+def decode_plan(catalog: RecipeCatalog, sol: np.ndarray) -> tuple[dict, dict]:
+    """
+    解（N×M の 0/1 配列）を献立に展開する
+
+    日別の栄養・コスト・カテゴリ数は nut / recipe_cost / cat_onehot との行列積でまとめて求め、
+    レシピの詳細はカタログで作り置きしたものを使う。
+
+    Returns:
+        (plan, checks): レスポンスの "plan" と "checks"
+    """
+    NUT_KEYS = catalog.NUT_KEYS
+    S = np.asarray(sol, dtype=float)
+    M = S.shape[1]
+
+    # 日別集計（選ばれた分だけ合計）
+    day_cost = catalog.recipe_cost @ S   # M
+    day_nut = catalog.nut.T @ S          # K×M
+    day_cats = catalog.cat_onehot @ S    # C×M
+    cat_names = [CATEGORY_NAME.get(c, str(c)) for c in catalog.check_cats]
+
+    days = []
+    daily_totals = []
+
+    # カテゴリ別カウント（チェック用）
+    checks = {"per_day_category_counts": []}
+
+    for r in range(M):
+        chosen = np.flatnonzero(sol[:, r])
+        days.append({"day": r + 1, "recipes": [catalog.recipe_details[i] for i in chosen]})
+
+        tot = {"cost": float(day_cost[r])}
+        for k_idx, key in enumerate(NUT_KEYS):
+            tot[key] = float(day_nut[k_idx, r])
+        daily_totals.append({"day": r + 1, "totals": tot})
+
+        cnt = {name: int(round(day_cats[c_idx, r])) for c_idx, name in enumerate(cat_names)}
+        checks["per_day_category_counts"].append({"day": r + 1, "counts": cnt})
+
+    # カテゴリ制約（主食・主菜は1品、他は1品以下）を満たした日の割合
+    counts = np.rint(day_cats).astype(int)
+    req = np.array([c in REQ_CATS for c in catalog.check_cats])[:, None]
+    violated = np.where(req, counts != 1, counts > 1)
+    feasible_days = int(np.count_nonzero(~violated.any(axis=0)))
+    checks["feasibility"] = {
+        "days": M,
+        "feasible_days": feasible_days,
+        "rate": round(feasible_days / M, 4) if M else 1.0,
+        "violations": int(np.count_nonzero(violated)),
+    }
+
+    plan = {
+        "days": days,
+        "daily_totals": daily_totals,
+        "total_cost": float(day_cost.sum()),
+    }
+    return plan, checks
+
+
+# ============
+# QUBO のメモリ上限（密な N×M×N×M の係数行列を同時にいくつ持つか）
+# ============
+# プロセス全体で同時に持つ QUBO の見積もりバイト数の上限。1つでこれを超えるリクエストは 400 にする
+QUBO_MAX_BYTES = int(os.getenv("OPTIMIZE_QUBO_MAX_BYTES", str(1 << 30)))
+
+
+def qubo_bytes(N: int, M: int, solver: str) -> int:
+    """
+    QUBO 行列（とソルバーの作業用コピー）のおおよそのバイト数
+
+    local は Q・対称化した Qs と作業用の一時配列、amplify は Q と Amplify の Matrix に渡したコピーを持つ。
+    """
+    copies = {"local": 3, "amplify": 2}.get(solver, 1)
+    return (N * M) ** 2 * 8 * copies
+
+
+class QuboMemoryBudget:
+    """
+    QUBO を組み立てて解く間のメモリを、見積もり（qubo_bytes）の合計が limit 以下になるように抑える
+
+    スイープの組み合わせ・一括最適化の学校・分割求解のブロック・同時に来たリクエストは、
+    それぞれ reserve してから Q を組み立てる。空きが足りなければ他が解き終わるまで待つので、
+    並列数はワーカー数ではなく QUBO の大きさで決まる。1つで limit を超えるものは待たずに 400 にする。
+    """
+
+    def __init__(self, limit: int):
+        self.limit = int(limit)
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.waiting = 0
+
+    def check(self, N: int, M: int, solver: str) -> int:
+        nbytes = qubo_bytes(N, M, solver)
+        if nbytes > self.limit:
+            raise OptimizeRequestError(
+                f"QUBO too large: N={N} x M={M} needs about {nbytes / 2**20:.0f} MiB "
+                f"(limit {self.limit / 2**20:.0f} MiB). Reduce M, or use prune or decompose."
+            )
+        return nbytes
+
+    @contextmanager
+    def reserve(self, N: int, M: int, solver: str):
+        nbytes = self.check(N, M, solver)
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_use + nbytes > self.limit:
+                    self._cond.wait()
+            finally:
+                self.waiting -= 1
+            self.in_use += nbytes
+        try:
+            yield nbytes
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"limit": self.limit, "in_use": self.in_use, "waiting": self.waiting}
+
+
+qubo_memory = QuboMemoryBudget(QUBO_MAX_BYTES)
+
+
+def solve_menu(
+    catalog: RecipeCatalog,
+    *,
+    M: int,
+    TARGET: dict,
+    W: dict,
+    H5_MODE: str = "practical",
+    solver: str = "amplify",
+    solver_options: dict = None,
+    locked: list = None,
+    constraints: str = "penalty",
+    repair: dict = None,
+):
+    if solver not in SOLVER_BACKENDS:
+        raise ValueError(f"solver must be one of {sorted(SOLVER_BACKENDS)}.")
+    if locked:
+        return solve_menu_locked(
+            catalog, M=M, TARGET=TARGET, W=W, H5_MODE=H5_MODE,
+            solver=solver, solver_options=solver_options, locked=locked, constraints=constraints,
+            repair=repair,
+        )
+
+    with qubo_memory.reserve(catalog.N, M, solver):
+        t0 = time.perf_counter()
+        d = build_day_adjacency(M)
+        Q, p, const = build_qubo_coefficients(
+            catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost,
+            catalog.top_neighbors, catalog.top_sim, d,
+            M=M, NUT_KEYS=catalog.NUT_KEYS, TARGET=TARGET, W=model_weights(W, constraints), H5_MODE=H5_MODE,
+        )
+        groups = one_hot_groups(catalog.cats, M) if constraints == "one_hot" else None
+        stats = qubo_stats(Q, p)
+        stats.update(constraint_stats(catalog.cats, M, constraints, groups))
+        build_time = time.perf_counter() - t0
+
+        # solve
+        t0 = time.perf_counter()
+        sol, energy = SOLVER_BACKENDS[solver](Q, p, const, groups=groups, **(solver_options or {}))
+        solver_time = time.perf_counter() - t0
+        del Q
+    if groups is not None:
+        # ソルバーのエネルギーには H1 が入らないので、ペナルティ形式と同じ重みで評価し直す
+        terms = evaluate_qubo_terms(catalog, sol, TARGET=TARGET, H5_MODE=H5_MODE)
+        energy = float(np.sum([float(W[k]) * v for k, v in terms.items()]))
+
+    repair_report = None
+    if repair:
+        sol, repair_report = repair_plan(catalog, sol, TARGET=TARGET, W=W, H5_MODE=H5_MODE, **repair)
+        energy = repair_report["energy_after"]
+
+    t0 = time.perf_counter()
+    plan, checks = decode_plan(catalog, sol)
+    decode_time = time.perf_counter() - t0
+
+    response = {
+        "meta": {
+            "M": M,
+            "N_candidates": catalog.N,
+            "target": TARGET,
+            "weights": W,
+            "h5_mode": H5_MODE,
+            "topk_sim": catalog.topk_sim,
+            "catalog_version": catalog.version,
+            "solver": solver,
+            "solver_time": round(solver_time, 4),
+            "energy": energy,
+            "qubo": stats,
+            "timings": {
+                "build_model": round(build_time, 4),
+                "solve": round(solver_time, 4),
+                "decode": round(decode_time, 4),
+            },
+        },
+        "plan": plan,
+        "checks": checks,
+    }
+    add_repair_meta(response, repair_report)
+
+    return response
+
+
+def evaluate_qubo_terms(
+    catalog: RecipeCatalog,
+    sol: np.ndarray,
+    *,
+    TARGET: dict,
+    H5_MODE: str = "practical",
+) -> dict:
+    """
+    解に対する H1〜H7 の値（重みを掛ける前）を QUBO 行列を使わずに求める
+
+    Σ W[k] * terms[k] が build_qubo_coefficients のエネルギー（定数項込み）と一致する。
+    """
+    cats, genres, nut, recipe_cost = catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost
+    S = sol.astype(float)
+    M = S.shape[1]
+
+    H1 = 0.0
+    for c in REQ_CATS + OPT_CATS:
+        s = S[cats == c].sum(axis=0)
+        H1 += float(((s - 1.0) ** 2).sum() if c in REQ_CATS else (s * (s - 1.0)).sum())
+
+    t = np.array([float(TARGET[key]) for key in catalog.NUT_KEYS])
+    H2 = float(((nut.T @ S - t[:, None]) ** 2).sum())
+
+    H3 = float((recipe_cost @ S.sum(axis=1) - float(TARGET["cost"])) ** 2)
+
+    k = S.sum(axis=1)
+    H4 = float((k * (k - 1.0)).sum())
+
+    # 同日の同ジャンルペア数 = Σ_g C(n_g, 2)
+    genre_ids, genre_idx = np.unique(genres, return_inverse=True)
+    G = np.zeros((len(genre_ids), len(genres)))
+    G[genre_idx, np.arange(len(genres))] = 1.0
+    n_g = G @ S
+    same = (n_g * (n_g - 1.0) / 2.0).sum(axis=0)
+    n = S.sum(axis=0)
+    if H5_MODE == "paper":
+        H5 = float((n * (n - 1.0) / 2.0 - same).sum())
+    else:
+        H5 = float(same.sum())
+
+    C = build_neighbor_coupling(genres, catalog.top_neighbors, catalog.top_sim)
+    d = build_day_adjacency(M)
+    H7 = 0.0
+    for r, rp in zip(*np.nonzero(d == 1)):
+        H7 += float(S[:, r] @ (C @ S[:, rp]))
+
+    return {"H1": H1, "H2": H2, "H3": H3, "H4": H4, "H5": H5, "H7": H7}
+
+
+# ============
+# 解の修復（カテゴリ枠・重複を貪欲に直し、枠単位の局所探索で H2・H3 を下げる）
+# ============
+REPAIR_MAX_MOVES = 200
+REPAIR_TIME_LIMIT_MS = 100
+
+
+class PlanState:
+    """
+    献立（N×M の 0/1）の日別集計を持ち、1品の追加・削除のエネルギー変化を O(N) で求める
+
+    エネルギーは H2〜H7 の重み付き和（H1 は枠を直接扱うので入れない）。
+    H7 は隣接日の選択との結合 C_sym = C + C^T を疎行列の積で求める。
+    """
+
+    def __init__(self, catalog: RecipeCatalog, sol: np.ndarray, *, TARGET: dict, W: dict, H5_MODE: str = "practical"):
+        self.nut = catalog.nut.astype(float)
+        self.nut_sq = (self.nut ** 2).sum(axis=1)
+        self.cost = catalog.recipe_cost.astype(float)
+        self.t_nut = np.array([float(TARGET[key]) for key in catalog.NUT_KEYS])
+        self.t_cost = float(TARGET["cost"])
+        self.w = {k: float(W[k]) for k in ("H2", "H3", "H4", "H5", "H7")}
+        self.paper = H5_MODE == "paper"
+        _, self.genre_idx = np.unique(catalog.genres, return_inverse=True)
+        C = build_neighbor_coupling(catalog.genres, catalog.top_neighbors, catalog.top_sim)
+        self.C_sym = (C + C.T).tocsr()
+
+        self.S = np.asarray(sol, dtype=np.int8).copy()
+        self.M = self.S.shape[1]
+        S = self.S.astype(float)
+        self.day_nut = self.nut.T @ S                         # K×M
+        self.total_cost = float(self.cost @ S.sum(axis=1))
+        self.k = self.S.sum(axis=1).astype(float)              # レシピごとの採用回数
+        self.genre_count = np.zeros((self.genre_idx.max() + 1 if len(self.genre_idx) else 0, self.M))
+        np.add.at(self.genre_count, self.genre_idx, S)
+        self.day_count = S.sum(axis=0)
+        self._coupling = {}
+
+    def _neighbor_field(self, r: int) -> np.ndarray:
+        """r 日目にレシピを置いたときの H7（隣接日の選択との結合）"""
+        field = self._coupling.get(r)
+        if field is None:
+            field = np.zeros(len(self.cost))
+            for rp in (r - 1, r + 1):
+                if 0 <= rp < self.M:
+                    field += self.C_sym @ self.S[:, rp].astype(float)
+            self._coupling[r] = field
+        return field
+
+    def delta_add(self, r: int, cands) -> np.ndarray:
+        """cands の各レシピを r 日目に加えたときのエネルギー変化"""
+        cands = np.asarray(cands)
+        dev = self.day_nut[:, r] - self.t_nut
+        dH2 = self.nut[cands] @ (2.0 * dev) + self.nut_sq[cands]
+        c = self.cost[cands]
+        dH3 = c * (2.0 * (self.total_cost - self.t_cost) + c)
+        dH4 = 2.0 * self.k[cands]
+        same = self.genre_count[self.genre_idx[cands], r]
+        dH5 = self.day_count[r] - same if self.paper else same
+        dH7 = self._neighbor_field(r)[cands]
+        w = self.w
+        return w["H2"] * dH2 + w["H3"] * dH3 + w["H4"] * dH4 + w["H5"] * dH5 + w["H7"] * dH7
+
+    def _update(self, r: int, i: int, step: int):
+        self.S[i, r] += step
+        self.day_nut[:, r] += step * self.nut[i]
+        self.total_cost += step * self.cost[i]
+        self.k[i] += step
+        self.genre_count[self.genre_idx[i], r] += step
+        self.day_count[r] += step
+        # 隣接日の H7 の場だけ作り直す
+        self._coupling.pop(r - 1, None)
+        self._coupling.pop(r + 1, None)
+
+    def add(self, r: int, i: int) -> float:
+        delta = float(self.delta_add(r, [i])[0])
+        self._update(r, i, +1)
+        return delta
+
+    def remove(self, r: int, i: int) -> float:
+        self._update(r, i, -1)
+        return -float(self.delta_add(r, [i])[0])
+
+    def delta_remove(self, r: int, i: int) -> float:
+        delta = self.remove(r, i)
+        self._update(r, i, +1)
+        return delta
+
+    def delta_swap(self, r: int, i: int, cands) -> np.ndarray:
+        """r 日目の i を cands の各レシピに入れ替えたときのエネルギー変化"""
+        removed = self.remove(r, i)
+        delta = removed + self.delta_add(r, cands)
+        self._update(r, i, +1)
+        return delta
+
+
+def repair_plan(
+    catalog: RecipeCatalog,
+    sol: np.ndarray,
+    *,
+    TARGET: dict,
+    W: dict,
+    H5_MODE: str = "practical",
+    frozen_days=(),
+    pins=(),
+    max_moves: int = REPAIR_MAX_MOVES,
+    time_limit_ms: int = REPAIR_TIME_LIMIT_MS,
+    local_search: bool = True,
+    dedupe: bool = True,
+) -> tuple[np.ndarray, dict]:
+    """
+    ソルバーの解を日 × カテゴリの枠単位で直し、局所探索で改善する
+
+    1. 枠の修復: 主食・主菜が無い日は最もエネルギーが下がるレシピを加え、1品を超える枠は
+       外して最もエネルギーが下がるものから外す
+    2. 重複の修復（dedupe）: 期間内で2回以上使ったレシピを、同じカテゴリの未使用レシピへ入れ替える
+    3. 局所探索（local_search）: 1枠の入れ替え・任意の枠の追加/削除（1-opt）と、
+       2日間での同じカテゴリの交換（2-opt）を、エネルギーが下がる限り max_moves 手・time_limit_ms まで行う
+       dedupe なら入れ替え先は期間内で未使用のレシピだけにする（H4 より栄養が勝って重複に戻さない）
+    frozen_days（0始まり）の日と pins の (レシピ, 日) は変えない。
+
+    Returns:
+        (修復後の解, 修復の記録 {"applied": [...], "energy_before", "energy_after", ...})
+    """
+    t_start = time.perf_counter()
+    deadline = t_start + float(time_limit_ms) / 1000.0
+    state = PlanState(catalog, sol, TARGET=TARGET, W=W, H5_MODE=H5_MODE)
+    S = state.S
+    M = state.M
+    frozen_days = set(frozen_days)
+    pinned = set(pins)
+    days = [r for r in range(M) if r not in frozen_days]
+    cat_members = {c: np.flatnonzero(catalog.cats == c) for c in REQ_CATS + OPT_CATS}
+    recipe_ids = catalog.df["recipe_id"]
+
+    before = evaluate_qubo_terms(catalog, S, TARGET=TARGET, H5_MODE=H5_MODE)
+    applied = []
+
+    def _record(action, r, c, removed=None, added=None, delta=0.0):
+        applied.append({
+            "action": action,
+            "day": r + 1,
+            "category": CATEGORY_NAME.get(c, str(c)),
+            "removed": None if removed is None else recipe_ids[int(removed)],
+            "added": None if added is None else recipe_ids[int(added)],
+            "delta": round(float(delta), 6),
+        })
+
+    def _chosen(r, c):
+        members = cat_members[c]
+        return members[S[members, r] > 0]
+
+    # 1. 枠の修復
+    for r in days:
+        for c in REQ_CATS + OPT_CATS:
+            members = cat_members[c]
+            if len(members) == 0:
+                continue
+            chosen = _chosen(r, c)
+            while len(chosen) > 1:
+                removable = [i for i in chosen if (int(i), r) not in pinned]
+                if not removable:
+                    break
+                deltas = [state.delta_remove(r, int(i)) for i in removable]
+                i = int(removable[int(np.argmin(deltas))])
+                _record("remove", r, c, removed=i, delta=state.remove(r, i))
+                chosen = _chosen(r, c)
+            if c in REQ_CATS and len(chosen) == 0:
+                i = int(members[int(np.argmin(state.delta_add(r, members)))])
+                _record("add", r, c, added=i, delta=state.add(r, i))
+
+    # 2. 重複の修復
+    for i in np.flatnonzero(state.k > 1) if dedupe else ():
+        i = int(i)
+        c = int(catalog.cats[i])
+        if c not in cat_members:
+            continue
+        while state.k[i] > 1:
+            best = None
+            for r in days:
+                if S[i, r] == 0 or (i, r) in pinned:
+                    continue
+                cands = cat_members[c][state.k[cat_members[c]] == 0]
+                if len(cands) == 0:
+                    break
+                deltas = state.delta_swap(r, i, cands)
+                j = int(np.argmin(deltas))
+                if best is None or deltas[j] < best[0]:
+                    best = (float(deltas[j]), r, int(cands[j]))
+            if best is None:
+                break
+            _, r, j = best
+            delta = state.remove(r, i) + state.add(r, j)
+            _record("dedupe", r, c, removed=i, added=j, delta=delta)
+
+    repair_moves = len(applied)
+
+    # 3. 局所探索
+    improved = local_search
+    while improved and len(applied) - repair_moves < max_moves and time.perf_counter() < deadline:
+        improved = False
+        # 1-opt：枠ごとに最もエネルギーが下がる入れ替え・追加・削除を1手
+        for r in days:
+            for c in REQ_CATS + OPT_CATS:
+                members = cat_members[c]
+                if len(members) == 0 or time.perf_counter() >= deadline:
+                    continue
+                chosen = _chosen(r, c)
+                if len(chosen) > 1:
+                    continue
+                if len(chosen) == 1:
+                    i = int(chosen[0])
+                    if (i, r) in pinned:
+                        continue
+                    cands = members[(members != i) & ((state.k[members] == 0) if dedupe else True)]
+                    if len(cands) == 0:
+                        continue
+                    deltas = state.delta_swap(r, i, cands)
+                    j = int(np.argmin(deltas))
+                    best_delta, move = float(deltas[j]), ("swap", i, int(cands[j]))
+                    if c in OPT_CATS:
+                        drop = state.delta_remove(r, i)
+                        if drop < best_delta:
+                            best_delta, move = drop, ("drop", i, None)
+                else:
+                    if c in REQ_CATS:
+                        continue
+                    cands = members[state.k[members] == 0] if dedupe else members
+                    if len(cands) == 0:
+                        continue
+                    deltas = state.delta_add(r, cands)
+                    j = int(np.argmin(deltas))
+                    best_delta, move = float(deltas[j]), ("fill", None, int(cands[j]))
+                if best_delta >= -1e-9:
+                    continue
+
+                action, i, j = move
+                delta = (state.remove(r, i) if i is not None else 0.0) + (state.add(r, j) if j is not None else 0.0)
+                _record(action, r, c, removed=i, added=j, delta=delta)
+                improved = True
+                if len(applied) - repair_moves >= max_moves:
+                    break
+            if len(applied) - repair_moves >= max_moves:
+                break
+
+        # 2-opt：同じカテゴリの2日間で品目を交換（H3・H4 は変わらず H2・H5・H7 が変わる）
+        for c in REQ_CATS + OPT_CATS:
+            for a_idx, r in enumerate(days):
+                for rp in days[a_idx + 1:]:
+                    if len(applied) - repair_moves >= max_moves or time.perf_counter() >= deadline:
+                        break
+                    ci, cj = _chosen(r, c), _chosen(rp, c)
+                    if len(ci) != 1 or len(cj) != 1:
+                        continue
+                    i, j = int(ci[0]), int(cj[0])
+                    if i == j or (i, r) in pinned or (j, rp) in pinned:
+                        continue
+                    delta = state.remove(r, i) + state.remove(rp, j) + state.add(r, j) + state.add(rp, i)
+                    if delta < -1e-9:
+                        _record("exchange", r, c, removed=i, added=j, delta=delta)
+                        applied[-1]["with_day"] = rp + 1
+                        improved = True
+                    else:
+                        state.remove(r, j)
+                        state.remove(rp, i)
+                        state.add(r, i)
+                        state.add(rp, j)
+
+    after = evaluate_qubo_terms(catalog, S, TARGET=TARGET, H5_MODE=H5_MODE)
+
+    def _energy(terms):
+        return float(np.sum([float(W[k]) * v for k, v in terms.items()]))
+
+    report = {
+        "applied": applied,
+        "repairs": repair_moves,
+        "improvements": len(applied) - repair_moves,
+        "energy_before": _energy(before),
+        "energy_after": _energy(after),
+        "terms_before": before,
+        "terms_after": after,
+        "time": round(time.perf_counter() - t_start, 4),
+    }
+    return S, report
+
+
+def add_repair_meta(response: dict, report: dict = None):
+    """repair_plan の記録を meta.repair に、所要時間を meta.timings.repair に入れる"""
+    if report is None:
+        return
+    response["meta"]["repair"] = report
+    response["meta"]["timings"]["repair"] = report["time"]
+
+
+# ============
+# 候補の絞り込み（QUBO を作る前に、季節外・単品で目標を超えるレシピを外す）
+# ============
+# 1品だけで1日の目標値（TARGET）のこの倍率を超えるレシピは候補から外す
+PRUNE_MAX_NUTRIENT_RATIO = {"エネルギー": 1.0, "たんぱく質": 1.0, "脂質": 1.0, "ナトリウム": 1.0}
+# 1品だけで1日あたりのコスト目標（cost / M）のこの倍率を超えるレシピは候補から外す
+PRUNE_MAX_COST_RATIO = 1.0
+
+
+def prune_candidates(
+    catalog: RecipeCatalog,
+    *,
+    M: int,
+    TARGET: dict,
+    month: int = None,
+    max_nutrient_ratio: dict = None,
+    max_cost_ratio: float = None,
+    categories: dict = None,
+    keep_recipe_ids=(),
+):
+    """
+    候補レシピを絞り込んだカタログと集計を返す
+
+    - month（1〜12）が指定されれば is_month でその月に出せないレシピを外す
+    - 栄養素ごとに「1品で1日の目標値 × 倍率」を、コストは「1品で1日あたりの目標 × 倍率」を超えるレシピを外す。
+      倍率は PRUNE_MAX_NUTRIENT_RATIO / PRUNE_MAX_COST_RATIO を max_nutrient_ratio / max_cost_ratio で上書きし、
+      categories（カテゴリid → {"max_nutrient_ratio": ..., "max_cost_ratio": ...}）でカテゴリごとにさらに上書きできる
+    - 絞り込みでカテゴリが空になる場合は、そのカテゴリだけ季節の絞り込みのみに戻す
+    - keep_recipe_ids（locked のレシピなど）は必ず残す
+
+    Returns:
+        (catalog, report): 候補だけのカタログ（減らなければ元のまま）と、外した件数などの集計
+    """
+    N = catalog.N
+    base_nut = dict(PRUNE_MAX_NUTRIENT_RATIO)
+    base_nut.update(max_nutrient_ratio or {})
+    base_cost = PRUNE_MAX_COST_RATIO if max_cost_ratio is None else max_cost_ratio
+
+    month_ok = catalog.is_month[:, month - 1] if month else np.ones(N, dtype=bool)
+    nutrient_ok = np.ones(N, dtype=bool)
+    cost_ok = np.ones(N, dtype=bool)
+    day_cost_target = float(TARGET["cost"]) / M
+
+    for c in np.unique(catalog.cats):
+        mask = catalog.cats == c
+        bounds = (categories or {}).get(int(c), {})
+        nut_ratio = dict(base_nut)
+        nut_ratio.update(bounds.get("max_nutrient_ratio") or {})
+        for k_idx, key in enumerate(catalog.NUT_KEYS):
+            ratio = nut_ratio.get(key)
+            if ratio is not None:
+                nutrient_ok &= ~(mask & (catalog.nut[:, k_idx] > float(ratio) * float(TARGET[key])))
+        cost_ratio = bounds.get("max_cost_ratio", base_cost)
+        if cost_ratio is not None:
+            cost_ok &= ~(mask & (catalog.recipe_cost > float(cost_ratio) * day_cost_target))
+
+    keep = month_ok & nutrient_ok & cost_ok
+
+    relaxed = []
+    for c in REQ_CATS + OPT_CATS:
+        mask = catalog.cats == c
+        if mask.any() and not (keep & mask).any():
+            fallback = mask & month_ok
+            keep |= fallback if fallback.any() else mask
+            relaxed.append(CATEGORY_NAME.get(c, str(c)))
+
+    for rid in keep_recipe_ids:
+        i = catalog.recipe_index.get(rid)
+        if i is not None:
+            keep[i] = True
+
+    idx = np.flatnonzero(keep)
+    report = {
+        "month": month,
+        "candidates_before": int(N),
+        "candidates_after": int(len(idx)),
+        "removed_by": {
+            "month": int((~month_ok).sum()),
+            "nutrient": int((~nutrient_ok).sum()),
+            "cost": int((~cost_ok).sum()),
+        },
+        "relaxed_categories": relaxed,
+        "variables_before": int(N * M),
+        "variables_after": int(len(idx) * M),
+        "variables_removed": int((N - len(idx)) * M),
+    }
+    if len(idx) == N:
+        return catalog, report
+    return catalog.subset(idx), report
+
+
+# ============
+# 固定した日・レシピを残して解き直す（locked）
+# ============
+def fix_qubo_variables(Q: np.ndarray, p: np.ndarray, const: float, fixed: np.ndarray):
+    """
+    一部の変数に定数を代入した QUBO を返す
+
+    fixed は p と同形で、-1 が自由変数、0/1 がその値に固定する変数。
+    x = x_free + v（v は固定値）として x^T Q x + p·x + c を展開し、自由変数だけの式にする。
+
+    Returns:
+        (Q_free, p_free, const, free): 自由変数だけの二次係数（n_free×n_free）・一次係数（n_free）・定数、
+        自由変数のマスク（p を平らにした並び）
+    """
+    n = p.size
+    Q2 = Q.reshape(n, n)
+    p1 = p.reshape(n)
+    fx = fixed.reshape(n)
+    free = fx < 0
+    if free.all():
+        return Q2, p1, const, free
+
+    v = np.where(free, 0.0, fx).astype(float)
+    Qv = Q2 @ v
+    cross = Qv + Q2.T @ v
+    p_free = p1[free] + cross[free]
+    const = float(const) + float(v @ Qv) + float(p1 @ v)
+    Q_free = Q2[np.ix_(free, free)]
+    return Q_free, p_free, const, free
+
+
+def solve_menu_locked(
+    catalog: RecipeCatalog,
+    *,
+    M: int,
+    TARGET: dict,
+    W: dict,
+    H5_MODE: str = "practical",
+    solver: str = "amplify",
+    solver_options: dict = None,
+    locked: list,
+    constraints: str = "penalty",
+    repair: dict = None,
+):
+    """
+    locked の割り当てを固定したまま残りだけを解き、solve_menu と同じ形式で返す
+
+    locked は {"day": 1始まり, "recipe_id": ..., "mode": "day" | "pin"} のリスト。
+      - mode="day": その日の献立を、その日に "day" で指定したレシピだけに固定する
+      - mode="pin": その日にそのレシピを必ず入れる（他の品目は自由）
+    固定した日は QUBO を作る前に取り除き、残りの日への影響を代入で反映する:
+      - H3: 期間のコスト目標から固定した日のコストを引く
+      - H4: 固定した日での各レシピの採用回数を一次項として加える
+      - H7: 固定した日と隣接する日に、その日の選択を一次項として加える
+    pin の変数は作った QUBO に定数として代入し、ソルバーには自由な変数だけを渡す。
+    constraints="one_hot" なら pin した枠の他のレシピも 0 に固定し、残りの枠を制約として渡す。
+    repair では固定した日と pin したレシピは変えない。
+    """
+    N = catalog.N
+    w4, w7 = float(W["H4"]), float(W["H7"])
+
+    day_locks = defaultdict(list)
+    pins = []
+    for entry in locked:
+        i = catalog.recipe_index.get(entry["recipe_id"])
+        if i is None:
+            raise OptimizeRequestError(f"locked recipe_id {entry['recipe_id']} is not in the catalog.")
+        r = int(entry["day"]) - 1
+        if not 0 <= r < M:
+            raise OptimizeRequestError(f"locked day must be between 1 and {M}.")
+        if entry.get("mode", "day") == "day":
+            day_locks[r].append(i)
+        else:
+            pins.append((i, r))
+
+    sol = np.zeros((N, M), dtype=np.int8)
+    for r, idxs in day_locks.items():
+        sol[idxs, r] = 1
+    for i, r in pins:
+        if r in day_locks:
+            sol[i, r] = 1  # 固定した日への pin はその日の献立に加える
+
+    free_days = [r for r in range(M) if r not in day_locks]
+    n_free = 0
+    stats = {"variables": 0, "quadratic_terms": 0, "linear_terms": 0}
+    stats.update(constraint_stats(catalog.cats, 0, constraints))
+    build_time = solver_time = 0.0
+
+    if free_days:
+        with qubo_memory.reserve(N, len(free_days), solver):
+            t0 = time.perf_counter()
+            M_free = len(free_days)
+            d = build_day_adjacency(M)[np.ix_(free_days, free_days)]
+
+            # H3：固定した日のコストを目標から引く
+            free_target = dict(TARGET)
+            free_target["cost"] = float(TARGET["cost"]) - float(catalog.recipe_cost @ sol.sum(axis=1))
+
+            Q, p, const = build_qubo_coefficients(
+                catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost,
+                catalog.top_neighbors, catalog.top_sim, d,
+                M=M_free, NUT_KEYS=catalog.NUT_KEYS, TARGET=free_target, W=model_weights(W, constraints),
+                H5_MODE=H5_MODE,
+            )
+
+            # H4：固定した日での採用回数 k_i → Σ_r 2 k_i x[i, r]
+            k_fixed = sol.sum(axis=1).astype(float)
+            p += 2.0 * w4 * k_fixed[:, None]
+
+            # H7：固定した隣接日の選択
+            C = build_neighbor_coupling(catalog.genres, catalog.top_neighbors, catalog.top_sim)
+            C_sym = (C + C.T).tocsr()
+            for c, r in enumerate(free_days):
+                for rp in (r - 1, r + 1):
+                    if rp in day_locks:
+                        p[:, c] += w7 * (C_sym @ sol[:, rp].astype(float))
+
+            # pin：自由な日の変数を 1 に固定して代入
+            fixed = np.full((N, M_free), -1, dtype=np.int8)
+            for i, r in pins:
+                if r not in day_locks:
+                    fixed[i, free_days.index(r)] = 1
+
+            groups = None
+            if constraints == "one_hot":
+                groups = restrict_groups(one_hot_groups(catalog.cats, M_free), fixed)
+
+            Q_free, p_free, const_free, free = fix_qubo_variables(Q, p, const, fixed)
+            n_free = int(free.sum())
+            stats = qubo_stats(Q_free, p_free)
+            stats.update(constraint_stats(catalog.cats, M_free, constraints, groups))
+            build_time = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            x_free, _ = SOLVER_BACKENDS[solver](Q_free, p_free, const_free, groups=groups, **(solver_options or {}))
+            solver_time = time.perf_counter() - t0
+
+            block = np.where(fixed < 0, 0, fixed).reshape(-1)
+            block[free] = np.asarray(x_free).reshape(-1)
+            sol[:, free_days] = block.reshape(N, M_free)
+            del Q, Q_free
+
+    repair_report = None
+    if repair:
+        sol, repair_report = repair_plan(
+            catalog, sol, TARGET=TARGET, W=W, H5_MODE=H5_MODE,
+            frozen_days=day_locks.keys(), pins=pins, **repair,
+        )
+
+    terms = evaluate_qubo_terms(catalog, sol, TARGET=TARGET, H5_MODE=H5_MODE)
+    energy = float(np.sum([float(W[k]) * v for k, v in terms.items()]))
+
+    t0 = time.perf_counter()
+    plan, checks = decode_plan(catalog, sol)
+    decode_time = time.perf_counter() - t0
+
+    response = {
+        "meta": {
+            "M": M,
+            "N_candidates": catalog.N,
+            "target": TARGET,
+            "weights": W,
+            "h5_mode": H5_MODE,
+            "topk_sim": catalog.topk_sim,
+            "catalog_version": catalog.version,
+            "solver": solver,
+            "solver_time": round(solver_time, 4),
+            "energy": energy,
+            "qubo": stats,
+            "timings": {
+                "build_model": round(build_time, 4),
+                "solve": round(solver_time, 4),
+                "decode": round(decode_time, 4),
+            },
+            "locked": {
+                "days": [r + 1 for r in sorted(day_locks)],
+                "pins": [{"day": r + 1, "recipe_id": catalog.df["recipe_id"][i]} for i, r in pins],
+                "free_variables": n_free,
+            },
+        },
+        "plan": plan,
+        "checks": checks,
+    }
+    add_repair_meta(response, repair_report)
+
+    return response
+
+
+# ============
+# 分割求解（月単位の献立を週ブロックに分けて並列に解く）
+# ============
+DECOMPOSE_BLOCK_DAYS = 5
+DECOMPOSE_ROUNDS = 1
+DECOMPOSE_MAX_WORKERS = 4
+
+
+def _solve_block(catalog, *, M_block, TARGET, W, H5_MODE, solver, solver_options, extra_linear,
+                 constraints="penalty"):
+    """1ブロックを解く。Returns: (解, QUBO の規模, 組み立て秒数, ソルバー秒数)"""
+    with qubo_memory.reserve(catalog.N, M_block, solver):
+        t0 = time.perf_counter()
+        d = build_day_adjacency(M_block)
+        Q, p, const = build_qubo_coefficients(
+            catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost,
+            catalog.top_neighbors, catalog.top_sim, d,
+            M=M_block, NUT_KEYS=catalog.NUT_KEYS, TARGET=TARGET, W=model_weights(W, constraints), H5_MODE=H5_MODE,
+        )
+        p += extra_linear
+        groups = one_hot_groups(catalog.cats, M_block) if constraints == "one_hot" else None
+        stats = qubo_stats(Q, p)
+        stats.update(constraint_stats(catalog.cats, M_block, constraints, groups))
+        build_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        sol, _ = SOLVER_BACKENDS[solver](Q, p, const, groups=groups, **(solver_options or {}))
+        return sol, stats, build_time, time.perf_counter() - t0
+
+
+def solve_menu_decomposed(
+    catalog: RecipeCatalog,
+    *,
+    M: int,
+    TARGET: dict,
+    W: dict,
+    H5_MODE: str = "practical",
+    solver: str = "amplify",
+    solver_options: dict = None,
+    block_days: int = DECOMPOSE_BLOCK_DAYS,
+    rounds: int = DECOMPOSE_ROUNDS,
+    max_workers: int = DECOMPOSE_MAX_WORKERS,
+    constraints: str = "penalty",
+    repair: dict = None,
+):
+    """
+    M日を block_days 日ごとのブロックに分けて解き、solve_menu と同じ形式で返す
+
+    偶数番目・奇数番目のブロックを交互に解く（同じ組のブロック同士は隣接しないので並列に解ける）。
+    各ブロックでは、既に決まっている他ブロックの日を固定値として代入する:
+      - H7: 境界の隣接日の選択を一次項として加える
+      - H4: 他ブロックでの各レシピの採用回数を一次項として加える
+      - H3: 期間コスト目標から他ブロックの実コスト（未確定の日は日割りの目標）を引いた残りを配分する
+    最初の偶奇2フェーズの後、rounds 回だけ同じ手順で全ブロックを解き直す。
+    """
+    if solver not in SOLVER_BACKENDS:
+        raise ValueError(f"solver must be one of {sorted(SOLVER_BACKENDS)}.")
+    block_days = int(block_days)
+    if block_days < 1:
+        raise ValueError("block_days must be >= 1.")
+    if M <= block_days:
+        return solve_menu(
+            catalog, M=M, TARGET=TARGET, W=W, H5_MODE=H5_MODE,
+            solver=solver, solver_options=solver_options, constraints=constraints, repair=repair,
+        )
+
+    N = catalog.N
+    w4, w7 = float(W["H4"]), float(W["H7"])
+    C = build_neighbor_coupling(catalog.genres, catalog.top_neighbors, catalog.top_sim)
+    C_sym = (C + C.T).tocsr()
+    T_cost = float(TARGET["cost"])
+
+    blocks = [(s, min(s + block_days, M)) for s in range(0, M, block_days)]
+    phases = [blocks[0::2], blocks[1::2]] * (1 + max(0, int(rounds)))
+
+    sol = np.zeros((N, M), dtype=np.int8)
+    assigned = np.zeros(M, dtype=bool)
+    phase_times = []
+    stats = {"variables": 0, "quadratic_terms": 0, "linear_terms": 0}
+    stats.update(constraint_stats(catalog.cats, 0, constraints))
+    build_time = 0.0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        for phase in phases:
+            # 期間コストの見込み（確定した日は実コスト、未確定の日は日割り目標）
+            day_cost = catalog.recipe_cost @ sol
+            expected = np.where(assigned, day_cost, T_cost / M)
+            phase_days = sum(e - s for s, e in phase)
+            residual = T_cost - float(expected.sum())
+
+            futures = []
+            for s, e in phase:
+                # H4 は確定済みの他ブロックを見る。同じフェーズで解き直すブロック同士は
+                # 互いに避け合って振動しないよう、前のブロックだけを見る（後ろが譲る）
+                outside = assigned.copy()
+                for s2, e2 in phase:
+                    if s2 >= s:
+                        outside[s2:e2] = False
+
+                extra = np.zeros((N, e - s), dtype=float)
+                # H4：他ブロックでの採用回数 k_i → Σ_r 2 k_i x[i, r]
+                k_out = sol[:, outside].sum(axis=1).astype(float)
+                extra += 2.0 * w4 * k_out[:, None]
+                # H7：境界の隣接日（確定済みのもの）
+                if s > 0 and assigned[s - 1]:
+                    extra[:, 0] += w7 * (C_sym @ sol[:, s - 1].astype(float))
+                if e < M and assigned[e]:
+                    extra[:, -1] += w7 * (C_sym @ sol[:, e].astype(float))
+
+                block_target = dict(TARGET)
+                block_target["cost"] = float(expected[s:e].sum()) + residual * (e - s) / phase_days
+
+                # 同じ形のブロックが同じ解にならないようシードをずらす
+                block_options = dict(solver_options or {})
+                block_options["seed"] = int(block_options.get("seed", 0)) + s
+
+                futures.append(((s, e), pool.submit(
+                    _solve_block, catalog,
+                    M_block=e - s, TARGET=block_target, W=W, H5_MODE=H5_MODE,
+                    solver=solver, solver_options=block_options, extra_linear=extra,
+                    constraints=constraints,
+                )))
+
+            tp = time.perf_counter()
+            for (s, e), fut in futures:
+                block_sol, block_stats, block_build, _ = fut.result()
+                sol[:, s:e] = block_sol
+                assigned[s:e] = True
+                for k, v in block_stats.items():
+                    if k != "constraints":
+                        stats[k] += v
+                build_time += block_build
+            phase_times.append(round(time.perf_counter() - tp, 4))
+    solver_time = time.perf_counter() - t0
+
+    repair_report = None
+    if repair:
+        sol, repair_report = repair_plan(catalog, sol, TARGET=TARGET, W=W, H5_MODE=H5_MODE, **repair)
+
+    terms = evaluate_qubo_terms(catalog, sol, TARGET=TARGET, H5_MODE=H5_MODE)
+    energy = float(np.sum([float(W[k]) * v for k, v in terms.items()]))
+
+    t0 = time.perf_counter()
+    plan, checks = decode_plan(catalog, sol)
+    decode_time = time.perf_counter() - t0
+
+    response = {
+        "meta": {
+            "M": M,
+            "N_candidates": catalog.N,
+            "target": TARGET,
+            "weights": W,
+            "h5_mode": H5_MODE,
+            "topk_sim": catalog.topk_sim,
+            "catalog_version": catalog.version,
+            "solver": solver,
+            "solver_time": round(solver_time, 4),
+            "energy": energy,
+            # ブロックごとの QUBO・組み立て秒数の合計（solve は各ブロックの組み立てを含む全フェーズの経過時間）
+            "qubo": stats,
+            "timings": {
+                "build_model": round(build_time, 4),
+                "solve": round(solver_time, 4),
+                "decode": round(decode_time, 4),
+            },
+            "decompose": {
+                "block_days": block_days,
+                "blocks": [[s + 1, e] for s, e in blocks],
+                "rounds": int(rounds),
+                "phase_times": phase_times,
+            },
+        },
+        "plan": plan,
+        "checks": checks,
+    }
+    add_repair_meta(response, repair_report)
+
+    return response
+
+
+# ============
+# 重みのスイープ（同じ項を重みだけ変えて並列に解く）
+# ============
+SWEEP_MAX_VARIANTS = int(os.getenv("OPTIMIZE_SWEEP_MAX_VARIANTS", "16"))
+SWEEP_MAX_WORKERS = int(os.getenv("OPTIMIZE_SWEEP_MAX_WORKERS", "4"))
+SWEEP_TOP_K = 3
+SWEEP_MAX_TOP_K = 10
+
+
+def is_feasible_terms(terms: dict) -> bool:
+    """カテゴリ制約（H1）を満たすか。H1 は主食・主菜が各日1品、他カテゴリが1品以下のとき 0"""
+    return terms["H1"] < 1e-9
+
+
+def solve_menu_sweep(
+    catalog: RecipeCatalog,
+    *,
+    M: int,
+    TARGET: dict,
+    weights: list[dict],
+    H5_MODE: str = "practical",
+    solver: str = "amplify",
+    solver_options: dict = None,
+    top_k: int = SWEEP_TOP_K,
+    max_workers: int = SWEEP_MAX_WORKERS,
+    constraints: str = "penalty",
+):
+    """
+    重みの組み合わせ（weights）ごとに解き、それぞれの上位の異なる実行可能な献立を返す
+
+    H1〜H7 の項は QuboTerms で1回だけ組み立て、重みごとに combine した QUBO を並列に解く。
+    ソルバーが返した複数の解（Amplify の全解・ローカルソルバーの局所最適解）を項ごとに評価し、
+    異なる献立を、カテゴリ制約を満たすものを先にエネルギー順で top_k 件まで残す。
+    組み合わせごとに密な QUBO（N×M×N×M）を持つので、同時に解くのは max_workers 個までのうち
+    qubo_memory の上限に収まる数だけ（1個で上限を超えるなら組み立てる前に OptimizeRequestError）。
+    """
+    if solver not in SOLVER_BACKENDS:
+        raise ValueError(f"solver must be one of {sorted(SOLVER_BACKENDS)}.")
+    qubo_memory.check(catalog.N, M, solver)
+
+    t0 = time.perf_counter()
+    d = build_day_adjacency(M)
+    terms = QuboTerms(
+        catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost,
+        catalog.top_neighbors, catalog.top_sim, d,
+        M=M, NUT_KEYS=catalog.NUT_KEYS, TARGET=TARGET, H5_MODE=H5_MODE,
+    )
+    groups = one_hot_groups(catalog.cats, M) if constraints == "one_hot" else None
+    terms_time = time.perf_counter() - t0
+
+    def _solve_variant(idx, W):
+        # 組み合わせごとに密な Q を持つので、同時に解く数は qubo_memory の空きで決まる
+        with qubo_memory.reserve(catalog.N, M, solver):
+            t0 = time.perf_counter()
+            Q, p, const = terms.combine(model_weights(W, constraints))
+            stats = qubo_stats(Q, p)
+            stats.update(constraint_stats(catalog.cats, M, constraints, groups))
+            build_time = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            found = []
+            sol, energy = SOLVER_BACKENDS[solver](
+                Q, p, const, solutions=found, groups=groups, **(solver_options or {}),
+            )
+            solve_time = time.perf_counter() - t0
+            del Q
+        if not found:
+            found = [(sol, energy)]
+
+        t0 = time.perf_counter()
+        candidates, seen = [], set()
+        for cand, _ in found:
+            key = cand.astype(np.int8).tobytes()
+            if key in seen:
+                continue
+            seen.add(key)
+            # one_hot ではソルバーのエネルギーに H1 が入らないので、どちらの形式も項から求め直す
+            values = evaluate_qubo_terms(catalog, cand, TARGET=TARGET, H5_MODE=H5_MODE)
+            cand_energy = float(np.sum([float(W[k]) * v for k, v in values.items()]))
+            candidates.append((not is_feasible_terms(values), cand_energy, cand, values))
+        # 実行可能な解を先に、その中はエネルギー順（実行可能な解が足りなければ違反のある解で埋める）
+        candidates.sort(key=lambda item: (item[0], item[1]))
+
+        plans = []
+        for rank, (infeasible, cand_energy, cand, values) in enumerate(candidates[:top_k], start=1):
+            plan, checks = decode_plan(catalog, cand)
+            plans.append({
+                "rank": rank,
+                "feasible": not infeasible,
+                "energy": cand_energy,
+                "terms": values,
+                "weighted_terms": {k: float(W[k]) * v for k, v in values.items()},
+                "plan": plan,
+                "checks": checks,
+            })
+        decode_time = time.perf_counter() - t0
+        feasible = int(np.sum([not item[0] for item in candidates]))
+
+        return {
+            "variant": idx,
+            "weights": W,
+            "energy": min(item[1] for item in candidates),
+            "solutions_found": len(candidates),
+            "feasible_solutions": feasible,
+            "feasibility_rate": round(feasible / len(candidates), 4),
+            "qubo": stats,
+            "timings": {
+                "build_model": round(build_time, 4),
+                "solve": round(solve_time, 4),
+                "decode": round(decode_time, 4),
+            },
+            "plans": plans,
+        }
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix="optimize-sweep") as pool:
+        variants = list(pool.map(_solve_variant, range(len(weights)), weights))
+    solver_time = time.perf_counter() - t0
+
+    return {
+        "meta": {
+            "M": M,
+            "N_candidates": catalog.N,
+            "target": TARGET,
+            "h5_mode": H5_MODE,
+            "topk_sim": catalog.topk_sim,
+            "catalog_version": catalog.version,
+            "solver": solver,
+            "solver_time": round(solver_time, 4),
+            "variants": len(variants),
+            "top_k": int(top_k),
+            "max_workers": int(max_workers),
+            # 重みが 0 の項があると変わるので、1番目の組み合わせの規模
+            "qubo": variants[0]["qubo"] if variants else None,
+            # build_model は項の組み立て1回（build_terms）と組み合わせごとの combine の合計
+            "timings": {
+                "build_terms": round(terms_time, 4),
+                "build_model": round(terms_time + sum(v["timings"]["build_model"] for v in variants), 4),
+                "solve": round(solver_time, 4),
+                "decode": round(sum(v["timings"]["decode"] for v in variants), 4),
+            },
+        },
+        "variants": variants,
+    }
+
+
+# ---- CORS設定 ----
+CORS_ORIGIN = "*"  # 特定ドメインに絞るなら "https://example.com"
+
+def _add_cors_headers(resp):
+    resp.headers["Access-Control-Allow-Origin"] = CORS_ORIGIN
+    resp.headers["Vary"] = "Origin"  # 将来 origin を絞る可能性があるなら有益
+    resp.headers["Access-Control-Allow-Methods"] = "POST, GET, DELETE, OPTIONS"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match"
+    resp.headers["Access-Control-Expose-Headers"] = "ETag"
+    resp.headers["Access-Control-Max-Age"] = "3600"
+    return resp
+
+# ============
+# 最適化結果キャッシュ（同じ入力・同じカタログなら再計算しない）
+# ============
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "128"))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400"))
+# "1" にすると Postgres の optimize_result_cache テーブルも参照・保存する（再起動後・複数インスタンスで共有）
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", "0") == "1"
+
+
+def optimize_cache_key(params: dict, catalog_version: str) -> str:
+    """ソルバー入力とカタログのバージョンから正規化したハッシュを作る"""
+    decompose = params["decompose"]
+    if decompose:
+        decompose_options = decompose if isinstance(decompose, dict) else {}
+        decompose = {
+            "block_days": int(decompose_options.get("block_days", DECOMPOSE_BLOCK_DAYS)),
+            "rounds": int(decompose_options.get("rounds", DECOMPOSE_ROUNDS)),
+        }
+
+    key_source = {
+        "catalog_version": catalog_version,
+        "M": params["M"],
+        "TARGET": params["TARGET"],
+        "W": params["W"],
+        "h5_mode": params["h5_mode"],
+        "solver": params["solver"],
+        "solver_options": params["solver_options"],
+        "decompose": decompose,
+        "locked": params["locked"],
+        "prune": params["prune"],
+        "constraints": params["constraints"],
+        "repair": params["repair"],
+    }
+    canonical = json.dumps(key_source, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """件数上限と有効期限つきの LRU。値は JSON 文字列で持ち、取り出すたびに新しい dict に戻す"""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return json.loads(entry[1])
+
+    def put(self, key: str, value: dict):
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_SECONDS)
+
+
+def load_cached_result_from_db(cache_key: str):
+    """optimize_result_cache から有効期限内の結果を取得（失敗しても None を返すだけ）"""
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT result
+                FROM optimize_result_cache
+                WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP
+            """, (cache_key,))
+            row = cur.fetchone()
+            cur.close()
+        if row is None:
+            return None
+        result = row[0]
+        if isinstance(result, str):
+            result = json.loads(result)
+        return result
+    except Exception as e:
+        print(f"[WARN] Result cache lookup failed: {str(e)}")
+        return None
+
+
+def save_cached_result_to_db(cache_key: str, catalog_version: str, result: dict):
+    """optimize_result_cache に結果を保存（同じキーは上書き、失敗しても例外は出さない）"""
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO optimize_result_cache (cache_key, catalog_version, result, created_at, expires_at)
+                VALUES (%s, %s, %s::jsonb, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+                ON CONFLICT (cache_key) DO UPDATE
+                SET catalog_version = EXCLUDED.catalog_version,
+                    result = EXCLUDED.result,
+                    created_at = EXCLUDED.created_at,
+                    expires_at = EXCLUDED.expires_at
+            """, (cache_key, catalog_version, json.dumps(result, ensure_ascii=False), RESULT_CACHE_TTL_SECONDS))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"[WARN] Result cache save failed: {str(e)}")
+
+
+class OptimizeRequestError(ValueError):
+    """/optimize のリクエスト不正。status に返すHTTPステータスを持つ"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_prune_options(prune, target_year_month):
+    """
+    リクエストの "prune" を prune_candidates の引数にまとめる（false なら絞り込みなし）
+
+    month は prune.month、無ければ target_year_month（YYYY-MM / YYYY-MM-DD）の月。どちらも無ければ季節では絞らない。
+    """
+    if prune is False or prune is None:
+        return False
+    if prune is True:
+        prune = {}
+    if not isinstance(prune, dict):
+        raise OptimizeRequestError("prune must be a boolean or an object.")
+
+    try:
+        month = prune.get("month")
+        if month is None and target_year_month:
+            month = str(target_year_month)[5:7]
+        month = int(month) if month else None
+    except (TypeError, ValueError):
+        raise OptimizeRequestError("prune.month / target_year_month must give a month (1-12).")
+    if month is not None and not 1 <= month <= 12:
+        raise OptimizeRequestError("prune.month must be between 1 and 12.")
+
+    def _bounds(options, where):
+        if not isinstance(options, dict):
+            raise OptimizeRequestError(f"{where} must be an object.")
+        nut_ratio = options.get("max_nutrient_ratio") or {}
+        cost_ratio = options.get("max_cost_ratio")
+        try:
+            nut_ratio = {str(k): (None if v is None else float(v)) for k, v in nut_ratio.items()}
+            cost_ratio = None if cost_ratio is None else float(cost_ratio)
+        except (AttributeError, TypeError, ValueError):
+            raise OptimizeRequestError(f"{where} ratios must be numbers.")
+        return nut_ratio, cost_ratio
+
+    max_nutrient_ratio, max_cost_ratio = _bounds(prune, "prune")
+
+    # カテゴリは id（"0"）でも名前（"主菜"）でも指定できる
+    name_to_cat = {name: c for c, name in CATEGORY_NAME.items()}
+    categories = {}
+    for key, options in (prune.get("categories") or {}).items():
+        c = name_to_cat.get(key)
+        if c is None:
+            try:
+                c = int(key)
+            except (TypeError, ValueError):
+                raise OptimizeRequestError(f"unknown category in prune.categories: {key}")
+        nut_ratio, cost_ratio = _bounds(options, f"prune.categories.{key}")
+        bounds = {"max_nutrient_ratio": nut_ratio}
+        if "max_cost_ratio" in options:
+            bounds["max_cost_ratio"] = cost_ratio
+        categories[c] = bounds
+
+    return {
+        "month": month,
+        "max_nutrient_ratio": max_nutrient_ratio,
+        "max_cost_ratio": max_cost_ratio,
+        "categories": categories,
+    }
+
+
+def parse_repair_options(repair):
+    """リクエストの "repair" を repair_plan の引数にまとめる（false なら修復しない）"""
+    if repair is False or repair is None:
+        return False
+    if repair is True:
+        repair = {}
+    if not isinstance(repair, dict):
+        raise OptimizeRequestError("repair must be a boolean or an object.")
+    try:
+        max_moves = int(repair.get("max_moves", REPAIR_MAX_MOVES))
+        time_limit_ms = int(repair.get("time_limit_ms", REPAIR_TIME_LIMIT_MS))
+    except (TypeError, ValueError):
+        raise OptimizeRequestError("repair.max_moves and repair.time_limit_ms must be numbers.")
+    if max_moves < 0 or time_limit_ms < 0:
+        raise OptimizeRequestError("repair.max_moves and repair.time_limit_ms must be >= 0.")
+    return {
+        "max_moves": max_moves,
+        "time_limit_ms": time_limit_ms,
+        "local_search": bool(repair.get("local_search", True)),
+        "dedupe": bool(repair.get("dedupe", True)),
+    }
+
+
+def parse_weight_overrides(overrides, base: dict, where: str) -> dict:
+    """base の重み係数を overrides（{"H2": 0.05} のように一部の項だけ）で上書きした dict を返す"""
+    W = dict(base)
+    if overrides is None:
+        return W
+    if not isinstance(overrides, dict):
+        raise OptimizeRequestError(f"{where} must be an object.")
+    for key, value in overrides.items():
+        if key not in W:
+            raise OptimizeRequestError(f"unknown weight in {where}: {key}")
+        try:
+            W[key] = float(value)
+        except (TypeError, ValueError):
+            raise OptimizeRequestError(f"{where}.{key} must be a number.")
+        if not np.isfinite(W[key]) or W[key] < 0:
+            raise OptimizeRequestError(f"{where}.{key} must be a non-negative number.")
+    return W
+
+
+def parse_optimize_request(body: dict) -> dict:
+    """
+    /optimize のリクエストボディを検証し、最適化パラメータにまとめる
+
+    Raises:
+        OptimizeRequestError: 入力不正（400）や AMPLIFY_TOKEN 未設定（500）
+    """
+    # --- request body例 ---
+    # {
+    #   "M": 5,
+    #   "cost": 1500.0,
+    #   "school_id": 1,                          # 保存先の学校。単価もこの学校の food_costs を使う
+    #   "use_school_prices": true,               # false なら学校ごとの単価を使わない
+    #   "target_year_month": "2026-03-01",
+    #   "save_to_db": true,
+    #   "solver": "local",                       # "amplify"（既定） or "local"
+    #   "solver_options": {"sweeps": 20, "time_limit_ms": 5000, "seed": 0},
+    #   "decompose": {"block_days": 5, "rounds": 1},  # true なら既定値で週ブロックに分割
+    #   "locked": [{"day": 1, "recipe_id": 183}],  # 固定する日・レシピ（"mode": "pin" なら品目だけ固定）
+    #   "prune": {"max_cost_ratio": 1.0},         # 候補の絞り込み（true で既定の条件、既定は無効）
+    #   "force_resolve": false,                  # true なら結果キャッシュを使わずに解き直す
+    #   "save_weekly": false,                    # true なら5日ごとの週に分けて target_week 1〜 で保存
+    #   "replace_existing": false,               # true なら同じ週の保存済み献立を置き換える
+    #   "target": {"エネルギー": 650.0},         # 1日あたりの栄養目標（省略した栄養素は既定値）
+    #   "weights": {"H2": 0.05},                 # 重み係数（省略した項は既定値）
+    #   "constraints": "one_hot",                # カテゴリ枠を制約で扱う（既定は "penalty" = H1）
+    #   "repair": {"max_moves": 200}             # 解いた後の修復・局所探索（true か設定で有効、既定は無効）
+    # }
+    try:
+        M = int(body.get("M", 5))
+        cost = int(body.get("cost", 1500.0))
+    except (TypeError, ValueError):
+        raise OptimizeRequestError("M and cost must be numbers.")
+    if M < 1:
+        raise OptimizeRequestError("M must be >= 1.")
+    if cost <= 0:
+        raise OptimizeRequestError("cost must be > 0.")
+    try:
+        school_id = int(body.get("school_id", DEFAULT_SCHOOL_ID))
+    except (TypeError, ValueError):
+        raise OptimizeRequestError("school_id must be an integer.")
+
+    solver = body.get("solver", "amplify")
+    solver_options = body.get("solver_options") or {}
+    decompose = body.get("decompose") or False
+    h5_mode = "practical"
+
+    TARGET = {
+        "エネルギー": 650.0,
+        "たんぱく質": 20.0,
         "脂質": 18.0,
         "ナトリウム": 1000.0,
-        "cost": int(body.get("cost", 1500.0)),   # M日合計
+        "cost": cost,   # M日合計
+    }
+
+    target_override = body.get("target") or {}
+    if not isinstance(target_override, dict):
+        raise OptimizeRequestError("target must be an object.")
+    for key, value in target_override.items():
+        if key not in TARGET or key == "cost":
+            raise OptimizeRequestError(f"unknown target: {key}")
+        try:
+            TARGET[key] = float(value)
+        except (TypeError, ValueError):
+            raise OptimizeRequestError(f"target.{key} must be a number.")
+
+    W = {
+        "H1": 80.0,
+        "H2": 0.03,
+        "H3": 0.006,
+        "H4": 20.0,
+        "H5": 0.2,
+        "H7": 0.2,
+    }
+    W = parse_weight_overrides(body.get("weights"), W, "weights")
+
+    if solver not in SOLVER_BACKENDS:
+        raise OptimizeRequestError(f"solver must be one of {sorted(SOLVER_BACKENDS)}.")
+    if not isinstance(solver_options, dict):
+        raise OptimizeRequestError("solver_options must be an object.")
+    if not isinstance(decompose, (bool, dict)):
+        raise OptimizeRequestError("decompose must be a boolean or an object.")
+    constraints = body.get("constraints", "penalty")
+    if constraints not in CONSTRAINT_FORMULATIONS:
+        raise OptimizeRequestError(f"constraints must be one of {list(CONSTRAINT_FORMULATIONS)}.")
+
+    # locked: [{"day": 1, "recipe_id": 183, "mode": "day" | "pin"}]（日は1始まり）
+    locked_raw = body.get("locked") or []
+    if not isinstance(locked_raw, list):
+        raise OptimizeRequestError("locked must be a list of {day, recipe_id} objects.")
+    locked = []
+    for entry in locked_raw:
+        if not isinstance(entry, dict) or "recipe_id" not in entry:
+            raise OptimizeRequestError("locked must be a list of {day, recipe_id} objects.")
+        try:
+            day = int(entry.get("day"))
+        except (TypeError, ValueError):
+            raise OptimizeRequestError("locked day must be a number.")
+        if not 1 <= day <= M:
+            raise OptimizeRequestError(f"locked day must be between 1 and {M}.")
+        mode = entry.get("mode", "day")
+        if mode not in ("day", "pin"):
+            raise OptimizeRequestError("locked mode must be 'day' or 'pin'.")
+        locked.append({"day": day, "recipe_id": entry["recipe_id"], "mode": mode})
+    locked.sort(key=lambda e: (e["day"], e["mode"], str(e["recipe_id"])))
+    if locked and decompose:
+        raise OptimizeRequestError("locked cannot be combined with decompose.")
+
+    # 絞り込むと候補・結果キャッシュのキーが変わるので、指定したときだけ行う
+    prune = parse_prune_options(body.get("prune", False), body.get("target_year_month"))
+    repair = parse_repair_options(body.get("repair", False))
+
+    save_weekly = bool(body.get("save_weekly", False))
+    if save_weekly and -(-M // SCHOOL_WEEK_DAYS) > MAX_TARGET_WEEK:
+        raise OptimizeRequestError(
+            f"save_weekly supports at most {SCHOOL_WEEK_DAYS * MAX_TARGET_WEEK} days (M={M})."
+        )
+
+    if solver == "amplify" and not os.getenv("AMPLIFY_TOKEN"):
+        raise OptimizeRequestError("AMPLIFY_TOKEN is not set in environment variables.", status=500)
+
+    return {
+        "M": M,
+        "TARGET": TARGET,
+        "W": W,
+        "h5_mode": h5_mode,
+        "solver": solver,
+        "solver_options": solver_options,
+        "decompose": decompose,
+        "locked": locked,
+        "prune": prune,
+        "constraints": constraints,
+        "repair": repair,
+        "force_resolve": bool(body.get("force_resolve", False)),
+        "school_id": school_id,
+        "use_school_prices": bool(body.get("use_school_prices", True)),
+        "save_to_db": body.get("save_to_db", False),
+        "target_year_month": body.get("target_year_month"),
+        "target_week": body.get("target_week"),  # フロントエンドから受け取る（1〜5、NULLも可）
+        "save_weekly": save_weekly,
+        "replace_existing": bool(body.get("replace_existing", False)),
+    }
+
+
+def solve_with_params(catalog: RecipeCatalog, params: dict) -> dict:
+    """
+    parse_optimize_request のパラメータで solve_menu / solve_menu_decomposed を呼ぶ
+
+    prune が有効なら、先に候補を絞り込んだカタログで解き、meta.prune に集計を付ける。
+    """
+    prune = params["prune"]
+    prune_report = None
+    if prune:
+        catalog, prune_report = prune_candidates(
+            catalog,
+            M=params["M"],
+            TARGET=params["TARGET"],
+            month=prune["month"],
+            max_nutrient_ratio=prune["max_nutrient_ratio"],
+            max_cost_ratio=prune["max_cost_ratio"],
+            categories=prune["categories"],
+            keep_recipe_ids=[entry["recipe_id"] for entry in params["locked"]],
+        )
+
+    result = _solve_with_params(catalog, params)
+    if prune_report is not None:
+        result["meta"]["prune"] = prune_report
+    return result
+
+
+def _solve_with_params(catalog: RecipeCatalog, params: dict) -> dict:
+    decompose = params["decompose"]
+    if decompose:
+        decompose_options = decompose if isinstance(decompose, dict) else {}
+        return solve_menu_decomposed(
+            catalog,
+            M=params["M"],
+            TARGET=params["TARGET"],
+            W=params["W"],
+            H5_MODE=params["h5_mode"],
+            solver=params["solver"],
+            solver_options=params["solver_options"],
+            block_days=int(decompose_options.get("block_days", DECOMPOSE_BLOCK_DAYS)),
+            rounds=int(decompose_options.get("rounds", DECOMPOSE_ROUNDS)),
+            max_workers=int(decompose_options.get("max_workers", DECOMPOSE_MAX_WORKERS)),
+            constraints=params["constraints"],
+            repair=params["repair"],
+        )
+    return solve_menu(
+        catalog,
+        M=params["M"],
+        TARGET=params["TARGET"],
+        W=params["W"],
+        H5_MODE=params["h5_mode"],
+        solver=params["solver"],
+        solver_options=params["solver_options"],
+        locked=params["locked"],
+        constraints=params["constraints"],
+        repair=params["repair"],
+    )
+
+
+# ============
+# 保存用の献立データ（compact 形式）
+# ============
+MENU_DATA_FORMAT = "compact"
+MENU_DATA_FORMAT_VERSION = 2
+# "0" にすると従来どおり最適化結果をそのまま school_menus.menu_data に保存する
+MENU_DATA_COMPACT = os.getenv("MENU_DATA_COMPACT", "1") == "1"
+
+
+def is_compact_menu_data(menu_data) -> bool:
+    return isinstance(menu_data, dict) and menu_data.get("format") == MENU_DATA_FORMAT
+
+
+def menu_unit_costs(menu_data: dict) -> dict:
+    """献立のレシピの食材ごとのグラム単価（{str(food_id): 単価}、JSONB のキーに合わせて文字列）"""
+    unit_costs = {}
+    for day in (menu_data.get("plan") or {}).get("days") or []:
+        for rec in day.get("recipes") or []:
+            if not isinstance(rec, dict):
+                continue
+            for ing in rec.get("ingredients") or []:
+                if ing.get("food_id") is not None and ing.get("unit_cost") is not None:
+                    unit_costs[str(ing["food_id"])] = ing["unit_cost"]
+    return unit_costs
+
+
+def compact_menu_data(menu_data: dict, catalog_version: str = None, price_version: str = None) -> dict:
+    """
+    最適化結果（または従来形式で保存された menu_data）を compact 形式にする
+
+    各日のレシピは recipe_id だけにし、日別集計・合計コストとカタログ（レシピ・価格表）のバージョンを残す。
+    レシピの詳細（栄養・食材）は読み出し時に rehydrate_menu_data でカタログから復元する。
+    単価は学校ごと・時期ごとに変わるので、解いたときの食材ごとの単価（unit_costs）を残して復元に使う。
+
+    catalog_version: 単価を差し替える前のカタログのバージョン（RecipeCatalog.base_version）
+    price_version: 解いたカタログのバージョン（学校の単価なら {catalog_version}-{単価のハッシュ}）
+    """
+    if is_compact_menu_data(menu_data):
+        return menu_data
+
+    plan = menu_data.get("plan") or {}
+    meta = menu_data.get("meta") or {}
+    days = [
+        {
+            "day": day.get("day", r + 1),
+            "recipe_ids": [rec.get("id") if isinstance(rec, dict) else rec for rec in (day.get("recipes") or [])],
+        }
+        for r, day in enumerate(plan.get("days") or [])
+    ]
+    price_version = price_version or meta.get("catalog_version")
+    return {
+        "format": MENU_DATA_FORMAT,
+        "format_version": MENU_DATA_FORMAT_VERSION,
+        "catalog_version": catalog_version or price_version,
+        "price_version": price_version,
+        "unit_costs": menu_unit_costs(menu_data),
+        "plan": {
+            "days": days,
+            "daily_totals": plan.get("daily_totals") or [],
+            "total_cost": plan.get("total_cost"),
+        },
+    }
+
+
+def recipe_summary(catalog: RecipeCatalog, i: int) -> dict:
+    """view=summary 用のレシピ情報（/get_menu の MENU_SUMMARY_SQL と同じ項目）"""
+    return {
+        "id": catalog.df["recipe_id"][i],
+        "title": catalog.df["title"][i],
+        "category": int(catalog.cats[i]),
+        "category_name": catalog.df["category_name"][i],
+    }
+
+
+def priced_recipe_detail(detail: dict, unit_costs: dict) -> dict:
+    """
+    レシピの詳細の単価・金額を、保存した食材ごとの単価（unit_costs）で付け直す
+
+    unit_costs に無い食材（保存後にレシピへ追加された食材）はカタログの単価のまま。
+    """
+    ingredients = []
+    for ing in detail["ingredients"]:
+        unit_cost = unit_costs.get(str(ing["food_id"])) if ing["food_id"] is not None else None
+        if unit_cost is not None:
+            ing = dict(ing, unit_cost=float(unit_cost))
+            if ing["amount_g"] is not None:
+                ing["cost"] = ing["amount_g"] * ing["unit_cost"]
+        ingredients.append(ing)
+    recipe_cost = sum(ing["cost"] for ing in ingredients if ing["cost"] is not None)
+    return dict(detail, ingredients=ingredients, recipe_cost=float(recipe_cost))
+
+
+def rehydrate_menu_data(catalog: RecipeCatalog, menu_data: dict, *, summary: bool = False) -> dict:
+    """
+    compact 形式の menu_data を、従来の保存形式（plan.days[].recipes[] に詳細）に戻す
+
+    summary=True なら view=summary と同じ形（レシピは id・タイトル・カテゴリだけ、checks なし）にする。
+    現在のカタログに無いレシピは {"id": ..., "missing": true} になる。
+    単価・金額は保存した unit_costs で付け直すので、日別集計・合計コスト（保存時の値をそのまま返す）と合う。
+    unit_costs の無い行（format_version 1）は catalog の単価になり、解いたときの単価と違いうる
+    （meta.prices が "catalog"、meta.catalog_version_mismatch で区別できる）。
+    """
+    plan = menu_data.get("plan") or {}
+    unit_costs = menu_data.get("unit_costs")
+    days = []
+    checks = {"per_day_category_counts": []}
+    for day in plan.get("days") or []:
+        details = []
+        for rid in day.get("recipe_ids") or []:
+            i = catalog.recipe_index.get(rid)
+            if i is None:
+                details.append({"id": rid, "missing": True})
+            elif summary:
+                details.append(recipe_summary(catalog, i))
+            elif unit_costs is not None:
+                details.append(priced_recipe_detail(catalog.recipe_details[i], unit_costs))
+            else:
+                details.append(catalog.recipe_details[i])
+        days.append({"day": day.get("day"), "recipes": details})
+        checks["per_day_category_counts"].append({"day": day.get("day"), "counts": category_counts(details)})
+
+    rehydrated_plan = {
+        "days": days,
+        "daily_totals": plan.get("daily_totals") or [],
+        "total_cost": plan.get("total_cost"),
+    }
+    if summary:
+        return {"plan": rehydrated_plan}
+
+    return {
+        "meta": {
+            "storage_format": MENU_DATA_FORMAT,
+            "catalog_version": menu_data.get("catalog_version"),
+            "price_version": menu_data.get("price_version", menu_data.get("catalog_version")),
+            "rehydrated_catalog_version": catalog.version,
+            "catalog_version_mismatch": menu_data.get("catalog_version") != catalog.version,
+            "prices": "saved" if unit_costs is not None else "catalog",
+        },
+        "plan": rehydrated_plan,
+        "checks": checks,
+    }
+
+
+SCHOOL_WEEK_DAYS = 5   # 1週 = 5営業日（フロントの週の割り当てと同じ）
+MAX_TARGET_WEEK = 5    # school_menus.target_week の上限
+
+
+def nutrition_average(daily_totals: list[dict]) -> dict:
+    """日別集計から平均栄養価を計算（school_menus.total_nutrition_avg 用）"""
+    total_nutrition_avg = {}
+    if len(daily_totals) > 0:
+        # 各栄養素の平均を計算
+        nutrition_keys = ["エネルギー", "たんぱく質", "脂質", "ナトリウム"]
+        for key in nutrition_keys:
+            total = sum(day["totals"].get(key, 0) for day in daily_totals if "totals" in day)
+            total_nutrition_avg[key] = round(float(total) / len(daily_totals), 2)
+    return total_nutrition_avg
+
+
+def split_result_by_week(result: dict, week_days: int = SCHOOL_WEEK_DAYS) -> list[dict]:
+    """
+    最適化結果を week_days 日ごとの週に分ける（各週の day は 1 から振り直す）
+
+    meta・checks 以外は元の結果と同じ形式で、plan だけがその週の分になる。
+    """
+    plan = result.get("plan", {})
+    days = plan.get("days", [])
+    daily_totals = plan.get("daily_totals", [])
+
+    weeks = []
+    for start in range(0, len(days), week_days):
+        week_days_list = [dict(day, day=i + 1) for i, day in enumerate(days[start:start + week_days])]
+        week_totals = [dict(tot, day=i + 1) for i, tot in enumerate(daily_totals[start:start + week_days])]
+        week_plan = {
+            "days": week_days_list,
+            "daily_totals": week_totals,
+            "total_cost": float(sum(tot["totals"]["cost"] for tot in week_totals)),
+        }
+        week_result = {k: v for k, v in result.items() if k != "plan"}
+        week_result["plan"] = week_plan
+        weeks.append(week_result)
+    return weeks
+
+
+# ============
+# 計測（/metrics と recommendation_logs）
+# ============
+DEFAULT_SCHOOL_ID = 1  # 固定値（横須賀市小学校）
+
+# /optimize の段階（レスポンスの meta.timings と get_catalog の再構築時の秒数から集める）
+OPTIMIZE_STAGES = ("load", "preprocess", "similarity", "build_model", "solve", "repair", "decode", "save")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+RECOMMENDATION_LOG_ENABLED = os.getenv("RECOMMENDATION_LOG_ENABLED", "1") == "1"
+RECOMMENDATION_LOG_QUEUE_SIZE = int(os.getenv("RECOMMENDATION_LOG_QUEUE_SIZE", "1000"))
+RECOMMENDATION_LOG_BATCH_SIZE = int(os.getenv("RECOMMENDATION_LOG_BATCH_SIZE", "50"))
+
+
+class Metrics:
+    """
+    Prometheus のテキスト形式で出すカウンタとヒストグラム（プロセス内で集計）
+
+    複数プロセスで動かす場合は各プロセスの値がそれぞれ返るので、集計は Prometheus 側で行う
+    （/metrics では全系列に pid ラベルを付けて、どのプロセスの値か区別できるようにする）。
+    """
+
+    HELP = {
+        "optimize_runs_total": ("counter", "Optimize runs by endpoint and status."),
+        "optimize_errors_total": ("counter", "Optimize errors by endpoint and kind."),
+        "optimize_cache_total": ("counter", "Result cache lookups by result (hit_memory, hit_db, miss, forced)."),
+        "optimize_plan_days_total": ("counter", "Planned days by constraint formulation and category feasibility."),
+        "recommendation_logs_total": ("counter", "recommendation_logs rows by result (written, failed, dropped)."),
+        "optimize_stage_seconds": ("histogram", "Optimize stage durations in seconds."),
+        "optimize_duration_seconds": ("histogram", "Total optimize run duration in seconds."),
+    }
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # (name, labels) -> [バケットごとの件数..., 合計, 件数]
+        self._histograms = {}
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, labels: dict = None, value: float = 1.0):
+        with self._lock:
+            self._counters[(name, self._labels(labels))] += value
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        key = (name, self._labels(labels))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for n, upper in enumerate(self.buckets):
+                if value <= upper:
+                    h[n] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def render(self, prefix: str = "school_menu_", gauges: dict = None, const_labels: dict = None) -> str:
+        """
+        gauges: {名前: 値} を一緒に出す（出力時に読む値。プールの接続数など）
+        const_labels: 全系列に付けるラベル（{"pid": ...} など）
+        """
+        const = self._labels(const_labels)
+        with self._lock:
+            counters = {(n, const + labels): v for (n, labels), v in self._counters.items()}
+            histograms = {(n, const + labels): list(v) for (n, labels), v in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in self.HELP.items():
+            lines.append(f"# HELP {prefix}{name} {help_text}")
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+            if kind == "counter":
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{prefix}{name}{self._format_labels(labels)} {value:g}")
+                continue
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for upper, count in zip(self.buckets, h):
+                    le = labels + (("le", f"{upper:g}"),)
+                    lines.append(f"{prefix}{name}_bucket{self._format_labels(le)} {count}")
+                lines.append(f"{prefix}{name}_bucket{self._format_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+                lines.append(f"{prefix}{name}_sum{self._format_labels(labels)} {h[-2]:g}")
+                lines.append(f"{prefix}{name}_count{self._format_labels(labels)} {h[-1]}")
+
+        for name, value in (gauges or {}).items():
+            if value is None:
+                continue
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name}{self._format_labels(const)} {float(value):g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class RecommendationLogWriter:
+    """
+    recommendation_logs への書き込みをバックグラウンドのスレッドでまとめて行う
+
+    submit はキューに積むだけなのでリクエストの待ち時間は増えない。キューが一杯なら捨てて数える。
+    書き込みに失敗したバッチも捨てる（ログのためにリクエストを失敗させない）。
+    """
+
+    def __init__(self, queue_size: int, batch_size: int):
+        self.batch_size = max(1, batch_size)
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, row: tuple) -> bool:
+        """row: (school_id, solver_time, total_time, parameters)"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="recommendation-log", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            metrics.inc("recommendation_logs_total", {"result": "dropped"})
+            return False
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            row = self._queue.get()
+            if row is None:
+                return
+            batch = [row]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    row = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                batch.append(row)
+            self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch: list):
+        values_sql = ", ".join(["(%s, %s, %s, %s::jsonb, CURRENT_TIMESTAMP)"] * len(batch))
+        args = []
+        for school_id, solver_time, total_time, parameters in batch:
+            args.extend([school_id, solver_time, total_time, json.dumps(parameters, ensure_ascii=False)])
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(f"""
+                    INSERT INTO recommendation_logs (school_id, solver_time, total_time, parameters, created_at)
+                    VALUES {values_sql}
+                """, tuple(args))
+                conn.commit()
+                cur.close()
+            metrics.inc("recommendation_logs_total", {"result": "written"}, len(batch))
+        except Exception as e:
+            print(f"[WARN] recommendation_logs write failed ({len(batch)} rows): {str(e)}")
+            metrics.inc("recommendation_logs_total", {"result": "failed"}, len(batch))
+
+    def close(self, timeout: float = 5.0):
+        """キューに残った分を書き終えるまで最大 timeout 秒待つ"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+
+recommendation_logs = RecommendationLogWriter(RECOMMENDATION_LOG_QUEUE_SIZE, RECOMMENDATION_LOG_BATCH_SIZE)
+atexit.register(recommendation_logs.close)
+
+
+def record_optimize_run(params: dict, *, endpoint: str, spans: dict, total_time: float,
+                        result: dict = None, error: Exception = None, sweep_weights: list = None):
+    """
+    1回の最適化をメトリクスに集計し、recommendation_logs に書き込む（キューに積むだけ）
+
+    spans: 段階ごとの秒数（OPTIMIZE_STAGES のうち、その回に実行したもの）
+    sweep_weights: /optimize/sweep の重みの組み合わせ（weights は既定の重みのまま残す）
+    """
+    status = "ok" if error is None else "error"
+    metrics.inc("optimize_runs_total", {"endpoint": endpoint, "status": status})
+    metrics.observe("optimize_duration_seconds", total_time, {"endpoint": endpoint})
+    for stage, seconds in spans.items():
+        metrics.observe("optimize_stage_seconds", seconds, {"stage": stage})
+    if error is not None:
+        kind = "bad_request" if isinstance(error, OptimizeRequestError) else "internal"
+        metrics.inc("optimize_errors_total", {"endpoint": endpoint, "kind": kind})
+
+    meta = (result or {}).get("meta", {})
+    cache = meta.get("cache") or {}
+    if cache:
+        if cache.get("hit"):
+            outcome = f"hit_{cache.get('source')}"
+        else:
+            outcome = "forced" if cache.get("forced") else "miss"
+        metrics.inc("optimize_cache_total", {"result": outcome})
+
+    # 解いた回だけ、カテゴリ制約を満たした日・満たさなかった日を数える（形式ごとの実行可能率）
+    feasibility = ((result or {}).get("checks") or {}).get("feasibility")
+    if feasibility and not cache.get("hit"):
+        labels = {"constraints": params["constraints"]}
+        metrics.inc("optimize_plan_days_total", dict(labels, feasible="true"), feasibility["feasible_days"])
+        metrics.inc("optimize_plan_days_total", dict(labels, feasible="false"),
+                    feasibility["days"] - feasibility["feasible_days"])
+
+    if not RECOMMENDATION_LOG_ENABLED:
+        return
+
+    parameters = {
+        "endpoint": endpoint,
+        "status": status,
+        "num_days": params["M"],
+        "target": params["TARGET"],
+        "weights": params["W"],
+        "h5_mode": params["h5_mode"],
+        "solver": params["solver"],
+        "solver_options": params["solver_options"],
+        "decompose": params["decompose"],
+        "locked": len(params["locked"]),
+        "prune": bool(params["prune"]),
+        "constraints": params["constraints"],
+        "repair": bool(params["repair"]),
+        "catalog_version": meta.get("catalog_version"),
+        "N_candidates": meta.get("N_candidates"),
+        "qubo": None if cache.get("hit") else meta.get("qubo"),
+        "cache": {"hit": cache.get("hit"), "source": cache.get("source")} if cache else None,
+        "timings": spans,
+    }
+    if sweep_weights is not None:
+        parameters["sweep_weights"] = sweep_weights
+    if error is not None:
+        parameters["error"] = str(error)[:500]
+    school_id = params.get("school_id", DEFAULT_SCHOOL_ID)
+    recommendation_logs.submit((school_id, spans.get("solve"), round(total_time, 5), parameters))
+
+
+def run_optimize(params: dict, timings: dict = None, cancel_event: threading.Event = None,
+                 endpoint: str = "optimize") -> dict:
+    """
+    献立を最適化し、必要ならデータベースに保存する
+
+    timings には各段階（catalog / solve / save）の所要時間（秒）を終わったものから書き込む。
+    cancel_event がセットされていれば保存を行わずに打ち切る。
+    成否にかかわらず、段階ごとの秒数を /metrics に集計し recommendation_logs に非同期で書き込む。
+    """
+    if timings is None:
+        timings = {}
+    spans = {}
+
+    t_start = time.perf_counter()
+    try:
+        result = _run_optimize(params, timings, spans, cancel_event)
+    except Exception as e:
+        record_optimize_run(params, endpoint=endpoint, spans=spans,
+                            total_time=time.perf_counter() - t_start, error=e)
+        raise
+    record_optimize_run(params, endpoint=endpoint, spans=spans,
+                        total_time=time.perf_counter() - t_start, result=result)
+    return result
+
+
+def _run_optimize(params: dict, timings: dict, spans: dict, cancel_event: threading.Event = None) -> dict:
+    t0 = time.perf_counter()
+    catalog = get_catalog(timings=spans)
+    timings["catalog"] = round(time.perf_counter() - t0, 4)
+
+    t0 = time.perf_counter()
+    catalog = school_catalog(catalog, params)
+    timings["prices"] = round(time.perf_counter() - t0, 4)
+
+    t0 = time.perf_counter()
+    result = solve_cached(catalog, params, spans)
+    timings["solve"] = round(time.perf_counter() - t0, 4)
+
+    if cancel_event is not None and cancel_event.is_set():
+        return result
+
+    # データベースに保存（オプション）
+    save_to_db = params["save_to_db"]
+    print(f"[DEBUG] save_to_db: {save_to_db}")  # デバッグログ
+
+    if save_to_db:
+        t0 = time.perf_counter()
+        print("[DEBUG] Starting database save...")  # デバッグログ
+        records = menu_records(result, params, catalog)
+
+        # データベースに保存（全週を1トランザクションで）
+        try:
+            menu_ids = save_menus_to_db(records, replace=params["replace_existing"])
+            print(f"[DEBUG] Successfully saved to database. menu_ids: {menu_ids}")  # デバッグログ
+
+            # レスポンスにmenu_idを追加
+            result["saved_menu_id"] = menu_ids[0]
+            if params["save_weekly"]:
+                result["saved_menu_ids"] = menu_ids
+        except Exception as db_error:
+            print(f"[ERROR] Database save failed: {str(db_error)}")  # エラーログ
+            import traceback
+            traceback.print_exc()  # 詳細なスタックトレースを出力
+            # エラーが発生してもレスポンスは返す（保存失敗を通知）
+            result["save_error"] = str(db_error)
+        timings["save"] = round(time.perf_counter() - t0, 4)
+        spans["save"] = timings["save"]
+
+    return result
+
+
+def solve_cached(catalog: RecipeCatalog, params: dict, spans: dict) -> dict:
+    """結果キャッシュを引き、無ければ解いてキャッシュに入れる（meta.cache に利用状況を付ける）"""
+    cache_key = optimize_cache_key(params, catalog.version)
+    result, cache_source = None, None
+    if not params["force_resolve"]:
+        result = result_cache.get(cache_key)
+        cache_source = "memory" if result is not None else None
+        if result is None and RESULT_CACHE_DB:
+            result = load_cached_result_from_db(cache_key)
+            if result is not None:
+                cache_source = "db"
+                result_cache.put(cache_key, result)
+
+    if result is None:
+        result = solve_with_params(catalog, params)
+        spans.update(result["meta"].get("timings", {}))
+
+    if cache_source is None:
+        result_cache.put(cache_key, result)
+        if RESULT_CACHE_DB:
+            save_cached_result_to_db(cache_key, catalog.version, result)
+    result["meta"]["cache"] = {
+        "hit": cache_source is not None,
+        "source": cache_source,
+        "key": cache_key,
+        "forced": params["force_resolve"],
+    }
+    return result
+
+
+def menu_records(result: dict, params: dict, catalog: RecipeCatalog) -> list[tuple]:
+    """最適化結果を save_menus_to_db に渡す行にする（save_weekly なら週ごとに分ける）"""
+    school_id = params.get("school_id", DEFAULT_SCHOOL_ID)
+    target_year_month = params["target_year_month"]
+    target_week = params["target_week"]
+
+    if not target_year_month:
+        # target_year_monthが指定されていない場合は現在の年月を使用
+        now = datetime.now()
+        target_year_month = f"{now.year}-{now.month:02d}"
+    else:
+        # YYYY-MM-DD形式の場合はYYYY-MMに変換
+        if len(target_year_month) == 10:  # YYYY-MM-DD
+            target_year_month = target_year_month[:7]  # YYYY-MM
+
+    print(f"[DEBUG] school_id: {school_id}, target_year_month: {target_year_month}, target_week: {target_week}")  # デバッグログ
+
+    # 保存する献立（save_weekly なら5日ごとの週に分けて1週目から順に）
+    if params["save_weekly"]:
+        menus = list(enumerate(split_result_by_week(result), start=1))
+    else:
+        menus = [(target_week, result)]
+
+    records = []
+    for menu_week, menu_result in menus:
+        plan = menu_result.get("plan", {})
+        total_nutrition_avg = nutrition_average(plan.get("daily_totals", []))
+        print(f"[DEBUG] target_week: {menu_week}, total_nutrition_avg: {total_nutrition_avg}")  # デバッグログ
+
+        # total_costを整数に変換（データベースのINT型に合わせる）
+        total_cost_int = int(round(float(plan.get("total_cost", 0))))
+        menu_data = (
+            compact_menu_data(menu_result, catalog.base_version, catalog.version) if MENU_DATA_COMPACT else menu_result
+        )
+        records.append((school_id, target_year_month, menu_week, menu_data, total_cost_int, total_nutrition_avg))
+
+    return records
+
+
+@app.route("/optimize", methods=["POST", "OPTIONS"])
+def optimize_kondate():
+    # --- Preflight ---
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    body = request.get_json(silent=True) or {}
+
+    try:
+        params = parse_optimize_request(body)
+    except OptimizeRequestError as e:
+        metrics.inc("optimize_errors_total", {"endpoint": "optimize", "kind": "bad_request"})
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), e.status
+
+    try:
+        result = run_optimize(params)
+        resp = jsonify(result)
+        return _add_cors_headers(resp), 200
+
+    except OptimizeRequestError as e:
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), e.status
+
+    except Exception as e:
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), 500
+
+
+# ============
+# 複数校の一括最適化（/optimize/batch）
+# ============
+BATCH_MAX_SCHOOLS = int(os.getenv("OPTIMIZE_BATCH_MAX_SCHOOLS", "50"))
+BATCH_MAX_WORKERS = int(os.getenv("OPTIMIZE_BATCH_MAX_WORKERS", "4"))
+
+
+def parse_batch_request(body: dict) -> tuple[list[dict], dict]:
+    """
+    /optimize/batch のリクエストボディを学校ごとの最適化パラメータにする
+
+    schools 以外のフィールドは全校共通の既定値で、schools[] の各要素で上書きできる（形式は /optimize と同じ）。
+
+    Returns:
+        (学校ごとの params（"school_id" 付き）, オプション {"use_school_prices", "max_workers"})
+    """
+    schools = body.get("schools")
+    if not isinstance(schools, list) or not schools:
+        raise OptimizeRequestError("schools must be a non-empty list.")
+    if len(schools) > BATCH_MAX_SCHOOLS:
+        raise OptimizeRequestError(f"schools must have at most {BATCH_MAX_SCHOOLS} entries.")
+
+    try:
+        max_workers = int(body.get("max_workers", BATCH_MAX_WORKERS))
+    except (TypeError, ValueError):
+        raise OptimizeRequestError("max_workers must be a number.")
+    options = {
+        "use_school_prices": bool(body.get("use_school_prices", True)),
+        "max_workers": max(1, min(max_workers, BATCH_MAX_WORKERS)),
+    }
+
+    common = {k: v for k, v in body.items() if k not in ("schools", "use_school_prices", "max_workers")}
+    school_params = []
+    seen = set()
+    for entry in schools:
+        if not isinstance(entry, dict):
+            raise OptimizeRequestError("schools must be a list of objects.")
+        try:
+            school_id = int(entry.get("school_id"))
+        except (TypeError, ValueError):
+            raise OptimizeRequestError("schools[].school_id must be an integer.")
+        if school_id in seen:
+            raise OptimizeRequestError(f"school_id {school_id} is listed more than once.")
+        seen.add(school_id)
+
+        try:
+            params = parse_optimize_request({**common, **entry})
+        except OptimizeRequestError as e:
+            raise OptimizeRequestError(f"school_id {school_id}: {e}", status=e.status)
+        params["school_id"] = school_id
+        params["use_school_prices"] = options["use_school_prices"]
+        school_params.append(params)
+
+    return school_params, options
+
+
+def params_qubo_bytes(N: int, params: dict) -> int:
+    """parse_optimize_request のパラメータで1度に組み立てる QUBO の見積もり（decompose はブロック1つ分）"""
+    M = params["M"]
+    decompose = params["decompose"]
+    if decompose:
+        options = decompose if isinstance(decompose, dict) else {}
+        M = min(M, int(options.get("block_days", DECOMPOSE_BLOCK_DAYS)))
+    return qubo_bytes(N, M, params["solver"])
+
+
+def run_optimize_batch(school_params: list[dict], *, use_school_prices: bool = True,
+                       max_workers: int = BATCH_MAX_WORKERS) -> dict:
+    """
+    複数校の献立を、共有カタログから作った学校ごとの単価で並列に解き、保存分はまとめて保存する
+
+    1校の失敗は他校に影響させず、その学校の結果に error を入れる。
+    学校ごとに密な QUBO を組み立てるので、並列数は max_workers と、最も大きい学校の QUBO の見積もりが
+    qubo_memory の上限にいくつ収まるかの小さい方にする（上限を超える学校はその学校だけ error）。
+    学校ごとの単価は school_price_cache から取る（food_costs の変更はウォーターマークで検知して読み直す）。
+    保存は全校分を1トランザクション（replace_existing の有無で最大2回）にまとめる。
+    """
+    t_start = time.perf_counter()
+    timings = {}
+    catalog_spans = {}
+
+    t0 = time.perf_counter()
+    catalog = get_catalog(timings=catalog_spans)
+    timings["catalog"] = round(time.perf_counter() - t0, 4)
+
+    t0 = time.perf_counter()
+    school_ids = [params["school_id"] for params in school_params]
+    if use_school_prices:
+        entries = school_price_cache.lookup(catalog, school_ids)
+        catalogs = {sid: entry[0] for sid, entry in entries.items()}
+        coverage = {sid: entry[1] for sid, entry in entries.items()}
+    else:
+        catalogs = {sid: catalog for sid in school_ids}
+        coverage = {sid: price_coverage(catalog) for sid in school_ids}
+    timings["prices"] = round(time.perf_counter() - t0, 4)
+
+    # カタログの再構築は全校で1回なので、メトリクスにも1回だけ数える
+    for stage, seconds in catalog_spans.items():
+        metrics.observe("optimize_stage_seconds", seconds, {"stage": stage})
+
+    def _solve_school(params):
+        spans = {}
+        t0 = time.perf_counter()
+        try:
+            result = solve_cached(catalogs[params["school_id"]], params, spans)
+            return {"result": result, "spans": spans, "elapsed": time.perf_counter() - t0, "error": None}
+        except Exception as e:
+            print(f"[ERROR] Batch optimize failed for school_id={params['school_id']}: {str(e)}")
+            return {"result": None, "spans": spans, "elapsed": time.perf_counter() - t0, "error": e}
+
+    largest = max(params_qubo_bytes(catalogs[params["school_id"]].N, params) for params in school_params)
+    max_workers = max(1, min(int(max_workers), qubo_memory.limit // max(1, largest)))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="optimize-batch") as pool:
+        outcomes = list(pool.map(_solve_school, school_params))
+    timings["solve"] = round(time.perf_counter() - t0, 4)
+
+    # 保存（replace_existing ごとに1トランザクション）
+    t0 = time.perf_counter()
+    groups = defaultdict(list)
+    for params, outcome in zip(school_params, outcomes):
+        if outcome["error"] is None and params["save_to_db"]:
+            records = menu_records(outcome["result"], params, catalogs[params["school_id"]])
+            groups[params["replace_existing"]].append((params, outcome, records))
+
+    for replace, entries in groups.items():
+        try:
+            menu_ids = save_menus_to_db([r for _, _, records in entries for r in records], replace=replace)
+        except Exception as db_error:
+            print(f"[ERROR] Batch database save failed: {str(db_error)}")
+            for _, outcome, _ in entries:
+                outcome["result"]["save_error"] = str(db_error)
+            continue
+        offset = 0
+        for params, outcome, records in entries:
+            ids = menu_ids[offset:offset + len(records)]
+            offset += len(records)
+            outcome["result"]["saved_menu_id"] = ids[0]
+            if params["save_weekly"]:
+                outcome["result"]["saved_menu_ids"] = ids
+    if groups:
+        timings["save"] = round(time.perf_counter() - t0, 4)
+
+    results = []
+    for params, outcome in zip(school_params, outcomes):
+        spans = outcome["spans"]
+        if "save" in timings and params["save_to_db"]:
+            spans["save"] = timings["save"]
+        record_optimize_run(params, endpoint="batch", spans=spans, total_time=outcome["elapsed"],
+                            result=outcome["result"], error=outcome["error"])
+        entry = {"school_id": params["school_id"]}
+        entry["price_coverage"] = {
+            k: v for k, v in coverage[params["school_id"]].items() if k != "median_fallback_food_ids"
+        }
+        if outcome["error"] is None:
+            entry["result"] = outcome["result"]
+        else:
+            entry["error"] = str(outcome["error"])
+        results.append(entry)
+
+    timings["total"] = round(time.perf_counter() - t_start, 4)
+    return {
+        "meta": {
+            "schools": len(school_params),
+            "failed": sum(1 for entry in results if "error" in entry),
+            "school_price_tables": sum(1 for sid in school_ids if catalogs[sid] is not catalog),
+            "catalog_version": catalog.version,
+            "max_workers": int(max_workers),
+            "timings": timings,
+        },
+        "results": results,
+    }
+
+
+@app.route("/optimize/batch", methods=["POST", "OPTIONS"])
+def optimize_batch():
+    """
+    複数校の献立を一括で最適化するAPI
+
+    Returns:
+        JSON: results[]（学校ごとに /optimize と同じ result、失敗した学校は error）と meta
+    """
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    body = request.get_json(silent=True) or {}
+
+    try:
+        school_params, options = parse_batch_request(body)
+    except OptimizeRequestError as e:
+        metrics.inc("optimize_errors_total", {"endpoint": "batch", "kind": "bad_request"})
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), e.status
+
+    try:
+        result = run_optimize_batch(school_params, **options)
+        resp = jsonify(result)
+        return _add_cors_headers(resp), 200
+    except Exception as e:
+        print(f"[ERROR] Batch optimize failed: {str(e)}")
+        metrics.inc("optimize_errors_total", {"endpoint": "batch", "kind": "internal"})
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), 500
+
+
+# ============
+# 重みのスイープ（/optimize/sweep）
+# ============
+def parse_sweep_request(body: dict) -> tuple[dict, dict]:
+    """
+    /optimize/sweep のリクエストボディを最適化パラメータとスイープの設定にする
+
+    sweep 以外のフィールドは /optimize と同じ。sweep.weights の各要素は weights（既定の重み）を一部の項だけ上書きする。
+
+    Returns:
+        (params, オプション {"weights", "top_k", "max_workers"})
+    """
+    sweep = body.get("sweep")
+    if not isinstance(sweep, dict):
+        raise OptimizeRequestError("sweep must be an object.")
+
+    params = parse_optimize_request({k: v for k, v in body.items() if k != "sweep"})
+    if params["decompose"] or params["locked"]:
+        raise OptimizeRequestError("sweep cannot be combined with decompose or locked.")
+    if params["save_to_db"]:
+        raise OptimizeRequestError("sweep does not save menus; re-run /optimize with the chosen weights to save.")
+    if params["repair"]:
+        raise OptimizeRequestError("sweep does not repair solutions; re-run /optimize with the chosen weights and repair.")
+
+    variants = sweep.get("weights")
+    if not isinstance(variants, list) or not variants:
+        raise OptimizeRequestError("sweep.weights must be a non-empty list.")
+    if len(variants) > SWEEP_MAX_VARIANTS:
+        raise OptimizeRequestError(f"sweep.weights must have at most {SWEEP_MAX_VARIANTS} entries.")
+    weights = [
+        parse_weight_overrides(overrides, params["W"], f"sweep.weights[{idx}]")
+        for idx, overrides in enumerate(variants)
+    ]
+
+    try:
+        top_k = int(sweep.get("top_k", SWEEP_TOP_K))
+        max_workers = int(sweep.get("max_workers", SWEEP_MAX_WORKERS))
+    except (TypeError, ValueError):
+        raise OptimizeRequestError("sweep.top_k and sweep.max_workers must be numbers.")
+    if not 1 <= top_k <= SWEEP_MAX_TOP_K:
+        raise OptimizeRequestError(f"sweep.top_k must be between 1 and {SWEEP_MAX_TOP_K}.")
+
+    options = {
+        "weights": weights,
+        "top_k": top_k,
+        "max_workers": max(1, min(max_workers, SWEEP_MAX_WORKERS, len(weights))),
     }
+    return params, options
+
+
+def run_optimize_sweep(params: dict, *, weights: list[dict], top_k: int = SWEEP_TOP_K,
+                       max_workers: int = SWEEP_MAX_WORKERS) -> dict:
+    """重みの組み合わせごとに解く（prune は1回だけ）。結果キャッシュ・保存は使わない"""
+    spans = {}
+    t_start = time.perf_counter()
+    try:
+        catalog = school_catalog(get_catalog(timings=spans), params)
+        prune = params["prune"]
+        prune_report = None
+        if prune:
+            catalog, prune_report = prune_candidates(
+                catalog,
+                M=params["M"],
+                TARGET=params["TARGET"],
+                month=prune["month"],
+                max_nutrient_ratio=prune["max_nutrient_ratio"],
+                max_cost_ratio=prune["max_cost_ratio"],
+                categories=prune["categories"],
+            )
+
+        result = solve_menu_sweep(
+            catalog,
+            M=params["M"],
+            TARGET=params["TARGET"],
+            weights=weights,
+            H5_MODE=params["h5_mode"],
+            solver=params["solver"],
+            solver_options=params["solver_options"],
+            top_k=top_k,
+            max_workers=max_workers,
+            constraints=params["constraints"],
+        )
+        if prune_report is not None:
+            result["meta"]["prune"] = prune_report
+        spans.update({k: v for k, v in result["meta"]["timings"].items() if k in OPTIMIZE_STAGES})
+    except Exception as e:
+        record_optimize_run(params, endpoint="sweep", spans=spans, sweep_weights=weights,
+                            total_time=time.perf_counter() - t_start, error=e)
+        raise
+    record_optimize_run(params, endpoint="sweep", spans=spans, sweep_weights=weights,
+                        total_time=time.perf_counter() - t_start, result=result)
+    return result
+
+
+@app.route("/optimize/sweep", methods=["POST", "OPTIONS"])
+def optimize_sweep():
+    """
+    重み係数の組み合わせを変えて同じ条件の献立を解き比べるAPI
+
+    Returns:
+        JSON: variants[]（組み合わせごとの上位の献立と項ごとのエネルギー）と meta
+    """
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    body = request.get_json(silent=True) or {}
+
+    try:
+        params, options = parse_sweep_request(body)
+    except OptimizeRequestError as e:
+        metrics.inc("optimize_errors_total", {"endpoint": "sweep", "kind": "bad_request"})
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), e.status
+
+    try:
+        result = run_optimize_sweep(params, **options)
+        resp = jsonify(result)
+        return _add_cors_headers(resp), 200
+    except OptimizeRequestError as e:
+        metrics.inc("optimize_errors_total", {"endpoint": "sweep", "kind": "bad_request"})
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), e.status
+    except Exception as e:
+        print(f"[ERROR] Sweep optimize failed: {str(e)}")
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), 500
+
+
+# ============
+# 非同期ジョブ（投入 → ポーリング / キャンセル）
+# ============
+JOB_WORKERS = int(os.getenv("OPTIMIZE_JOB_WORKERS", "2"))
+JOB_QUEUE_DEPTH = int(os.getenv("OPTIMIZE_JOB_QUEUE_DEPTH", "16"))
+JOB_RESULT_TTL_SECONDS = int(os.getenv("OPTIMIZE_JOB_RESULT_TTL_SECONDS", "3600"))
+
+
+class OptimizeJob:
+    """最適化ジョブ1件の状態（queued → running → done / failed / cancelled）"""
+
+    def __init__(self, params: dict):
+        self.job_id = uuid.uuid4().hex
+        self.params = params
+        self.status = "queued"
+        self.submitted_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.timings = {}
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.future = None
 
-    W = {
-        "H1": 80.0,
-        "H2": 0.03,
-        "H3": 0.006,
-        "H4": 20.0,
-        "H5": 0.2,
-        "H7": 0.2,
-    }
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "cancel_requested": self.cancel_event.is_set(),
+            "submitted_at": self.submitted_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "timings": dict(self.timings),
+        }
+        if self.status == "done":
+            data["result"] = self.result
+        if self.status == "failed":
+            data["error"] = self.error
+        return data
 
-    token = os.getenv("AMPLIFY_TOKEN")
-    if not token:
-        return jsonify({"error": "AMPLIFY_TOKEN is not set in environment variables."}), 500
 
-    try:
-        recipes_raw, cost_raw = load_json_sources()
-
-        result = solve_menu(
-            recipes_raw,
-            cost_raw,
-            M=M,
-            topk_sim=topk_sim,
-            amplify_token=token,
-            TARGET=TARGET,
-            W=W,
-            H5_MODE=h5_mode,
-        )
+_jobs_lock = threading.Lock()
+_jobs = {}
+_job_executor = None
 
-        # データベースに保存（オプション）
-        save_to_db = body.get("save_to_db", False)
-        print(f"[DEBUG] save_to_db: {save_to_db}")  # デバッグログ
 
-        if save_to_db:
-            print("[DEBUG] Starting database save...")  # デバッグログ
-            school_id = 1  # 固定値（横須賀市小学校）
-            target_year_month = body.get("target_year_month")
-            target_week = body.get("target_week")  # フロントエンドから受け取る（1〜5、NULLも可）
+def _run_job(job: OptimizeJob):
+    with _jobs_lock:
+        if job.cancel_event.is_set():
+            job.status = "cancelled"
+            job.finished_at = datetime.now()
+            return
+        job.status = "running"
+        job.started_at = datetime.now()
 
-            if not target_year_month:
-                # target_year_monthが指定されていない場合は現在の年月を使用
-                now = datetime.now()
-                target_year_month = f"{now.year}-{now.month:02d}"
+    try:
+        result = run_optimize(job.params, timings=job.timings, cancel_event=job.cancel_event, endpoint="job")
+        with _jobs_lock:
+            if job.cancel_event.is_set():
+                job.status = "cancelled"
             else:
-                # YYYY-MM-DD形式の場合はYYYY-MMに変換
-                if len(target_year_month) == 10:  # YYYY-MM-DD
-                    target_year_month = target_year_month[:7]  # YYYY-MM
-
-            print(f"[DEBUG] school_id: {school_id}, target_year_month: {target_year_month}, target_week: {target_week}")  # デバッグログ
-
-            # 平均栄養価を計算
-            total_nutrition_avg = {}
-            if "plan" in result and "daily_totals" in result["plan"]:
-                daily_totals = result["plan"]["daily_totals"]
-                if len(daily_totals) > 0:
-                    # 各栄養素の平均を計算
-                    nutrition_keys = ["エネルギー", "たんぱく質", "脂質", "ナトリウム"]
-                    for key in nutrition_keys:
-                        total = sum(day["totals"].get(key, 0) for day in daily_totals if "totals" in day)
-                        total_nutrition_avg[key] = round(float(total) / len(daily_totals), 2)
-
-            print(f"[DEBUG] total_nutrition_avg: {total_nutrition_avg}")  # デバッグログ
-
-            # データベースに保存
-            try:
-                # total_costを整数に変換（データベースのINT型に合わせる）
-                total_cost_value = result.get("plan", {}).get("total_cost", 0)
-                total_cost_int = int(round(float(total_cost_value)))
-
-                menu_id = save_menu_to_db(
-                    school_id=school_id,
-                    target_year_month=target_year_month,
-                    target_week=target_week,
-                    menu_data=result,
-                    total_cost=total_cost_int,
-                    total_nutrition_avg=total_nutrition_avg
-                )
-                print(f"[DEBUG] Successfully saved to database. menu_id: {menu_id}")  # デバッグログ
+                job.result = result
+                job.status = "done"
+    except Exception as e:
+        print(f"[ERROR] Job {job.job_id} failed: {str(e)}")
+        with _jobs_lock:
+            job.error = str(e)
+            job.status = "failed"
+    finally:
+        job.finished_at = datetime.now()
 
-                # レスポンスにmenu_idを追加
-                result["saved_menu_id"] = menu_id
-            except Exception as db_error:
-                print(f"[ERROR] Database save failed: {str(db_error)}")  # エラーログ
-                import traceback
-                traceback.print_exc()  # 詳細なスタックトレースを出力
-                # エラーが発生してもレスポンスは返す（保存失敗を通知）
-                result["save_error"] = str(db_error)
 
-        resp = jsonify(result)
+def _prune_jobs():
+    """保持期限を過ぎた終了済みジョブを捨てる（_jobs_lock を持って呼ぶ）"""
+    now = datetime.now()
+    expired = [
+        job_id for job_id, job in _jobs.items()
+        if job.finished_at is not None and (now - job.finished_at).total_seconds() > JOB_RESULT_TTL_SECONDS
+    ]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+def submit_optimize_job(params: dict) -> OptimizeJob:
+    """
+    ジョブを投入する。待ち行列が JOB_QUEUE_DEPTH 件を超える場合は OptimizeRequestError（429）
+    """
+    global _job_executor
+
+    with _jobs_lock:
+        _prune_jobs()
+        queued = sum(1 for job in _jobs.values() if job.status == "queued")
+        if queued >= JOB_QUEUE_DEPTH:
+            raise OptimizeRequestError("Job queue is full. Retry later.", status=429)
+
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="optimize-job")
+
+        job = OptimizeJob(params)
+        _jobs[job.job_id] = job
+        job.future = _job_executor.submit(_run_job, job)
+        return job
+
+
+def get_job(job_id: str):
+    with _jobs_lock:
+        _prune_jobs()
+        return _jobs.get(job_id)
+
+
+def cancel_job(job_id: str):
+    """
+    ジョブをキャンセルする
+
+    待ち中ならその場で cancelled にする。実行中ならソルバーの終了後に保存をせず cancelled になる。
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status in ("done", "failed", "cancelled"):
+            return job
+        job.cancel_event.set()
+        if job.status == "queued" and job.future.cancel():
+            job.status = "cancelled"
+            job.finished_at = datetime.now()
+        return job
+
+
+@app.route("/jobs", methods=["POST", "OPTIONS"])
+def submit_job():
+    """
+    最適化ジョブを投入するAPI（リクエストボディは /optimize と同じ）
+
+    Returns:
+        202: {"job_id": ..., "status": "queued", ...}
+    """
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    body = request.get_json(silent=True) or {}
+
+    try:
+        params = parse_optimize_request(body)
+        job = submit_optimize_job(params)
+    except OptimizeRequestError as e:
+        metrics.inc("optimize_errors_total", {"endpoint": "job", "kind": "bad_request" if e.status == 400 else "rejected"})
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), e.status
+
+    resp = jsonify(job.to_dict())
+    return _add_cors_headers(resp), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET", "DELETE", "OPTIONS"])
+def job_status(job_id):
+    """
+    ジョブの状態を取得（GET）/ キャンセル（DELETE）するAPI
+
+    Returns:
+        JSON: status（queued / running / done / failed / cancelled）、段階ごとの所要時間、
+              完了時は result、失敗時は error
+    """
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    job = cancel_job(job_id) if request.method == "DELETE" else get_job(job_id)
+    if job is None:
+        resp = jsonify({"error": f"job {job_id} not found."})
+        return _add_cors_headers(resp), 404
+
+    resp = jsonify(job.to_dict())
+    return _add_cors_headers(resp), 200
+
+
+@app.route("/catalog/reload", methods=["POST", "OPTIONS"])
+def reload_catalog():
+    """
+    レシピカタログを強制的に再構築するAPI
+
+    reciept.json / reciept-cost.json を差し替えた直後など、
+    mtime による自動検知を待たずに反映したい場合に使う。学校ごとの単価（food_costs）も次の参照で読み直す。
+    """
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    try:
+        catalog = get_catalog(force_reload=True)
+        school_price_cache.invalidate()
+        resp = jsonify(catalog.info())
         return _add_cors_headers(resp), 200
+    except Exception as e:
+        print(f"[ERROR] Catalog reload failed: {str(e)}")
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), 500
+
+
+@app.route("/prices/coverage", methods=["GET", "OPTIONS"])
+def prices_coverage():
+    """
+    学校ごとの単価の網羅状況を返すAPI
+
+    カタログの食材のうち、food_costs・共通の価格表・中央値のどれで値付けしたか（中央値で代用した食材とそのレシピ数）。
+    クエリ: school_id（カンマ区切りで複数可。省略時は DEFAULT_SCHOOL_ID）
+    """
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    try:
+        school_ids = [int(v) for v in str(request.args.get("school_id", DEFAULT_SCHOOL_ID)).split(",") if v.strip()]
+    except ValueError:
+        resp = jsonify({"error": "school_id must be integers."})
+        return _add_cors_headers(resp), 400
+    if not school_ids or len(school_ids) > BATCH_MAX_SCHOOLS:
+        resp = jsonify({"error": f"school_id must list 1 to {BATCH_MAX_SCHOOLS} schools."})
+        return _add_cors_headers(resp), 400
 
+    try:
+        catalog = get_catalog()
+        entries = school_price_cache.lookup(catalog, school_ids)
+        resp = jsonify({
+            "catalog_version": catalog.version,
+            "schools": [
+                {"school_id": sid, "price_version": entries[sid][0].version, "coverage": entries[sid][1]}
+                for sid in sorted(entries)
+            ],
+            "cache": school_price_cache.stats(),
+        })
+        return _add_cors_headers(resp), 200
     except Exception as e:
+        print(f"[ERROR] Price coverage failed: {str(e)}")
         resp = jsonify({"error": str(e)})
         return _add_cors_headers(resp), 500
 
 
+@app.route("/db/pool", methods=["GET", "OPTIONS"])
+def db_pool_stats():
+    """DB接続プールの統計（監視用）。プール未作成なら接続はせずに null を返す"""
+    if request.method == "OPTIONS":
+        resp = make_response("", 204)
+        return _add_cors_headers(resp)
+
+    stats = _db_pool.stats() if _db_pool is not None else None
+    resp = jsonify({"pool": stats})
+    return _add_cors_headers(resp), 200
+
+
+# ============
+# 起動時のウォームアップと死活・準備完了の確認
+# ============
+_warmup_lock = threading.Lock()
+_warmup_state = {"ready": False, "started_at": None, "finished_at": None, "seconds": None, "error": None}
+
+
+def warmup() -> dict:
+    """
+    リクエストを受ける前の準備（レシピカタログの読み込み）。終わるまで /readyz は 503 を返す
+
+    本番（wsgi.py）では gunicorn のマスタープロセスが fork 前に呼ぶので、ワーカーはカタログを
+    コピーオンライトで共有する。DB接続・スレッドは fork 後に各ワーカーで作るので、ここでは作らない。
+    """
+    with _warmup_lock:
+        _warmup_state.update(started_at=datetime.now().isoformat(), error=None)
+        t0 = time.perf_counter()
+        try:
+            catalog = get_catalog()
+            _warmup_state["catalog"] = catalog.info()
+            _warmup_state["ready"] = True
+        except Exception as e:
+            print(f"[ERROR] Warmup failed: {str(e)}")
+            _warmup_state["error"] = str(e)
+        _warmup_state["seconds"] = round(time.perf_counter() - t0, 4)
+        _warmup_state["finished_at"] = datetime.now().isoformat()
+        return dict(_warmup_state)
+
+
+def _reset_after_fork():
+    """
+    fork した子プロセスで、親から引き継いだ DB プール・Connector・スレッドの参照を捨てる
+
+    ソケットは親と共有しているので閉じない。子では必要になったときに作り直す。
+    """
+    global _db_pool, _connector, _job_executor
+    _db_pool = None
+    _connector = None
+    _job_executor = None
+    recommendation_logs._thread = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """死活確認（プロセスが応答できれば 200）"""
+    return jsonify({"status": "ok", "pid": os.getpid()}), 200
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """準備完了の確認（ウォームアップが終わっていれば 200、まだ・失敗なら 503）"""
+    state = dict(_warmup_state)
+    state["pid"] = os.getpid()
+    return jsonify(state), 200 if state["ready"] else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Prometheus 形式のメトリクス（段階ごとのヒストグラム、キャッシュ・エラーのカウンタ、現在値）
+
+    値はこのプロセスの分だけなので、全系列に pid ラベルを付ける。
+    """
+    cache_stats = result_cache.stats()
+    pool_stats = _db_pool.stats() if _db_pool is not None else {}
+    qubo_memory_stats = qubo_memory.stats()
+    with _jobs_lock:
+        jobs_queued = sum(1 for job in _jobs.values() if job.status == "queued")
+        jobs_running = sum(1 for job in _jobs.values() if job.status == "running")
+    gauges = {
+        "result_cache_entries": cache_stats["size"],
+        "db_pool_connections": pool_stats.get("size"),
+        "db_pool_in_use": pool_stats.get("in_use"),
+        "jobs_queued": jobs_queued,
+        "jobs_running": jobs_running,
+        "recommendation_logs_pending": recommendation_logs.pending(),
+        "catalog_candidates": _catalog.N if _catalog is not None else None,
+        "school_price_tables": school_price_cache.stats()["schools"],
+        "qubo_memory_reserved_bytes": qubo_memory_stats["in_use"],
+        "qubo_memory_waiting": qubo_memory_stats["waiting"],
+    }
+    resp = make_response(metrics.render(gauges=gauges, const_labels={"pid": os.getpid()}), 200)
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return resp
+
+
+# ============
+# 保存済み献立の取得（/get_menu）
+# ============
+MENU_VIEWS = ("full", "summary")
+MENU_MAX_FIELDS = 16
+MENU_FIELD_PATTERN = re.compile(r"^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$")
+
+# view=summary：カレンダー表示用。各日のレシピは id・タイトル・カテゴリだけにし、日別集計と合計コストを付ける
+MENU_SUMMARY_SQL = """
+    jsonb_build_object('plan', jsonb_build_object(
+        'days', COALESCE((
+            SELECT jsonb_agg(jsonb_build_object(
+                'day', d.value -> 'day',
+                'recipes', COALESCE((
+                    SELECT jsonb_agg(jsonb_build_object(
+                        'id', r.value -> 'id',
+                        'title', r.value -> 'title',
+                        'category', r.value -> 'category',
+                        'category_name', r.value -> 'category_name'
+                    ) ORDER BY r.ord)
+                    FROM jsonb_array_elements(d.value -> 'recipes') WITH ORDINALITY AS r(value, ord)
+                ), '[]'::jsonb)
+            ) ORDER BY d.ord)
+            FROM jsonb_array_elements(menu_data #> '{plan,days}') WITH ORDINALITY AS d(value, ord)
+        ), '[]'::jsonb),
+        'daily_totals', menu_data #> '{plan,daily_totals}',
+        'total_cost', menu_data #> '{plan,total_cost}'
+    ))
+"""
+
+
+def _as_bool(value) -> bool:
+    """クエリ文字列（"true" / "1" など）と JSON の真偽値の両方を受け付ける"""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def parse_menu_query(body: dict) -> dict:
+    """
+    /get_menu のパラメータを検証してまとめる
+
+    Raises:
+        ValueError: 入力不正（400）
+    """
+    # school_idを取得（デフォルト: 1）
+    school_id = int(body.get("school_id", 1))
+
+    # target_year_monthを取得（デフォルト: 当月）
+    target_year_month = body.get("target_year_month")
+    if not target_year_month:
+        now = datetime.now()
+        target_year_month = f"{now.year}-{now.month:02d}"
+    else:
+        # YYYY-MM-DD形式の場合はYYYY-MMに変換
+        if len(target_year_month) == 10:  # YYYY-MM-DD
+            target_year_month = target_year_month[:7]  # YYYY-MM
+
+    # target_weekを取得（オプション）
+    target_week = body.get("target_week")
+    if target_week is not None:
+        target_week = int(target_week)
+
+    view = body.get("view") or "full"
+    if view not in MENU_VIEWS:
+        raise ValueError(f"view must be one of {list(MENU_VIEWS)}.")
+
+    # fields：menu_data から取り出すパス（"plan.daily_totals,plan.total_cost" またはリスト）
+    fields = body.get("fields") or []
+    if isinstance(fields, str):
+        fields = [f.strip() for f in fields.split(",") if f.strip()]
+    if not isinstance(fields, list) or len(fields) > MENU_MAX_FIELDS:
+        raise ValueError(f"fields must be a list of at most {MENU_MAX_FIELDS} paths.")
+    for field in fields:
+        if not isinstance(field, str) or not MENU_FIELD_PATTERN.match(field):
+            raise ValueError(f"invalid field path: {field!r}")
+
+    return {
+        "school_id": school_id,
+        "target_year_month": target_year_month,
+        "target_week": target_week,
+        "view": view,
+        "fields": fields,
+        "latest_only": _as_bool(body.get("latest_only", False)),
+    }
+
+
+def _menu_order_sql(query: dict) -> tuple[str, str]:
+    """(SELECT の先頭, ORDER BY 以降)。latest_only なら週ごとに最新の1件だけ（DISTINCT ON）"""
+    week_key = "CASE WHEN target_week IS NULL THEN 0 ELSE target_week END"
+    if query["target_week"] is not None:
+        return "SELECT", "ORDER BY created_at DESC, school_menu_id DESC LIMIT 1"
+    if query["latest_only"]:
+        return (
+            f"SELECT DISTINCT ON ({week_key})",
+            f"ORDER BY {week_key} ASC, created_at DESC, school_menu_id DESC",
+        )
+    return "SELECT", f"ORDER BY {week_key} ASC, created_at DESC, school_menu_id DESC"
+
+
+def find_menu_versions(cur, query: dict) -> list[tuple]:
+    """条件に合う献立の (school_menu_id, updated_at) を返却順に取得（menu_data は読まない）"""
+    select, order = _menu_order_sql(query)
+    where = "school_id = %s AND target_year_month = %s AND deleted_at IS NULL"
+    args = [query["school_id"], query["target_year_month"]]
+    if query["target_week"] is not None:
+        where += " AND target_week = %s"
+        args.append(query["target_week"])
+
+    cur.execute(f"""
+        {select} school_menu_id, updated_at
+        FROM school_menus
+        WHERE {where}
+        {order}
+    """, tuple(args))
+    return cur.fetchall()
+
+
+def menu_etag(query: dict, versions: list[tuple], catalog_version: str) -> str:
+    """
+    返す献立の (school_menu_id, updated_at) と取得形式から ETag を作る
+
+    compact 形式の行はカタログから詳細を復元するので、カタログのバージョンも含める。
+    """
+    key_source = {
+        "query": query,
+        "catalog_version": catalog_version,
+        "versions": [[int(menu_id), updated_at.isoformat() if updated_at else None] for menu_id, updated_at in versions],
+    }
+    canonical = json.dumps(key_source, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def _pick_fields(menu_data: dict, fields: list[str], values=None) -> dict:
+    """fields のパスだけを残した menu_data を作る（values があればパスごとの値として使う）"""
+    picked = {}
+    for n, field in enumerate(fields):
+        keys = field.split(".")
+        if values is not None:
+            value = values[n]
+        else:
+            value = menu_data
+            for k in keys:
+                value = value.get(k) if isinstance(value, dict) else None
+        if value is None:
+            continue
+        node = picked
+        for k in keys[:-1]:
+            node = node.setdefault(k, {})
+        node[keys[-1]] = value
+    return picked
+
+
+def fetch_menus(cur, query: dict, menu_ids: list[int], catalog: RecipeCatalog) -> list[dict]:
+    """
+    school_menu_id の献立を menu_ids の順で取得する
+
+    view=summary や fields の指定があれば、必要な部分だけを DB 側で JSONB 演算子で取り出す。
+    compact 形式の行はそのまま取得し、catalog からレシピの詳細を復元してから同じ形にする。
+    """
+    compact_sql = f"menu_data ->> 'format' = '{MENU_DATA_FORMAT}'"
+    args = []
+    if query["fields"]:
+        field_sql = ", ".join(["menu_data #> %s::text[]"] * len(query["fields"]))
+        args.extend(field.split(".") for field in query["fields"])
+        menu_sql = f"CASE WHEN {compact_sql} THEN menu_data END, {field_sql}"
+    elif query["view"] == "summary":
+        menu_sql = f"CASE WHEN {compact_sql} THEN menu_data ELSE {MENU_SUMMARY_SQL} END"
+    else:
+        menu_sql = "menu_data"
+
+    args.append(list(menu_ids))
+    cur.execute(f"""
+        SELECT school_menu_id, total_cost, total_nutrition_avg, target_week, created_at, {menu_sql}
+        FROM school_menus
+        WHERE school_menu_id = ANY(%s)
+    """, tuple(args))
+    rows = cur.fetchall()
+
+    def _json(value):
+        # JSON文字列をパース（pg8000の場合は既にdictになっている可能性あり）
+        return json.loads(value) if isinstance(value, str) else value
+
+    by_id = {}
+    for row in rows:
+        menu_id, total_cost, total_nutrition_avg, result_target_week, created_at, menu_data = row[:6]
+        menu_data = _json(menu_data)
+        if is_compact_menu_data(menu_data):
+            menu_data = rehydrate_menu_data(catalog, menu_data, summary=query["view"] == "summary" and not query["fields"])
+            if query["fields"]:
+                menu_data = _pick_fields(menu_data, query["fields"])
+        elif query["fields"]:
+            menu_data = _pick_fields(None, query["fields"], [_json(value) for value in row[6:]])
+
+        by_id[menu_id] = {
+            "menu_id": menu_id,
+            "school_id": query["school_id"],
+            "target_year_month": query["target_year_month"],
+            "target_week": result_target_week,
+            "menu_data": menu_data,
+            "total_cost": total_cost,
+            "total_nutrition_avg": _json(total_nutrition_avg),
+            "created_at": created_at.isoformat() if created_at else None,
+        }
+    return [by_id[menu_id] for menu_id in menu_ids if menu_id in by_id]
+
+
 @app.route("/get_menu", methods=["GET", "POST", "OPTIONS"])
 def get_menu():
     """
@@ -619,9 +5749,12 @@ def get_menu():
         school_id (int): 小学校ID（デフォルト: 1）
         target_year_month (str): 対象年月（YYYY-MM形式、例: "2026-03"、デフォルト: 当月）
         target_week (int): 対象週（1〜5、省略可）
+        view (str): "full"（デフォルト）/ "summary"（カレンダー表示用の要約）
+        fields (str | list): menu_data から取り出すパス（例: "plan.daily_totals,plan.total_cost"）。view より優先
+        latest_only (bool): 月全体のとき、週ごとに最新の1件だけ返す（デフォルト: false）
 
     Returns:
-        JSON: 献立データ
+        JSON: 献立データ。ETag を付け、If-None-Match が一致すれば 304 を返す
     """
     if request.method == "OPTIONS":
         return _add_cors_headers(jsonify({})), 200
@@ -633,71 +5766,44 @@ def get_menu():
         else:  # GET
             body = request.args.to_dict()
 
-        # school_idを取得（デフォルト: 1）
-        school_id = int(body.get("school_id", 1))
-
-        # target_year_monthを取得（デフォルト: 当月）
-        target_year_month = body.get("target_year_month")
-        if not target_year_month:
-            from datetime import datetime
-            now = datetime.now()
-            target_year_month = f"{now.year}-{now.month:02d}"
-        else:
-            # YYYY-MM-DD形式の場合はYYYY-MMに変換
-            if len(target_year_month) == 10:  # YYYY-MM-DD
-                target_year_month = target_year_month[:7]  # YYYY-MM
-
-        # target_weekを取得（オプション）
-        target_week = body.get("target_week")
-        if target_week is not None:
-            target_week = int(target_week)
+        try:
+            query = parse_menu_query(body)
+        except (TypeError, ValueError) as e:
+            resp = jsonify({"error": str(e)})
+            return _add_cors_headers(resp), 400
 
-        print(f"[DEBUG] Getting menu for school_id={school_id}, target_year_month={target_year_month}, target_week={target_week}")
+        school_id = query["school_id"]
+        target_year_month = query["target_year_month"]
+        target_week = query["target_week"]
+        print(f"[DEBUG] Getting menu for school_id={school_id}, target_year_month={target_year_month}, target_week={target_week}, view={query['view']}, fields={query['fields']}, latest_only={query['latest_only']}")
 
         # データベースから献立を取得
-        conn = None
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
+            catalog = get_catalog()  # compact 形式の行の復元用（接続を借りる前に用意しておく）
+            with db_connection() as conn:
+                cur = conn.cursor()
 
-            # target_weekが指定されている場合は週単位で検索、なければ月全体のすべての週を検索
-            if target_week is not None:
-                # 指定された週の献立を取得（1件のみ）
-                cur.execute("""
-                    SELECT school_menu_id, menu_data, total_cost, total_nutrition_avg, target_week, created_at
-                    FROM school_menus
-                    WHERE school_id = %s AND target_year_month = %s AND target_week = %s
-                    ORDER BY created_at DESC
-                    LIMIT 1
-                """, (school_id, target_year_month, target_week))
+                # まず ID と更新日時だけを見て、変わっていなければ menu_data を読まずに 304
+                versions = find_menu_versions(cur, query)
+                etag = menu_etag(query, versions, catalog.version)
+                if request.if_none_match.contains_weak(etag):
+                    cur.close()
+                    print(f"[DEBUG] Menu not modified (etag={etag})")
+                    resp = make_response("", 304)
+                    resp.set_etag(etag, weak=True)
+                    return _add_cors_headers(resp)
 
-                result = cur.fetchone()
+                menus = fetch_menus(cur, query, [menu_id for menu_id, _ in versions], catalog)
                 cur.close()
 
-                if result:
-                    menu_id, menu_data, total_cost, total_nutrition_avg, result_target_week, created_at = result
-
-                    # JSON文字列をパース（pg8000の場合は既にdictになっている可能性あり）
-                    if isinstance(menu_data, str):
-                        import json
-                        menu_data = json.loads(menu_data)
-                    if isinstance(total_nutrition_avg, str):
-                        import json
-                        total_nutrition_avg = json.loads(total_nutrition_avg)
-
-                    response_data = {
-                        "menu_id": menu_id,
-                        "school_id": school_id,
-                        "target_year_month": target_year_month,
-                        "target_week": result_target_week,
-                        "menu_data": menu_data,
-                        "total_cost": total_cost,
-                        "total_nutrition_avg": total_nutrition_avg,
-                        "created_at": created_at.isoformat() if created_at else None
-                    }
+            # target_weekが指定されている場合は1件、なければ月全体のすべての週を配列で返す
+            if target_week is not None:
+                if menus:
+                    response_data = menus[0]
 
                     # デバッグ: 返却するデータの日数を確認
                     days_count = 0
+                    menu_data = response_data["menu_data"]
                     if menu_data and isinstance(menu_data, dict):
                         plan = menu_data.get("plan", {})
                         if isinstance(plan, dict):
@@ -705,12 +5811,10 @@ def get_menu():
                             if isinstance(days, list):
                                 days_count = len(days)
 
-                    print(f"[DEBUG] Found menu_id={menu_id}, target_week={result_target_week}, returning {days_count} days of menu data")
-                    resp = jsonify(response_data)
-                    return _add_cors_headers(resp), 200
+                    print(f"[DEBUG] Found menu_id={response_data['menu_id']}, target_week={response_data['target_week']}, returning {days_count} days of menu data")
                 else:
                     print(f"[DEBUG] No menu found for specific week")
-                    resp = jsonify({
+                    response_data = {
                         "menu_id": None,
                         "school_id": school_id,
                         "target_year_month": target_year_month,
@@ -719,55 +5823,15 @@ def get_menu():
                         "total_cost": None,
                         "total_nutrition_avg": None,
                         "created_at": None
-                    })
-                    return _add_cors_headers(resp), 200
+                    }
             else:
-                # 月全体のすべての週の献立を取得（複数レコード）
-                cur.execute("""
-                    SELECT school_menu_id, menu_data, total_cost, total_nutrition_avg, target_week, created_at
-                    FROM school_menus
-                    WHERE school_id = %s AND target_year_month = %s
-                    ORDER BY
-                        CASE WHEN target_week IS NULL THEN 0 ELSE target_week END ASC,
-                        created_at DESC
-                """, (school_id, target_year_month))
-
-                results = cur.fetchall()
-                cur.close()
+                print(f"[DEBUG] Found {len(menus)} menu(s) for {target_year_month}")
+                response_data = {"menus": menus}
 
-                if results:
-                    # 複数レコードを配列で返す
-                    menus = []
-                    for result in results:
-                        menu_id, menu_data, total_cost, total_nutrition_avg, result_target_week, created_at = result
-
-                        # JSON文字列をパース（pg8000の場合は既にdictになっている可能性あり）
-                        if isinstance(menu_data, str):
-                            import json
-                            menu_data = json.loads(menu_data)
-                        if isinstance(total_nutrition_avg, str):
-                            import json
-                            total_nutrition_avg = json.loads(total_nutrition_avg)
-
-                        menu_item = {
-                            "menu_id": menu_id,
-                            "school_id": school_id,
-                            "target_year_month": target_year_month,
-                            "target_week": result_target_week,
-                            "menu_data": menu_data,
-                            "total_cost": total_cost,
-                            "total_nutrition_avg": total_nutrition_avg,
-                            "created_at": created_at.isoformat() if created_at else None
-                        }
-                        menus.append(menu_item)
-
-                    print(f"[DEBUG] Found {len(menus)} menu(s) for {target_year_month}")
-                    resp = jsonify({"menus": menus})
-                    return _add_cors_headers(resp), 200
-                else:
-                    print(f"[DEBUG] No menu found for the month")
-                    resp = jsonify({"menus": []})
-                    return _add_cors_headers(resp), 200
+            resp = jsonify(response_data)
+            resp.set_etag(etag, weak=True)
+            resp.headers["Cache-Control"] = "no-cache"  # 毎回 If-None-Match で再検証させる
+            return _add_cors_headers(resp), 200
 
         except Exception as db_error:
             print(f"[ERROR] Database query failed: {str(db_error)}")
@@ -775,9 +5839,6 @@ def get_menu():
             traceback.print_exc()
             resp = jsonify({"error": f"Database error: {str(db_error)}"})
             return _add_cors_headers(resp), 500
-        finally:
-            if conn:
-                conn.close()
 
     except Exception as e:
         print(f"[ERROR] get_menu failed: {str(e)}")
@@ -787,5 +5848,288 @@ def get_menu():
         return _add_cors_headers(resp), 500
 
 
+# ============
+# 発注用の食材集計（/procurement）
+# ============
+PROCUREMENT_GROUPS = ("day", "week", "month")
+PROCUREMENT_MAX_SCHOOLS = int(os.getenv("PROCUREMENT_MAX_SCHOOLS", "100"))
+YEAR_MONTH_PATTERN = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+
+# 学校・年月・週ごとに最新の献立（/get_menu の latest_only と同じ）の日ごとの recipe_id。
+# compact 形式は recipe_ids、従来形式は recipes[].id を DB 側で取り出し、レシピの詳細は読まない
+PROCUREMENT_DAYS_SQL = """
+    WITH latest AS (
+        SELECT DISTINCT ON (school_id, target_year_month, COALESCE(target_week, 0))
+            school_id, target_year_month, target_week, menu_data
+        FROM school_menus
+        WHERE school_id = ANY(%s) AND target_year_month BETWEEN %s AND %s AND deleted_at IS NULL
+        ORDER BY school_id, target_year_month, COALESCE(target_week, 0), created_at DESC, school_menu_id DESC
+    )
+    SELECT m.school_id, m.target_year_month, m.target_week,
+           COALESCE((d.value ->> 'day')::int, d.ord::int),
+           COALESCE(d.value -> 'recipe_ids', (
+               SELECT jsonb_agg(r.value -> 'id') FROM jsonb_array_elements(d.value -> 'recipes') AS r(value)
+           ), '[]'::jsonb)
+    FROM latest AS m
+    CROSS JOIN LATERAL jsonb_array_elements(m.menu_data #> '{plan,days}') WITH ORDINALITY AS d(value, ord)
+    ORDER BY m.school_id, m.target_year_month, COALESCE(m.target_week, 0), d.ord
+"""
+
+
+def _year_month(value, name: str) -> str:
+    """YYYY-MM（YYYY-MM-DD なら月に切り詰める）"""
+    value = str(value)[:7]
+    if not YEAR_MONTH_PATTERN.match(value):
+        raise ValueError(f"{name} must be YYYY-MM.")
+    return value
+
+
+def parse_procurement_query(body: dict) -> dict:
+    """
+    /procurement のパラメータを検証してまとめる
+
+    Raises:
+        ValueError: 入力不正（400）
+    """
+    school_ids = body.get("school_id", DEFAULT_SCHOOL_ID)
+    if isinstance(school_ids, str):
+        school_ids = [v for v in school_ids.split(",") if v.strip()]
+    elif not isinstance(school_ids, list):
+        school_ids = [school_ids]
+    school_ids = sorted({int(sid) for sid in school_ids})
+    if not school_ids or len(school_ids) > PROCUREMENT_MAX_SCHOOLS:
+        raise ValueError(f"school_id must list 1 to {PROCUREMENT_MAX_SCHOOLS} schools.")
+
+    now = datetime.now()
+    from_year_month = _year_month(body.get("from_year_month") or f"{now.year}-{now.month:02d}", "from_year_month")
+    to_year_month = _year_month(body.get("to_year_month") or from_year_month, "to_year_month")
+    if to_year_month < from_year_month:
+        raise ValueError("to_year_month must not be before from_year_month.")
+
+    group_by = body.get("group_by") or "week"
+    if group_by not in PROCUREMENT_GROUPS:
+        raise ValueError(f"group_by must be one of {list(PROCUREMENT_GROUPS)}.")
+
+    # servings：食数（1食あたりのグラム数に掛ける）。数値なら全校共通、{school_id: 食数} なら学校ごと
+    servings = body.get("servings", 1)
+    if isinstance(servings, str):
+        servings = json.loads(servings) if servings.strip().startswith("{") else float(servings)
+    if isinstance(servings, dict):
+        servings = {sid: float(servings.get(str(sid), servings.get(sid, 1))) for sid in school_ids}
+    else:
+        servings = {sid: float(servings) for sid in school_ids}
+    if any(v < 0 for v in servings.values()):
+        raise ValueError("servings must not be negative.")
+
+    return {
+        "school_ids": school_ids,
+        "from_year_month": from_year_month,
+        "to_year_month": to_year_month,
+        "group_by": group_by,
+        "servings": servings,
+        "use_school_prices": _as_bool(body.get("use_school_prices", True)),
+    }
+
+
+def load_menu_days(query: dict) -> list[tuple]:
+    """期間内の保存済み献立を日ごとの (school_id, target_year_month, target_week, day, recipe_ids) で読む"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(PROCUREMENT_DAYS_SQL, (query["school_ids"], query["from_year_month"], query["to_year_month"]))
+        rows = cur.fetchall()
+        cur.close()
+    return [
+        (int(sid), ym, week, int(day), json.loads(ids) if isinstance(ids, str) else ids)
+        for sid, ym, week, day, ids in rows
+    ]
+
+
+def catalog_food_names(catalog: RecipeCatalog, cols) -> dict:
+    """X の列 → 食材名（その食材を使う最初のレシピの食材名）"""
+    Xc = catalog.X.tocsc()
+    names = {}
+    for j in cols:
+        start, end = Xc.indptr[j], Xc.indptr[j + 1]
+        if start == end:
+            continue
+        fid = int(catalog.food_ids[j])
+        r = catalog.recipes[int(Xc.indices[start])]
+        names[j] = next(
+            (ing.get("name") for ing in r.get("ingredients", []) or [] if ing.get("id") is not None and int(ing["id"]) == fid),
+            None,
+        )
+    return names
+
+
+def procurement_rollup(catalog: RecipeCatalog, days: list[tuple], *, group_by: str,
+                       unit_prices: dict, servings: dict = None) -> dict:
+    """
+    献立の日ごとのレシピから、食材ごとの使用量（g）と金額をグループ（日・週・月）ごとに集計する
+
+    日×レシピの選択行列 S（同じ日に同じレシピが2回なら 2）と、グループ×日の行列 A（値は食数）を作り、
+    (A · S) · X の疎行列の積1回で食材ごとのグラム数を求める。金額はグラム数 × 学校の単価
+    （unit_prices[school_id]：X の列にそろえた密ベクトル）。
+    target_week の無い献立（月まとめて保存したもの）の週は day から SCHOOL_WEEK_DAYS 日ごとに数える。
+
+    Returns:
+        {"groups": [...], "missing_recipe_ids": [...], "totals": {...}}
+    """
+    servings = servings or {}
+    group_index, group_keys = {}, []
+    group_of_day, day_weight = [], []
+    sel_rows, sel_cols = [], []
+    missing = set()
+    for d, (sid, ym, week, day, recipe_ids) in enumerate(days):
+        week = int(week) if week is not None else (day - 1) // SCHOOL_WEEK_DAYS + 1
+        key = {"day": (sid, ym, week, day), "week": (sid, ym, week), "month": (sid, ym)}[group_by]
+        g = group_index.get(key)
+        if g is None:
+            g = group_index[key] = len(group_keys)
+            group_keys.append(key)
+        group_of_day.append(g)
+        day_weight.append(servings.get(sid, 1.0))
+        for rid in recipe_ids or []:
+            i = catalog.recipe_index.get(rid)
+            if i is None:
+                missing.add(rid)
+                continue
+            sel_rows.append(d)
+            sel_cols.append(i)
+
+    D, G = len(days), len(group_keys)
+    S = sparse.csr_matrix((np.ones(len(sel_rows)), (sel_rows, sel_cols)), shape=(D, catalog.N))
+    A = sparse.csr_matrix((day_weight, (group_of_day, np.arange(D))), shape=(G, D))
+    grams = sparse.csr_matrix((A @ S) @ catalog.X)
+    grams.sum_duplicates()
+    grams.eliminate_zeros()  # 使用量 0 g の食材行は出さない
+    grams.sort_indices()
+
+    # 金額：非ゼロ要素ごとに、その行（グループ）の学校の単価を掛ける
+    schools = sorted({key[0] for key in group_keys})
+    P = np.vstack([unit_prices[sid] for sid in schools]) if schools else np.zeros((0, len(catalog.food_ids)))
+    school_row = np.searchsorted(schools, [key[0] for key in group_keys]).astype(np.int64)
+    rows = np.repeat(np.arange(G), np.diff(grams.indptr))
+    unit = P[school_row[rows], grams.indices] if len(rows) else np.zeros(0)
+    cost = grams.data * unit
+
+    # レスポンスの組み立ても要素ごとの numpy → Python 変換を避け、列ごとにまとめて tolist する
+    names = catalog_food_names(catalog, np.unique(grams.indices))
+    name_of_col = np.array([names.get(j) for j in range(len(catalog.food_ids))], dtype=object)
+    food_col = np.asarray(catalog.food_ids)[grams.indices].tolist()
+    name_col = name_of_col[grams.indices].tolist()
+    grams_col = np.round(grams.data, 3).tolist()
+    unit_col = unit.tolist()
+    cost_col = np.round(cost, 3).tolist()
+    total_grams = np.round(np.asarray(grams.sum(axis=1)).ravel(), 3)
+    total_cost = np.round(np.asarray(sparse.csr_matrix((cost, grams.indices, grams.indptr), shape=grams.shape).sum(axis=1)).ravel(), 3)
+    days_per_group = np.bincount(group_of_day, minlength=G)
+
+    groups = []
+    for g, key in enumerate(group_keys):
+        lo, hi = int(grams.indptr[g]), int(grams.indptr[g + 1])
+        entry = {"school_id": key[0], "target_year_month": key[1]}
+        if group_by in ("week", "day"):
+            entry["target_week"] = key[2]
+        if group_by == "day":
+            entry["day"] = key[3]
+        entry.update({
+            "days": int(days_per_group[g]),
+            "total_grams": float(total_grams[g]),
+            "total_cost": float(total_cost[g]),
+            "foods": [
+                {"food_id": f, "name": n, "grams": q, "unit_cost": u, "cost": c}
+                for f, n, q, u, c in zip(
+                    food_col[lo:hi], name_col[lo:hi], grams_col[lo:hi], unit_col[lo:hi], cost_col[lo:hi]
+                )
+            ],
+        })
+        groups.append(entry)
+
+    return {
+        "groups": groups,
+        "missing_recipe_ids": sorted(missing, key=str),
+        "totals": {
+            "days": D,
+            "foods": int(len(np.unique(grams.indices))),
+            "grams": round(float(grams.data.sum()), 3),
+            "cost": round(float(cost.sum()), 3),
+        },
+    }
+
+
+@app.route("/procurement", methods=["GET", "POST", "OPTIONS"])
+def procurement():
+    """
+    保存済み献立から、発注用に食材ごとの使用量（g）と金額を集計するAPI
+
+    Parameters:
+        school_id (int | list | str): 小学校ID（カンマ区切り・配列で複数可、デフォルト: 1）
+        from_year_month / to_year_month (str): 対象期間（YYYY-MM、両端を含む。デフォルト: 当月）
+        group_by (str): "day" / "week"（デフォルト）/ "month"
+        servings (number | dict): 食数（デフォルト: 1 = 1食あたり）。{school_id: 食数} で学校ごと
+        use_school_prices (bool): food_costs の学校ごとの単価で金額を出す（デフォルト: true）
+
+    Returns:
+        JSON: groups[]（学校・期間ごとの foods[]）と meta
+    """
+    if request.method == "OPTIONS":
+        return _add_cors_headers(jsonify({})), 200
+
+    body = (request.get_json(silent=True) or {}) if request.method == "POST" else request.args.to_dict()
+    try:
+        query = parse_procurement_query(body)
+    except (TypeError, ValueError) as e:
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), 400
+
+    try:
+        t_start = time.perf_counter()
+        timings = {}
+        catalog = get_catalog()
+
+        t0 = time.perf_counter()
+        days = load_menu_days(query)
+        timings["query"] = round(time.perf_counter() - t0, 4)
+
+        t0 = time.perf_counter()
+        if query["use_school_prices"]:
+            catalogs = school_price_cache.catalogs(catalog, query["school_ids"])
+        else:
+            catalogs = {sid: catalog for sid in query["school_ids"]}
+        unit_prices = {sid: c.price_vector(c.price_per_g, c.median_price) for sid, c in catalogs.items()}
+        timings["prices"] = round(time.perf_counter() - t0, 4)
+
+        t0 = time.perf_counter()
+        rollup = procurement_rollup(
+            catalog, days, group_by=query["group_by"], unit_prices=unit_prices, servings=query["servings"],
+        )
+        timings["aggregate"] = round(time.perf_counter() - t0, 4)
+        timings["total"] = round(time.perf_counter() - t_start, 4)
+
+        resp = jsonify({
+            "meta": {
+                "school_ids": query["school_ids"],
+                "from_year_month": query["from_year_month"],
+                "to_year_month": query["to_year_month"],
+                "group_by": query["group_by"],
+                "catalog_version": catalog.version,
+                "use_school_prices": query["use_school_prices"],
+                "missing_recipe_ids": rollup["missing_recipe_ids"],
+                "totals": rollup["totals"],
+                "timings": timings,
+            },
+            "groups": rollup["groups"],
+        })
+        return _add_cors_headers(resp), 200
+    except Exception as e:
+        print(f"[ERROR] Procurement rollup failed: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        resp = jsonify({"error": str(e)})
+        return _add_cors_headers(resp), 500
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+    # 開発用サーバー（本番は gunicorn -c gunicorn.conf.py wsgi:app）。FLASK_DEBUG=1 でデバッグ・自動リロード
+    warmup()
+    app.run(debug=os.getenv("FLASK_DEBUG", "0") == "1", host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
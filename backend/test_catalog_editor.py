@@ -0,0 +1,132 @@
+"""
+カタログの差分更新（CatalogEditor / apply_catalog_diff）が作り直した場合と同じになることの確認
+
+同梱の reciept.json・reciept-cost.json を書き換え、差分で当てたカタログと
+RecipeCatalog で作り直したカタログの X・recipe_cost・nut・近傍の類似度を比べる。
+
+    cd backend && python -m pytest -q test_catalog_editor.py
+"""
+
+import copy
+
+import numpy as np
+import pytest
+
+from main import (
+    CatalogEditor,
+    RecipeCatalog,
+    apply_catalog_diff,
+    diff_catalog_sources,
+    load_json_sources,
+)
+
+
+@pytest.fixture(scope="module")
+def sources():
+    return load_json_sources()
+
+
+@pytest.fixture(scope="module")
+def base(sources):
+    return RecipeCatalog(*sources)
+
+
+def _edit(recipes_raw):
+    """既存レシピの分量と栄養を変える（X・類似度・原価・栄養が変わる）"""
+    r = next(r for r in recipes_raw if len(r["ingredients"]) >= 3)
+    r["ingredients"][0]["amount"] = float(r["ingredients"][0]["amount"]) * 2 + 5
+    r["nutritions"]["エネルギー"] = float(r["nutritions"]["エネルギー"]) + 10
+
+
+def _insert(recipes_raw):
+    """既存レシピを元に、語彙に無い食材を含むレシピを追加する"""
+    r = copy.deepcopy(recipes_raw[10])
+    r["id"] = max(x["id"] for x in recipes_raw) + 1
+    r["title"] = "追加レシピ"
+    r["ingredients"] = r["ingredients"][1:] + [{"id": 999001, "name": "新しい食材", "amount": 30}]
+    recipes_raw.append(r)
+
+
+def _deactivate(recipes_raw):
+    """他のレシピの近傍に入っているレシピを外す"""
+    recipes_raw[20]["active"] = 0
+
+
+def _prices(cost_raw):
+    """単価を1件変え、1件を価格表から外す（外した食材と価格表に無い食材は中央値になる）"""
+    cost_raw[0]["cost"] = float(cost_raw[0]["cost"]) * 3
+    del cost_raw[1]
+
+
+CASES = {
+    "edit": (_edit,),
+    "insert": (_insert,),
+    "deactivate": (_deactivate,),
+    "prices": (_prices,),
+    "mixed": (_edit, _insert, _deactivate, _prices),
+}
+
+
+def _changed_sources(sources, edits):
+    recipes_raw, cost_raw = copy.deepcopy(sources)
+    for edit in edits:
+        edit(cost_raw if edit is _prices else recipes_raw)
+    return recipes_raw, cost_raw
+
+
+def _assert_same_catalog(inc, full):
+    assert list(inc.df["recipe_id"]) == list(full.df["recipe_id"])
+    assert inc.recipe_index == full.recipe_index
+    np.testing.assert_array_equal(inc.food_ids, full.food_ids)
+    np.testing.assert_array_equal(inc.cats, full.cats)
+    np.testing.assert_array_equal(inc.genres, full.genres)
+    np.testing.assert_allclose(inc.X.toarray(), full.X.toarray(), rtol=0, atol=0)
+    np.testing.assert_allclose(inc.recipe_cost, full.recipe_cost, rtol=1e-12)
+    np.testing.assert_allclose(inc.nut, full.nut, rtol=0, atol=0)
+
+    # 近傍は同じ類似度のレシピが入れ替わりうるので、index ではなく類似度の値で比べる
+    assert inc.top_sim.shape == full.top_sim.shape
+    np.testing.assert_allclose(inc.top_sim, full.top_sim, rtol=0, atol=1e-6)
+
+    # 差分で持った近傍 index が、作り直したカタログでその類似度のレシピを指していること
+    X = full.X.toarray()
+    Xn = X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-9)
+    S = Xn @ Xn.T
+    rows = np.arange(full.N)[:, None]
+    assert np.all(inc.top_neighbors != rows)
+    np.testing.assert_allclose(S[rows, inc.top_neighbors], inc.top_sim, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("case", list(CASES))
+def test_apply_diff_matches_rebuild(sources, base, case):
+    recipes_raw, cost_raw = _changed_sources(sources, CASES[case])
+    diff = diff_catalog_sources(base, recipes_raw, cost_raw)
+    assert diff is not None
+
+    inc = apply_catalog_diff(base, diff, version="incremental")
+    full = RecipeCatalog(recipes_raw, cost_raw)
+    _assert_same_catalog(inc, full)
+    assert inc.source == "incremental"
+    # 元のカタログは書き換えない
+    _assert_same_catalog(base, RecipeCatalog(*sources))
+
+
+def test_editor_chained_updates_match_rebuild(sources, base):
+    """CatalogEditor を直接使い、upsert・無効化・追加・単価変更を続けて当てる"""
+    recipes_raw, cost_raw = _changed_sources(sources, CASES["mixed"])
+    editor = CatalogEditor(base)
+    editor.update_food_prices({
+        int(sources[1][0]["food_id"]): float(cost_raw[0]["cost"]),
+        int(sources[1][1]["food_id"]): None,
+    })
+    for r in recipes_raw:
+        if int(r.get("active", 1)) != 1:
+            assert editor.upsert_recipe(r) == "deactivated"
+        elif r["id"] not in base.recipe_index:
+            assert editor.upsert_recipe(r) == "added"
+    edited = next(r for r in recipes_raw if r["id"] in base.recipe_index and r != base.recipes[base.recipe_index[r["id"]]])
+    assert editor.upsert_recipe(edited) == "updated"
+    assert editor.upsert_recipe(edited) == "unchanged"
+    editor.reorder([r["id"] for r in recipes_raw if int(r.get("active", 1)) == 1])
+
+    _assert_same_catalog(editor.commit(), RecipeCatalog(recipes_raw, cost_raw))
@@ -0,0 +1,96 @@
+"""
+locked（固定した日・pin）で解く QUBO が、期間全体の QUBO と同じ最適化問題になることの確認
+
+solve_menu_locked がソルバーに渡す自由変数だけの QUBO（Q_free, p_free, const_free）のエネルギーと、
+組み立てた献立での期間全体の QUBO（build_qubo_coefficients）のエネルギーの差が、
+自由変数の値によらず一定（固定した日だけで決まる項）になること。
+
+    cd backend && python -m pytest -q test_locked.py
+"""
+
+import numpy as np
+import pytest
+
+import main
+from main import (
+    OPT_CATS,
+    REQ_CATS,
+    RecipeCatalog,
+    build_day_adjacency,
+    build_qubo_coefficients,
+    load_json_sources,
+    solve_menu_locked,
+)
+
+M = 5
+TARGET = {"エネルギー": 650.0, "たんぱく質": 25.0, "脂質": 20.0, "ナトリウム": 1000.0, "cost": 1500.0}
+W = {"H1": 80.0, "H2": 0.03, "H3": 0.006, "H4": 20.0, "H5": 0.2, "H7": 0.2}
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    full = RecipeCatalog(*load_json_sources())
+    idx = np.concatenate([np.where(full.cats == c)[0][:6] for c in REQ_CATS + OPT_CATS])
+    return full.subset(np.sort(idx))
+
+
+@pytest.fixture(scope="module")
+def locked(catalog):
+    ids = catalog.df["recipe_id"]
+    first = {c: int(np.where(catalog.cats == c)[0][0]) for c in REQ_CATS + OPT_CATS}
+    second = {c: int(np.where(catalog.cats == c)[0][1]) for c in REQ_CATS}
+    return (
+        # 2日目と3日目を固定（3日目は4日目と隣接するので H7 の一次項が入る）
+        [{"day": 2, "recipe_id": ids[first[c]], "mode": "day"} for c in REQ_CATS]
+        + [{"day": 3, "recipe_id": ids[second[c]], "mode": "day"} for c in REQ_CATS]
+        + [{"day": 3, "recipe_id": ids[first[OPT_CATS[0]]], "mode": "pin"}]
+        # 自由な日への pin（変数を 1 に固定して代入する）
+        + [{"day": 1, "recipe_id": ids[first[REQ_CATS[0]]], "mode": "pin"},
+           {"day": 5, "recipe_id": ids[second[REQ_CATS[1]]], "mode": "pin"}]
+    )
+
+
+def _energy(Q, p, const, x):
+    x = np.asarray(x, dtype=float).reshape(-1)
+    n = x.size
+    return float(x @ Q.reshape(n, n) @ x + p.reshape(n) @ x + const)
+
+
+def _solve_with(monkeypatch, catalog, locked, seed):
+    """ソルバーをランダムな解を返すものに差し替えて解き、渡された QUBO と組み立てた献立を返す"""
+    captured = {}
+
+    def fake_solver(Q, p, const, *, groups=None, **_):
+        x = np.random.default_rng(seed).integers(0, 2, size=p.size)
+        captured.update(Q=Q, p=p, const=const, x=x)
+        return x, None
+
+    monkeypatch.setitem(main.SOLVER_BACKENDS, "local", fake_solver)
+    result = solve_menu_locked(catalog, M=M, TARGET=TARGET, W=W, solver="local", locked=locked)
+    sol = np.zeros((catalog.N, M), dtype=int)
+    for day in result["plan"]["days"]:
+        for rec in day["recipes"]:
+            sol[catalog.recipe_index[rec["id"]], day["day"] - 1] += 1
+    return captured, sol, result
+
+
+def test_locked_energy_matches_full_qubo(monkeypatch, catalog, locked):
+    Q, p, const = build_qubo_coefficients(
+        catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost,
+        catalog.top_neighbors, catalog.top_sim, build_day_adjacency(M),
+        M=M, NUT_KEYS=catalog.NUT_KEYS, TARGET=TARGET, W=W,
+    )
+
+    offsets = []
+    for seed in range(6):
+        captured, sol, result = _solve_with(monkeypatch, catalog, locked, seed)
+        full = _energy(Q, p, const, sol)
+        # meta.energy（evaluate_qubo_terms の重み付き和）は期間全体の QUBO のエネルギー
+        assert result["meta"]["energy"] == pytest.approx(full, rel=1e-9, abs=1e-6)
+
+        # 固定した日と pin は解に残る
+        for entry in locked:
+            assert sol[catalog.recipe_index[entry["recipe_id"]], entry["day"] - 1] == 1
+        offsets.append(full - _energy(captured["Q"], captured["p"], captured["const"], captured["x"]))
+
+    np.testing.assert_allclose(offsets, offsets[0], rtol=0, atol=1e-6 * max(1.0, abs(offsets[0])))
@@ -0,0 +1,78 @@
+"""
+保存用の献立データ（compact 形式）を復元したときの単価・金額の確認
+
+学校の単価で解いた献立を compact 形式にし、共通の単価のカタログで復元しても、
+レシピの単価・金額が解いたときのもの（日別集計・合計コストと同じ）になること。
+
+    cd backend && python -m pytest -q test_menu_data.py
+"""
+
+import numpy as np
+import pytest
+
+from main import RecipeCatalog, compact_menu_data, decode_plan, load_json_sources, rehydrate_menu_data
+
+M = 3
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    return RecipeCatalog(*load_json_sources(), version="base")
+
+
+@pytest.fixture(scope="module")
+def priced(catalog):
+    """一部の食材だけ単価が違う学校のカタログ"""
+    table = {int(f): catalog.price_per_g.get(int(f), catalog.median_price) * (2.5 if n % 4 == 0 else 1.0)
+             for n, f in enumerate(catalog.food_ids)}
+    return catalog.with_prices(table, catalog.median_price, version="base-school")
+
+
+@pytest.fixture(scope="module")
+def result(priced):
+    sol = np.zeros((priced.N, M), dtype=int)
+    for r in range(M):
+        sol[[r * 4 + k for k in range(4)], r] = 1
+    plan, checks = decode_plan(priced, sol)
+    return {"meta": {"catalog_version": priced.version}, "plan": plan, "checks": checks}
+
+
+def _recipes(menu_data):
+    return [rec for day in menu_data["plan"]["days"] for rec in day["recipes"]]
+
+
+def test_rehydrate_uses_saved_prices(catalog, priced, result):
+    compact = compact_menu_data(result, priced.base_version, priced.version)
+    assert compact["catalog_version"] == "base"
+    assert compact["price_version"] == "base-school"
+
+    rehydrated = rehydrate_menu_data(catalog, compact)
+    assert rehydrated["meta"]["prices"] == "saved"
+    assert rehydrated["meta"]["price_version"] == "base-school"
+    assert not rehydrated["meta"]["catalog_version_mismatch"]
+
+    solved = _recipes(result)
+    restored = _recipes(rehydrated)
+    assert [rec["id"] for rec in restored] == [rec["id"] for rec in solved]
+    assert any(rec["recipe_cost"] != pytest.approx(float(catalog.recipe_cost[rec["idx"]])) for rec in solved)
+    for got, exp in zip(restored, solved):
+        assert got["recipe_cost"] == pytest.approx(exp["recipe_cost"])
+        assert [ing["unit_cost"] for ing in got["ingredients"]] == [ing["unit_cost"] for ing in exp["ingredients"]]
+        assert [ing["cost"] for ing in got["ingredients"]] == pytest.approx([ing["cost"] for ing in exp["ingredients"]])
+
+    for day, totals in zip(rehydrated["plan"]["days"], rehydrated["plan"]["daily_totals"]):
+        assert sum(rec["recipe_cost"] for rec in day["recipes"]) == pytest.approx(totals["totals"]["cost"])
+    assert rehydrated["plan"]["total_cost"] == result["plan"]["total_cost"]
+
+
+def test_rehydrate_without_saved_prices_is_flagged(catalog, priced, result):
+    # format_version 1 の行（unit_costs が無く、catalog_version は解いたカタログのもの）
+    compact = compact_menu_data(result, priced.base_version, priced.version)
+    legacy = {k: v for k, v in compact.items() if k not in ("unit_costs", "price_version")}
+    legacy.update(format_version=1, catalog_version=priced.version)
+
+    rehydrated = rehydrate_menu_data(catalog, legacy)
+    assert rehydrated["meta"]["prices"] == "catalog"
+    assert rehydrated["meta"]["catalog_version_mismatch"]
+    for rec in _recipes(rehydrated):
+        assert rec["recipe_cost"] == pytest.approx(float(catalog.recipe_cost[rec["idx"]]))
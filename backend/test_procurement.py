@@ -0,0 +1,103 @@
+"""
+発注集計（procurement_rollup）が献立を1日ずつたどって足し上げた結果と同じになることの確認
+
+DB は使わず、load_menu_days と同じ形の日ごとのタプルと、学校ごとの単価ベクトルを渡す。
+
+    cd backend && python -m pytest -q test_procurement.py
+"""
+
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from main import SCHOOL_WEEK_DAYS, RecipeCatalog, load_json_sources, procurement_rollup
+
+MISSING_ID = 999999
+SERVINGS = {1: 120.0, 2: 80.0}
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    return RecipeCatalog(*load_json_sources())
+
+
+@pytest.fixture(scope="module")
+def school_prices(catalog):
+    """学校ごとの {food_id: 単価}（学校2は学校1の一部の食材だけ単価が違う）"""
+    common = {int(f): catalog.price_per_g.get(int(f), catalog.median_price) for f in catalog.food_ids}
+    school2 = {fid: (price * 1.5 if fid % 3 == 0 else price) for fid, price in common.items()}
+    return {1: common, 2: school2}
+
+
+@pytest.fixture(scope="module")
+def days(catalog):
+    ids = list(catalog.df["recipe_id"])
+    return [
+        # (school_id, target_year_month, target_week, day, recipe_ids)
+        (1, "2026-04", 1, 1, ids[0:4]),
+        (1, "2026-04", 1, 2, ids[4:8] + [ids[4]]),  # 同じ日に同じレシピが2回
+        (1, "2026-04", 2, 6, ids[8:12]),
+        (1, "2026-04", None, 7, ids[12:16]),       # 週の無い献立は day から数える（7日目 → 2週目）
+        (2, "2026-04", 1, 1, ids[0:3] + [MISSING_ID]),
+        (2, "2026-04", 1, 2, ids[20:24]),
+        (2, "2026-05", 1, 1, ids[30:34]),
+    ]
+
+
+def _naive(catalog, days, school_prices, servings):
+    """献立 → レシピ（JSON の dict）→ 材料を1件ずつたどって週ごとに足す"""
+    recipes = {r["id"]: r for r in catalog.recipes}
+    grams = defaultdict(lambda: defaultdict(float))
+    n_days = defaultdict(int)
+    missing = set()
+    for sid, ym, week, day, recipe_ids in days:
+        key = (sid, ym, week if week is not None else (day - 1) // SCHOOL_WEEK_DAYS + 1)
+        n_days[key] += 1
+        for rid in recipe_ids:
+            r = recipes.get(rid)
+            if r is None:
+                missing.add(rid)
+                continue
+            for ing in r.get("ingredients", []):
+                if ing.get("id") is None or ing.get("amount") is None:
+                    continue
+                grams[key][int(ing["id"])] += float(ing["amount"]) * servings.get(sid, 1.0)
+
+    groups = {}
+    for key, foods in grams.items():
+        prices = school_prices[key[0]]
+        groups[key] = {
+            "days": n_days[key],
+            "foods": {fid: (g, g * prices[fid]) for fid, g in foods.items() if g != 0},
+        }
+    return groups, sorted(missing, key=str)
+
+
+def test_week_rollup_matches_naive_walk(catalog, days, school_prices):
+    unit_prices = {
+        sid: np.array([prices[int(f)] for f in catalog.food_ids]) for sid, prices in school_prices.items()
+    }
+    result = procurement_rollup(catalog, days, group_by="week", unit_prices=unit_prices, servings=SERVINGS)
+    expected, missing = _naive(catalog, days, school_prices, SERVINGS)
+
+    assert result["missing_recipe_ids"] == missing == [MISSING_ID]
+    got = {(g["school_id"], g["target_year_month"], g["target_week"]): g for g in result["groups"]}
+    assert set(got) == set(expected) == {(1, "2026-04", 1), (1, "2026-04", 2), (2, "2026-04", 1), (2, "2026-05", 1)}
+
+    for key, exp in expected.items():
+        group = got[key]
+        assert group["days"] == exp["days"]
+        foods = {f["food_id"]: f for f in group["foods"]}
+        assert set(foods) == set(exp["foods"])
+        for fid, (g, cost) in exp["foods"].items():
+            assert foods[fid]["grams"] == pytest.approx(g, abs=1e-3)
+            assert foods[fid]["cost"] == pytest.approx(cost, abs=1e-3)
+            assert foods[fid]["unit_cost"] == pytest.approx(school_prices[key[0]][fid])
+        assert group["total_grams"] == pytest.approx(sum(g for g, _ in exp["foods"].values()), abs=1e-2)
+        assert group["total_cost"] == pytest.approx(sum(c for _, c in exp["foods"].values()), abs=1e-2)
+
+    all_foods = [food for exp in expected.values() for food in exp["foods"].values()]
+    assert result["totals"]["days"] == len(days)
+    assert result["totals"]["grams"] == pytest.approx(sum(g for g, _ in all_foods), abs=1e-2)
+    assert result["totals"]["cost"] == pytest.approx(sum(c for _, c in all_foods), abs=1e-2)
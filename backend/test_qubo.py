@@ -0,0 +1,100 @@
+"""
+QUBO の2つの組み立てが同じ多項式になることの確認
+
+build_qubo_poly（Poly を1項ずつ組み立てる参照実装）と build_qubo_coefficients（NumPy の係数行列）を
+同梱の reciept.json の一部で作り、H1〜H7 の項ごとに係数とランダムな x でのエネルギーを比べる。
+
+    cd backend && python -m pytest -q test_qubo.py
+"""
+
+import numpy as np
+import pytest
+
+from main import (
+    REQ_CATS,
+    OPT_CATS,
+    RecipeCatalog,
+    build_day_adjacency,
+    build_qubo_coefficients,
+    build_qubo_poly,
+    load_json_sources,
+)
+
+M = 4
+TERMS = ("H1", "H2", "H3", "H4", "H5", "H7")
+TARGET = {"エネルギー": 650.0, "たんぱく質": 25.0, "脂質": 20.0, "ナトリウム": 1000.0, "cost": 1500.0}
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    full = RecipeCatalog(*load_json_sources())
+    # 各カテゴリから6件ずつ（計30件）。上位近傍の一部は候補外（-1）になる
+    idx = np.concatenate([np.where(full.cats == c)[0][:6] for c in REQ_CATS + OPT_CATS])
+    return full.subset(np.sort(idx))
+
+
+def _builders(catalog, W, H5_MODE):
+    args = (
+        catalog.cats, catalog.genres, catalog.nut, catalog.recipe_cost,
+        catalog.top_neighbors, catalog.top_sim, build_day_adjacency(M),
+    )
+    kwargs = dict(M=M, NUT_KEYS=catalog.NUT_KEYS, TARGET=TARGET, W=W, H5_MODE=H5_MODE)
+    _, H = build_qubo_poly(*args, **kwargs)
+    Q, p, const = build_qubo_coefficients(*args, **kwargs)
+    return H, Q, p, const
+
+
+def _canonical(Q, p, const):
+    """バイナリ変数の多項式として正規化（x² = x を一次に、(i, j) と (j, i) を i < j にまとめる）"""
+    n = p.size
+    Q = Q.reshape(n, n)
+    linear = p.ravel() + np.diag(Q)
+    quad = np.triu(Q, 1) + np.tril(Q, -1).T
+    return linear, quad, float(const)
+
+
+def _poly_canonical(H, n):
+    linear, quad, const = np.zeros(n), np.zeros((n, n)), 0.0
+    for key, coef in H.as_dict().items():
+        if len(key) == 0:
+            const += coef
+        elif len(key) == 1:
+            linear[key[0]] += coef
+        else:
+            i, j = sorted(key)
+            quad[i, j] += coef
+    return linear, quad, const
+
+
+@pytest.mark.parametrize("H5_MODE", ["practical", "paper"])
+@pytest.mark.parametrize("term", TERMS)
+def test_coefficients_match_per_term(catalog, term, H5_MODE):
+    W = {t: (1.0 if t == term else 0.0) for t in TERMS}
+    H, Q, p, const = _builders(catalog, W, H5_MODE)
+    n = catalog.N * M
+
+    lin_a, quad_a, const_a = _poly_canonical(H, n)
+    lin_b, quad_b, const_b = _canonical(Q, p, const)
+    scale = max(1.0, np.abs(lin_a).max(), np.abs(quad_a).max(), abs(const_a))
+    np.testing.assert_allclose(lin_b, lin_a, rtol=0, atol=1e-9 * scale)
+    np.testing.assert_allclose(quad_b, quad_a, rtol=0, atol=1e-9 * scale)
+    assert const_b == pytest.approx(const_a, rel=1e-12, abs=1e-9 * scale)
+
+    # ランダムな x でのエネルギー
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        x = (rng.random(n) < 0.2).astype(float)
+        e_poly = const_a + lin_a @ x + x @ quad_a @ x
+        e_coef = const + p.ravel() @ x + x @ Q.reshape(n, n) @ x
+        assert e_coef == pytest.approx(e_poly, rel=1e-9, abs=1e-9 * scale)
+
+
+def test_default_weights_match(catalog):
+    W = {"H1": 80.0, "H2": 0.03, "H3": 0.006, "H4": 20.0, "H5": 0.2, "H7": 0.2}
+    H, Q, p, const = _builders(catalog, W, "practical")
+    n = catalog.N * M
+    a = _poly_canonical(H, n)
+    b = _canonical(Q, p, const)
+    for u, v in zip(a[:2], b[:2]):
+        np.testing.assert_allclose(v, u, rtol=1e-12, atol=1e-9 * np.abs(u).max())
+    assert b[2] == pytest.approx(a[2], rel=1e-12)
@@ -0,0 +1,108 @@
+"""
+解の修復（repair_plan）が記録した手ごとのエネルギー変化が、evaluate_qubo_terms で測り直した値と同じになることの確認
+
+PlanState は1品の追加・削除のエネルギー変化（H2〜H7）を差分で求める。枠・重複の崩れた解を修復し、
+meta.repair.applied の手を元の解に1手ずつ当て直して、前後の evaluate_qubo_terms の差と delta を比べる。
+
+    cd backend && python -m pytest -q test_repair.py
+"""
+
+import numpy as np
+import pytest
+
+from main import (
+    OPT_CATS,
+    REQ_CATS,
+    PlanState,
+    RecipeCatalog,
+    evaluate_qubo_terms,
+    load_json_sources,
+    repair_plan,
+)
+
+M = 5
+TARGET = {"エネルギー": 650.0, "たんぱく質": 25.0, "脂質": 20.0, "ナトリウム": 1000.0, "cost": 1500.0}
+W = {"H1": 80.0, "H2": 0.03, "H3": 0.006, "H4": 20.0, "H5": 0.2, "H7": 0.2}
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    full = RecipeCatalog(*load_json_sources())
+    idx = np.concatenate([np.where(full.cats == c)[0][:6] for c in REQ_CATS + OPT_CATS])
+    return full.subset(np.sort(idx))
+
+
+def _broken_plan(catalog, seed):
+    """主食の無い日・2品ある枠・期間内の重複を含む解"""
+    rng = np.random.default_rng(seed)
+    sol = (rng.random((catalog.N, M)) < 0.15).astype(np.int8)
+    staple = np.where(catalog.cats == REQ_CATS[0])[0]
+    sol[staple, 0] = 0
+    sol[staple[:2], 1] = 1
+    sol[staple[2], 2:] = 1
+    return sol
+
+
+def _energy(catalog, sol, H5_MODE):
+    """PlanState と同じ H2〜H7 の重み付き和"""
+    terms = evaluate_qubo_terms(catalog, sol, TARGET=TARGET, H5_MODE=H5_MODE)
+    return sum(W[k] * v for k, v in terms.items() if k != "H1")
+
+
+def _apply(catalog, sol, move):
+    day = move["day"] - 1
+    if move["removed"] is not None:
+        sol[catalog.recipe_index[move["removed"]], day] -= 1
+    if move["added"] is not None:
+        sol[catalog.recipe_index[move["added"]], day] += 1
+    if move["action"] == "exchange":
+        other = move["with_day"] - 1
+        sol[catalog.recipe_index[move["added"]], other] -= 1
+        sol[catalog.recipe_index[move["removed"]], other] += 1
+
+
+@pytest.mark.parametrize("H5_MODE", ["practical", "paper"])
+@pytest.mark.parametrize("seed", range(3))
+def test_repair_deltas_match_evaluated_energy(catalog, seed, H5_MODE):
+    sol = _broken_plan(catalog, seed)
+    repaired, report = repair_plan(
+        catalog, sol, TARGET=TARGET, W=W, H5_MODE=H5_MODE, max_moves=50, time_limit_ms=60_000,
+    )
+    actions = {move["action"] for move in report["applied"]}
+    assert {"add", "remove", "dedupe"} <= actions
+    assert report["improvements"] > 0
+
+    replay = sol.astype(int)
+    for move in report["applied"]:
+        before = _energy(catalog, replay, H5_MODE)
+        _apply(catalog, replay, move)
+        assert replay.min() >= 0 and replay.max() <= 1
+        after = _energy(catalog, replay, H5_MODE)
+        assert move["delta"] == pytest.approx(after - before, rel=1e-6, abs=1e-5), move
+
+    np.testing.assert_array_equal(replay, repaired)
+    assert report["energy_after"] == pytest.approx(
+        sum(W[k] * v for k, v in evaluate_qubo_terms(catalog, repaired, TARGET=TARGET, H5_MODE=H5_MODE).items())
+    )
+
+
+def test_plan_state_deltas_match_evaluated_energy(catalog):
+    """1品の追加・削除・入れ替えの delta が、当てた前後の evaluate_qubo_terms の差と同じ"""
+    sol = _broken_plan(catalog, 7)
+    state = PlanState(catalog, sol, TARGET=TARGET, W=W)
+    rng = np.random.default_rng(0)
+    for _ in range(40):
+        r = int(rng.integers(M))
+        before = _energy(catalog, state.S, "practical")
+        chosen = np.flatnonzero(state.S[:, r])
+        if len(chosen) and rng.random() < 0.5:
+            i = int(rng.choice(chosen))
+            cands = np.flatnonzero(state.S[:, r] == 0)
+            j = int(rng.choice(cands))
+            expected = float(state.delta_swap(r, i, [j])[0])
+            delta = state.remove(r, i) + state.add(r, j)
+            assert delta == pytest.approx(expected, rel=1e-9, abs=1e-9)
+        else:
+            i = int(rng.choice(np.flatnonzero(state.S[:, r] == 0)))
+            delta = state.add(r, i)
+        assert delta == pytest.approx(_energy(catalog, state.S, "practical") - before, rel=1e-6, abs=1e-5)
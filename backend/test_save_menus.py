@@ -0,0 +1,99 @@
+"""
+save_menus_to_db の RETURNING の行を records の順の献立IDに戻す処理（menu_ids_by_record）の確認
+
+RETURNING の並びは保証されないので、行を並べ替えても records と同じ順の id になること。
+
+    cd backend && python -m pytest -q test_save_menus.py
+"""
+
+import random
+
+import pytest
+
+from main import menu_ids_by_record
+
+
+def _record(school_id, target_year_month, target_week):
+    return (school_id, target_year_month, target_week, {"format": "compact"}, 1500, {})
+
+
+RECORDS = [
+    _record(2, "2026-04", 1),
+    _record(1, "2026-04", 2),
+    _record(1, "2026-04", 1),
+    _record(1, "2026-05", None),
+    _record(1, "2026-05", None),  # 同じキーが2件（ord の順に採番される）
+    _record(3, "2026-04", 1),
+]
+
+
+def _returning_rows(records, first_id=100):
+    return [(first_id + n, r[0], r[1], r[2]) for n, r in enumerate(records)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ids_follow_records_regardless_of_returning_order(seed):
+    rows = _returning_rows(RECORDS)
+    random.Random(seed).shuffle(rows)
+    assert menu_ids_by_record(RECORDS, rows) == [100, 101, 102, 103, 104, 105]
+
+
+def test_driver_types_are_normalized():
+    # school_id が文字列、target_week が SMALLINT 由来の別の型で返ってきても対応づける
+    rows = [(str(menu_id), str(sid), ym, None if week is None else float(week))
+            for menu_id, sid, ym, week in _returning_rows(RECORDS)]
+    assert menu_ids_by_record(RECORDS, rows[::-1]) == [100, 101, 102, 103, 104, 105]
+
+
+def test_missing_row_raises():
+    rows = _returning_rows(RECORDS)
+    rows[0] = (100, 9, "2026-04", 1)
+    with pytest.raises(Exception):
+        menu_ids_by_record(RECORDS, rows)
+
+
+class _FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=()):
+        self.conn.executed.append((sql, args))
+
+    def fetchall(self):
+        # INSERT の args は1行7列（ord, school_id, target_year_month, target_week, ...）
+        sql, args = self.conn.executed[-1]
+        rows = [(500 + args[k], args[k + 1], args[k + 2], args[k + 3]) for k in range(0, len(args), 7)]
+        return rows[::-1]
+
+    def close(self):
+        pass
+
+
+class _FakeConnection:
+    def __init__(self):
+        self.executed = []
+        self.committed = False
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def test_save_menus_to_db_maps_ids_by_key(monkeypatch):
+    import main
+
+    conn = _FakeConnection()
+    monkeypatch.setattr(main, "db_connection", lambda: conn)
+    assert main.save_menus_to_db(RECORDS, replace=True) == [500, 501, 502, 503, 504, 505]
+    assert conn.committed
+    # replace はキーごとに1回だけ論理削除する
+    assert sum("UPDATE school_menus" in sql for sql, _ in conn.executed) == len({r[:3] for r in RECORDS})
+    assert "ORDER BY v.ord" in conn.executed[-1][0]
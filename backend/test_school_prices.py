@@ -0,0 +1,129 @@
+"""
+学校ごとの単価（food_costs）の読み込みの確認
+
+DB は使わず、db_connection を問い合わせを記録するだけの接続に差し替える。
+
+    cd backend && python -m pytest -q test_school_prices.py
+"""
+
+from datetime import datetime
+
+import pytest
+
+import main
+
+
+class _FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self._rows = []
+
+    def execute(self, sql, args=()):
+        self.db.queries.append(sql)
+        if "to_regclass" in sql:
+            self._rows = [(self.db.has_migrations_table,)]
+        elif "schema_migrations" in sql:
+            self._rows = [(1,)] if self.db.migrated else []
+        elif "COUNT(*)" in sql:
+            self._rows = [(sid, datetime(2026, 4, 1), len(rows)) for sid, rows in self.db.prices.items()]
+        elif "FROM food_costs" in sql:
+            self._rows = [(sid, fid, price) for sid, rows in self.db.prices.items() for fid, price in rows.items()]
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+class _FakeDB:
+    def __init__(self, *, has_migrations_table=True, migrated=True, prices=None):
+        self.has_migrations_table = has_migrations_table
+        self.migrated = migrated
+        self.prices = prices or {}
+        self.queries = []
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    monkeypatch.setattr(main, "_food_costs_migrated", False)
+    monkeypatch.setattr(main, "_food_costs_migration_warned", False)
+
+    def _install(**kwargs):
+        db = _FakeDB(**kwargs)
+        monkeypatch.setattr(main, "db_connection", lambda: db)
+        return db
+
+    return _install
+
+
+@pytest.mark.parametrize("has_table", [False, True])
+def test_food_costs_not_read_before_migration(fake_db, has_table):
+    db = fake_db(has_migrations_table=has_table, migrated=False, prices={1: {85: 9.9}})
+    assert main.load_school_price_watermarks([1]) == {}
+    assert main.load_school_prices([1]) == {}
+    assert not any("FROM food_costs" in sql for sql in db.queries)
+
+
+def test_food_costs_read_after_migration(fake_db):
+    db = fake_db(prices={1: {85: 9.9, 174: 1.5}})
+    assert main.load_school_price_watermarks([1]) == {1: ("2026-04-01T00:00:00", 2)}
+    assert main.load_school_prices([1]) == {1: {85: 9.9, 174: 1.5}}
+    # 移行済みと分かった後は schema_migrations を問い合わせない
+    assert sum("schema_migrations" in sql for sql in db.queries) == 2
+
+
+def test_migration_applied_later_is_picked_up(fake_db):
+    catalog = main.get_catalog()
+    db = fake_db(migrated=False, prices={1: {int(catalog.food_ids[0]): 123.0}})
+    cache = main.SchoolPriceCache(0)
+    assert cache.catalogs(catalog, [1])[1] is catalog
+
+    db.migrated = True
+    school = cache.catalogs(catalog, [1])[1]
+    assert school is not catalog
+    assert school.version != catalog.version
+
+
+def test_failed_check_waits_check_seconds(fake_db, monkeypatch):
+    catalog = main.get_catalog()
+    db = fake_db(prices={1: {int(catalog.food_ids[0]): 123.0}})
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    cache = main.SchoolPriceCache(30)
+    monkeypatch.setattr(main, "school_price_cache", cache)
+    priced = cache.catalogs(catalog, [1])[1]
+
+    def broken():
+        db.queries.append("connect")
+        raise ConnectionError("db down")
+
+    monkeypatch.setattr(main, "db_connection", broken)
+    clock[0] += 30
+    # 読めた学校は前回の単価で続け、失敗のあとも check_seconds までは DB に問い合わせない
+    for _ in range(3):
+        assert cache.catalogs(catalog, [1])[1] is priced
+    assert db.queries.count("connect") == 1
+    assert cache.stats()["failures"] == 1
+
+    # まだ行の無い学校は共通の単価に戻り（school_catalog）、こちらも再試行は check_seconds 後
+    params = {"use_school_prices": True, "school_id": 2}
+    for _ in range(3):
+        assert main.school_catalog(catalog, params) is catalog
+    assert db.queries.count("connect") == 2
+
+    clock[0] += 30
+    assert main.school_catalog(catalog, params) is catalog
+    assert db.queries.count("connect") == 3
@@ -0,0 +1,18 @@
+"""
+本番用の WSGI エントリポイント（gunicorn -c gunicorn.conf.py wsgi:app）
+
+gunicorn.conf.py の preload_app により、マスタープロセスがこのモジュールを1回だけ読み込む。
+重い import（numpy / scipy / amplify / psycopg2）とウォームアップ（レシピカタログの読み込み）を
+済ませてから fork するので、ワーカーはそれらをコピーオンライトで共有し、起動直後から /readyz が 200 を返す。
+"""
+
+import gc
+
+import main
+
+main.warmup()
+
+# fork 後に GC の走査で共有ページに書き込み（コピーが発生）しないよう、ここまでのオブジェクトを GC の対象外にする
+gc.freeze()
+
+app = main.app
@@ -3,6 +3,21 @@
 -- データベーステーブル作成SQL
 -- ==================================================
 
+-- 0. スキーマの移行記録
+-- ==================================================
+
+-- 0.1 schema_migrations（適用済みの移行。docs/migrations/ の SQL が記録する）
+CREATE TABLE schema_migrations (
+    version VARCHAR(100) PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE schema_migrations IS '適用済みのスキーマ移行（このファイルで作った DB は最新の形なので全件を記録する）';
+
+-- 新規作成した DB は移行後の形なので、適用済みとして記録する
+-- （サーバーは 001 の記録があるまで food_costs を読まない）
+INSERT INTO schema_migrations (version) VALUES ('001_food_costs_school_food_key');
+
 -- 1. 小学校・ユーザー管理
 -- ==================================================
 
@@ -92,19 +107,32 @@ COMMENT ON COLUMN recipe_ingredients.amount_g IS '使用量（g）';
 
 -- 2.3 food_costs（食材単価）
 CREATE TABLE food_costs (
-    food_id SERIAL PRIMARY KEY,
-    school_id INTEGER REFERENCES schools(school_id),
+    school_id INTEGER NOT NULL REFERENCES schools(school_id),
+    food_id INTEGER NOT NULL,
     price_per_gram DECIMAL(10,4) NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    deleted_at TIMESTAMP DEFAULT NULL
+    deleted_at TIMESTAMP DEFAULT NULL,
+    PRIMARY KEY (school_id, food_id)
 );
 
 COMMENT ON TABLE food_costs IS '食材単価（小学校ごとに異なる地域の仕入れ価格差を考慮）';
-COMMENT ON COLUMN food_costs.food_id IS '食材ID（自動採番）';
+COMMENT ON COLUMN food_costs.food_id IS '食材ID（レシピの食材 id）';
 COMMENT ON COLUMN food_costs.school_id IS '小学校ID';
 COMMENT ON COLUMN food_costs.price_per_gram IS 'グラム単価（円/g）';
 
+-- 単価を書き換えたら updated_at も進める（サーバーは学校ごとの最終更新時刻と行数で単価の変更を検知する）
+CREATE OR REPLACE FUNCTION touch_food_costs_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_food_costs_updated_at
+    BEFORE UPDATE ON food_costs
+    FOR EACH ROW EXECUTE FUNCTION touch_food_costs_updated_at();
+
 -- 3. 実行ログ・献立保存
 -- ==================================================
 
@@ -125,7 +153,7 @@ COMMENT ON COLUMN recommendation_logs.log_id IS 'ログID（自動採番）';
 COMMENT ON COLUMN recommendation_logs.school_id IS '小学校ID';
 COMMENT ON COLUMN recommendation_logs.solver_time IS 'ソルバー実行時間（秒）';
 COMMENT ON COLUMN recommendation_logs.total_time IS '総処理時間（秒）';
-COMMENT ON COLUMN recommendation_logs.parameters IS '実行パラメータ（制約の重み等、JSON形式）';
+COMMENT ON COLUMN recommendation_logs.parameters IS '実行パラメータ（制約の重み・段階ごとの所要時間等、JSON形式）';
 
 -- 3.2 school_menus（献立保存）
 CREATE TABLE school_menus (
@@ -146,9 +174,25 @@ COMMENT ON COLUMN school_menus.school_menu_id IS '献立ID（自動採番）';
 COMMENT ON COLUMN school_menus.school_id IS '小学校ID';
 COMMENT ON COLUMN school_menus.target_year_month IS '対象年月（YYYY-MM形式、例: "2026-03"）';
 COMMENT ON COLUMN school_menus.target_week IS '対象週（1〜5週目）';
-COMMENT ON COLUMN school_menus.menu_data IS '献立データ（QUBO出力をそのまま保存、JSON形式）';
+COMMENT ON COLUMN school_menus.menu_data IS '献立データ（compact 形式：日ごとの recipe_id・日別集計・カタログバージョン、JSON形式）';
 COMMENT ON COLUMN school_menus.total_cost IS '合計コスト（円）';
 COMMENT ON COLUMN school_menus.total_nutrition_avg IS '平均栄養価（JSON形式）';
+COMMENT ON COLUMN school_menus.deleted_at IS '削除日時（置き換えられた献立に設定、NULLなら有効）';
+
+-- 3.3 optimize_result_cache（最適化結果キャッシュ）
+CREATE TABLE optimize_result_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    catalog_version VARCHAR(32) NOT NULL,
+    result JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+COMMENT ON TABLE optimize_result_cache IS '最適化結果キャッシュ（同じ入力・同じカタログの結果を再利用）';
+COMMENT ON COLUMN optimize_result_cache.cache_key IS 'ソルバー入力とカタログバージョンのSHA-256';
+COMMENT ON COLUMN optimize_result_cache.catalog_version IS 'レシピカタログのバージョン';
+COMMENT ON COLUMN optimize_result_cache.result IS '最適化結果（/optimize のレスポンス、JSON形式）';
+COMMENT ON COLUMN optimize_result_cache.expires_at IS '有効期限';
 
 -- 4. 学習用データ（QUBO制約項用）
 -- ==================================================
@@ -197,6 +241,9 @@ CREATE INDEX idx_school_menus_school_month ON school_menus(school_id, target_yea
 -- ログ検索用
 CREATE INDEX idx_recommendation_logs_school ON recommendation_logs(school_id, created_at DESC);
 
+-- 期限切れキャッシュ削除用
+CREATE INDEX idx_optimize_result_cache_expires ON optimize_result_cache(expires_at);
+
 -- レシピ検索用（食材から逆引き）
 CREATE INDEX idx_recipe_ingredients_recipe ON recipe_ingredients(recipe_id);
 
@@ -0,0 +1,90 @@
+-- ==================================================
+-- 001: food_costs を (school_id, food_id) の単価表にする
+-- ==================================================
+-- 移行前の food_costs は food_id が SERIAL（行の自動採番）で、レシピの食材 id ではない。
+-- 移行後は food_id をレシピの食材 id（reciept.json の ingredients[].id）とし、主キーを (school_id, food_id) にする。
+--
+-- 手順:
+--   1. 既存の行は food_costs_legacy に退避する（自動採番の id を食材 id として読まない）
+--   2. 新しい food_costs と updated_at のトリガーを作る
+--   3. food_costs_legacy_map（旧 id → 食材 id）に入っている行だけを新しい food_costs に移す
+--   4. schema_migrations に記録する（サーバーは記録があるまで food_costs を読まず、共通の価格表を使う）
+--
+-- 何度流してもよい（適用済みなら 1〜2 と 4 は何もしない）。food_costs_legacy_map を後から埋めた場合は、
+-- もう一度流すと 3 の移し替えだけが行われる。
+--
+--   psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f docs/migrations/001_food_costs_school_food_key.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version VARCHAR(100) PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION touch_food_costs_updated_at() RETURNS trigger AS $fn$
+BEGIN
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$fn$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM schema_migrations WHERE version = '001_food_costs_school_food_key') THEN
+        RAISE NOTICE '001_food_costs_school_food_key is already applied';
+        RETURN;
+    END IF;
+
+    -- 1. 旧テーブルを退避（主キーのインデックス名も空ける）
+    IF to_regclass('food_costs') IS NOT NULL THEN
+        ALTER TABLE food_costs RENAME TO food_costs_legacy;
+        IF to_regclass('food_costs_pkey') IS NOT NULL THEN
+            ALTER INDEX food_costs_pkey RENAME TO food_costs_legacy_pkey;
+        END IF;
+        DROP TRIGGER IF EXISTS trg_food_costs_updated_at ON food_costs_legacy;
+    END IF;
+
+    -- 2. 新しい food_costs
+    CREATE TABLE food_costs (
+        school_id INTEGER NOT NULL REFERENCES schools(school_id),
+        food_id INTEGER NOT NULL,
+        price_per_gram DECIMAL(10,4) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        deleted_at TIMESTAMP DEFAULT NULL,
+        PRIMARY KEY (school_id, food_id)
+    );
+    COMMENT ON TABLE food_costs IS '食材単価（小学校ごとに異なる地域の仕入れ価格差を考慮）';
+    COMMENT ON COLUMN food_costs.food_id IS '食材ID（レシピの食材 id）';
+    COMMENT ON COLUMN food_costs.school_id IS '小学校ID';
+    COMMENT ON COLUMN food_costs.price_per_gram IS 'グラム単価（円/g）';
+
+    CREATE TRIGGER trg_food_costs_updated_at
+        BEFORE UPDATE ON food_costs
+        FOR EACH ROW EXECUTE FUNCTION touch_food_costs_updated_at();
+
+    INSERT INTO schema_migrations (version) VALUES ('001_food_costs_school_food_key');
+END
+$$;
+
+-- 3. 旧 id → 食材 id の対応表（運用側で埋める。空なら何も移さない）
+CREATE TABLE IF NOT EXISTS food_costs_legacy_map (
+    legacy_food_id INTEGER PRIMARY KEY,
+    food_id INTEGER NOT NULL
+);
+
+DO $$
+BEGIN
+    IF to_regclass('food_costs_legacy') IS NOT NULL THEN
+        INSERT INTO food_costs (school_id, food_id, price_per_gram, created_at, updated_at)
+        SELECT l.school_id, m.food_id, l.price_per_gram, l.created_at, CURRENT_TIMESTAMP
+        FROM food_costs_legacy l
+        JOIN food_costs_legacy_map m ON m.legacy_food_id = l.food_id
+        WHERE l.deleted_at IS NULL AND l.school_id IS NOT NULL
+        ON CONFLICT (school_id, food_id) DO NOTHING;
+    END IF;
+END
+$$;
+
+COMMIT;
@@ -61,7 +61,9 @@ const MenuCalendar = ({ generatedMenu, selectedMonth }) => {
 
         const savedData = await getSavedMenu({
           school_id: 1, // 固定値（将来的にはログイン情報から取得）
-          target_year_month: targetYearMonth
+          target_year_month: targetYearMonth,
+          view: 'summary',   // カレンダーにはレシピ名・カテゴリだけあればよい
+          latest_only: true  // 同じ週の古い保存は不要
         });
 
         // 複数週のデータを処理
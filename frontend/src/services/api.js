@@ -21,7 +21,7 @@ const apiClient = axios.create({
  * @param {Object} params - リクエストパラメータ
  * @param {number} params.days - 献立を作成する日数（通常は5）
  * @param {number} params.cost - M日間の合計コスト目標値（円）
- * @param {string} [params.school_id] - 小学校ID（オプション、デフォルト: "default_school"）
+ * @param {number} [params.school_id] - 小学校ID（オプション、デフォルト: 1）
  * @param {string} [params.target_year_month] - 対象年月（YYYY-MM-DD形式、オプション）
  * @param {Object} params.history - 履歴データ（現在は未使用）
  * @returns {Promise} APIレスポンス
@@ -65,7 +65,7 @@ export const generateMenu = async (params) => {
       M: params.days || 5,  // 献立日数
       cost: params.cost || 1500.0,  // M日間の合計コスト目標値
       save_to_db: true,  // データベースに保存
-      school_id: params.school_id || 9999,  // 小学校ID
+      school_id: params.school_id || 1,  // 小学校ID
       target_year_month: params.target_year_month || null,  // 対象年月（YYYY-MM-DD形式）
       target_week: params.target_week || null  // 対象週（1〜5、NULLも可）
     };
@@ -247,16 +247,20 @@ export const getRecipes = async () => {
  * @param {number} [params.school_id=1] - 小学校ID
  * @param {string} [params.target_year_month] - 対象年月（YYYY-MM-DD形式）
  * @param {number} [params.target_week] - 対象週（1〜5、省略時は月全体のすべての週を取得）
+ * @param {string} [params.view] - 'full'（既定）または 'summary'（カレンダー表示用にレシピ名・カテゴリと日別集計だけ）
+ * @param {boolean} [params.latest_only] - 月全体の取得時に、週ごとに最新の1件だけを取得するか
  * @returns {Promise} APIレスポンス（target_week指定時は単一オブジェクト、未指定時は{menus: []}）
  */
 export const getSavedMenu = async (params = {}) => {
   try {
-    const { school_id = 1, target_year_month, target_week } = params;
+    const { school_id = 1, target_year_month, target_week, view, latest_only } = params;
 
     const response = await apiClient.post('/get_menu', {
       school_id,
       target_year_month,
       target_week,
+      view,
+      latest_only,
     });
 
     console.log('✅ Saved menu retrieved successfully:', response.data);